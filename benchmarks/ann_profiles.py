@@ -0,0 +1,129 @@
+"""
+Recall and latency of the vector index profiles (lib/docker/index_profiles.py) on a fixed query set.
+
+Each profile's index is built through index_profiles.build_index on the local OpenSearch stand-in in approximate
+mode, which searches it through an HNSW graph with the profile's m, ef_construction, ef_search and quantization.
+For every profile it reports:
+  * recall_at_k:           overlap of the top k hits with the exact top k, found by brute force
+  * p50_ms / p99_ms:       search latency of the stand-in, only comparable between profiles of one run
+  * distances_per_query:   vector comparisons per search, the engine-independent cost of a query
+  * build_s:               time to bulk index the corpus
+  * memory_per_vector_b:   estimated native memory per vector in OpenSearch, for the embedding model's dimension
+
+The corpus is synthetic: unit vectors drawn around random cluster centres, with queries drawn the same way.
+
+Usage:
+    python benchmarks/ann_profiles.py --documents 2000 --queries 100 --dimension 64 --profiles low-latency balanced
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lib', 'docker'))
+
+import embedders  # noqa: E402
+import index_profiles  # noqa: E402
+from local_ann import SPACES  # noqa: E402
+from local_standins import FakeOpenSearch  # noqa: E402
+from opensearch_bulk import BulkItem, bulk_index  # noqa: E402
+from tracing import percentile  # noqa: E402
+
+ALIAS = 'rag-vector-index'
+VECTOR_FIELD = 'vector_field'
+
+
+def unit(vector):
+    norm = sum(value * value for value in vector) ** 0.5 or 1.0
+    return [value / norm for value in vector]
+
+
+def clustered_vectors(count, dimension, clusters, spread, rng):
+    centres = [[rng.gauss(0, 1) for _ in range(dimension)] for _ in range(clusters)]
+    return [unit([value + rng.gauss(0, spread) for value in rng.choice(centres)]) for _ in range(count)]
+
+
+def exact_neighbours(space_type, vectors, query, k):
+    distance, _ = SPACES[space_type]
+    return sorted(range(len(vectors)), key=lambda position: distance(query, vectors[position]))[:k]
+
+
+def run_profile(name, corpus, queries, args):
+    profile = index_profiles.resolve_profile({'base': name, 'dimension': args.dimension})
+    space_type = profile.get('space_type') or 'l2'
+
+    client = FakeOpenSearch(approximate=True)
+    index_name, _, _ = index_profiles.build_index(client, ALIAS, profile, vector_field=VECTOR_FIELD)
+    items = [BulkItem(str(position), {VECTOR_FIELD: vector, 'text': str(position)}, doc_id=str(position))
+             for position, vector in enumerate(corpus)]
+    started = time.perf_counter()
+    result = bulk_index(client, ALIAS, items)
+    build_s = time.perf_counter() - started
+    if result['failed']:
+        raise RuntimeError(f"{name}: {len(result['failed'])} documents failed to index")
+
+    graph, _ = client.graphs[index_name][VECTOR_FIELD]
+    graph.distance_computations = 0
+    latencies = []
+    recalls = []
+    for query in queries:
+        body = {'size': args.k, 'query': {'knn': {VECTOR_FIELD: {'vector': query, 'k': args.k}}}}
+        started = time.perf_counter()
+        response = client.search(body=body, index=ALIAS)
+        latencies.append(time.perf_counter() - started)
+        found = {hit['_id'] for hit in response['hits']['hits']}
+        expected = {str(position) for position in exact_neighbours(space_type, corpus, query, args.k)}
+        recalls.append(len(found & expected) / args.k)
+
+    dimension = embedders.build_embedder(args.model_id, args.model_dimensions).dimension
+    return {
+        'profile': profile,
+        'recall_at_k': round(sum(recalls) / len(recalls), 4),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'distances_per_query': round(graph.distance_computations / len(queries), 1),
+        'build_s': round(build_s, 2),
+        'memory_per_vector_b': index_profiles.memory_per_vector(dimension, profile),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', nargs='+', default=list(index_profiles.PROFILES), choices=list(index_profiles.PROFILES))
+    parser.add_argument('--documents', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--dimension', type=int, default=64, help='Dimension of the synthetic vectors')
+    parser.add_argument('--clusters', type=int, default=50)
+    parser.add_argument('--spread', type=float, default=0.6, help='Standard deviation around the cluster centres')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--model-id', default=embedders.DEFAULT_MODEL_ID,
+                        help='Embedding model whose dimension the memory estimate is for')
+    parser.add_argument('--model-dimensions', type=int, help='Output dimensions of the embedding model, for Titan v2')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vectors = clustered_vectors(args.documents + args.queries, args.dimension, args.clusters, args.spread, rng)
+    corpus, queries = vectors[:args.documents], vectors[args.documents:]
+
+    results = {'config': vars(args), 'profiles': {}}
+    for name in args.profiles:
+        summary = run_profile(name, corpus, queries, args)
+        results['profiles'][name] = summary
+        print(f"{name}: recall@{args.k} {summary['recall_at_k']} p50 {summary['p50_ms']}ms p99 {summary['p99_ms']}ms "
+              f"{summary['distances_per_query']} distances/query, built in {summary['build_s']}s, "
+              f"~{summary['memory_per_vector_b']} B/vector")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
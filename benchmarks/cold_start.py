@@ -0,0 +1,132 @@
+"""
+Cold-start benchmark for the Python Lambda functions.
+
+Every run starts a fresh interpreter, the way Lambda starts a new container, and measures:
+  * import_s: importing the handler module
+  * init_s:   creating the Bedrock and OpenSearch clients (no network calls are made)
+  * total_s:  both of the above
+
+The "vendored" mode imports the function from a locally built asset that has its requirements.txt
+installed next to it, as the CDK bundling does. The "pip" mode replays the old behaviour of running
+pip install into /tmp at import time, so the two can be compared. The pip mode needs network access.
+
+Usage:
+    python benchmarks/cold_start.py --function indexer --runs 5 --modes vendored pip --output cold_start.json
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_DIR = os.path.join(REPO_ROOT, 'lib', 'docker')
+
+# The legacy cold start path, as both Lambda functions used to run it at module import.
+LEGACY_PIP_COMMAND = ['install', '-I', '-q', 'boto3', 'requests', 'opensearch-py==2.4.2', 'urllib3',
+                      '--no-cache-dir', '--disable-pip-version-check']
+
+VENDORED_PROBE = """
+import json, sys, time
+sys.path.insert(0, {bundle!r})
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+import rag_clients
+rag_clients.get_bedrock_client()
+rag_clients.get_opensearch_client('localhost')
+initialized = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'init_s': initialized - imported}}))
+"""
+
+PIP_PROBE = """
+import json, sys, tempfile, time
+start = time.perf_counter()
+from pip._internal import main
+target = tempfile.mkdtemp()
+main({command!r} + ['--target', target])
+sys.path.insert(0, target)
+import boto3
+from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+imported = time.perf_counter()
+boto3.client('bedrock-runtime', 'us-east-1')
+OpenSearch(hosts=[{{'host': 'localhost', 'port': 443}}],
+           http_auth=AWSV4SignerAuth(boto3.Session().get_credentials(), 'us-east-1', 'aoss'),
+           use_ssl=True, connection_class=RequestsHttpConnection)
+initialized = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'init_s': initialized - imported}}))
+"""
+
+
+def build_bundle(function_name, target):
+    """
+    Builds the Lambda asset the same way the CDK bundling does: requirements, function code, shared modules.
+    """
+    function_dir = os.path.join(REPO_ROOT, 'lambda', function_name)
+    subprocess.run([sys.executable, '-m', 'pip', 'install', '-q', '--no-cache-dir', '--disable-pip-version-check',
+                    '-r', os.path.join(function_dir, 'requirements.txt'), '-t', target], check=True)
+    for path in glob.glob(os.path.join(function_dir, '*.py')) + glob.glob(os.path.join(SHARED_DIR, '*.py')):
+        shutil.copy(path, target)
+
+
+def run_probe(code):
+    env = dict(os.environ)
+    # Dummy credentials and endpoint, the probes only construct clients
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    env.setdefault('AWS_REGION', 'us-east-1')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('opensearch_host', 'localhost')
+    # Run from an empty directory so nothing on the caller's path leaks into the measurement
+    with tempfile.TemporaryDirectory() as cwd:
+        output = subprocess.run([sys.executable, '-c', code], env=env, cwd=cwd, check=True,
+                                capture_output=True, text=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings['total_s'] = timings['import_s'] + timings['init_s']
+    return timings
+
+
+def summarize(runs):
+    return {
+        metric: {
+            'median': statistics.median(run[metric] for run in runs),
+            'min': min(run[metric] for run in runs),
+            'max': max(run[metric] for run in runs),
+        }
+        for metric in ('import_s', 'init_s', 'total_s')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--function', default='indexer', choices=['indexer', 'aoss'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=['vendored'], choices=['vendored', 'pip'])
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {'function': args.function, 'runs': args.runs, 'modes': {}}
+    for mode in args.modes:
+        if mode == 'vendored':
+            bundle = tempfile.mkdtemp(prefix=f'{args.function}-asset-')
+            build_bundle(args.function, bundle)
+            code = VENDORED_PROBE.format(bundle=bundle)
+        else:
+            code = PIP_PROBE.format(command=LEGACY_PIP_COMMAND)
+        runs = [run_probe(code) for _ in range(args.runs)]
+        results['modes'][mode] = summarize(runs)
+        print(f"{mode}: median cold start {results['modes'][mode]['total_s']['median']:.3f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
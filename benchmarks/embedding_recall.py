@@ -0,0 +1,149 @@
+"""
+Recall cost of smaller or cheaper embeddings (lib/docker/embedders.py) on the MLA-C01 query set.
+
+The PDF chunks and the questions in benchmarks/mla_c01_queries.json are embedded with a reference embedder
+(Titan v1, the model the index was built with so far) and with every candidate. Each question is answered by
+exact search over the chunks, so the index's ANN approximation stays out of the comparison, and for every
+candidate it reports:
+  * recall_at_k:          overlap of the candidate's top k chunks with the reference's top k
+  * recall_by_domain:     the same, per exam domain of the query set
+  * bytes_per_vector:     raw float32 size of one vector, what the collection stores
+  * memory_per_vector_b:  estimated native HNSW memory per vector for the index profile
+  * search_p50_ms:        exact search latency per query over the corpus, which grows with the dimension
+  * embed_s / calls:      time and Bedrock calls to embed the corpus
+
+Candidates are model ids, with the output dimensions after an @ for Titan v2.
+
+Usage:
+    python benchmarks/embedding_recall.py --docs <pdf or dir> \\
+        --candidates amazon.titan-embed-text-v2:0@1024 amazon.titan-embed-text-v2:0@256 cohere.embed-english-v3
+    python benchmarks/embedding_recall.py --docs <pdf or dir> --local
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lib', 'docker'))
+
+import embedders  # noqa: E402
+import index_profiles  # noqa: E402
+import rag_clients  # noqa: E402
+from ingest_pipeline import build_text_splitter, iter_chunks, iter_pages, list_pdfs  # noqa: E402
+from local_ann import SPACES  # noqa: E402
+from tracing import percentile  # noqa: E402
+
+QUERY_SET = os.path.join(REPO_ROOT, 'benchmarks', 'mla_c01_queries.json')
+DEFAULT_CANDIDATES = [f"{embedders.TITAN_V2_MODEL_ID}@{dimensions}" for dimensions in (1024, 512, 256)]
+
+
+def parse_candidate(spec):
+    model_id, _, dimensions = spec.partition('@')
+    return embedders.build_embedder(model_id, int(dimensions) if dimensions else None)
+
+
+def load_chunks(path, limit):
+    text_splitter = build_text_splitter()
+    chunks = []
+    for pdf in list_pdfs(path):
+        for chunk in iter_chunks(iter_pages(pdf), text_splitter):
+            chunks.append(chunk.page_content)
+            if limit and len(chunks) >= limit:
+                return chunks
+    return chunks
+
+
+def embed_corpus(embedder, bedrock, texts, concurrency):
+    batches = [texts[start:start + embedder.batch_size] for start in range(0, len(texts), embedder.batch_size)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        vectors = [vector for batch in executor.map(lambda batch: embedder.embed_documents(bedrock, batch), batches)
+                   for vector in batch]
+    return vectors, time.perf_counter() - started, len(batches)
+
+
+def exact_search(vectors, query, k, space_type):
+    distance, _ = SPACES[space_type]
+    return sorted(range(len(vectors)), key=lambda position: distance(query, vectors[position]))[:k]
+
+
+def run_embedder(embedder, bedrock, chunks, queries, args):
+    vectors, embed_s, calls = embed_corpus(embedder, bedrock, chunks, args.concurrency)
+    query_vectors = [embedder.embed_query(bedrock, query['question']) for query in queries]
+    latencies = []
+    results = []
+    for query_vector in query_vectors:
+        started = time.perf_counter()
+        results.append(exact_search(vectors, query_vector, args.k, args.space_type))
+        latencies.append(time.perf_counter() - started)
+    return results, {
+        'dimension': embedder.dimension,
+        'bytes_per_vector': 4 * embedder.dimension,
+        'memory_per_vector_b': index_profiles.memory_per_vector(embedder.dimension, args.profile),
+        'search_p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'embed_s': round(embed_s, 2),
+        'calls': calls + len(queries),
+    }
+
+
+def recall(reference, results, queries, k):
+    by_domain = defaultdict(list)
+    for query, expected, found in zip(queries, reference, results):
+        by_domain[query['domain']].append(len(set(expected) & set(found)) / k)
+    overall = [value for values in by_domain.values() for value in values]
+    return (round(sum(overall) / len(overall), 4),
+            {domain: round(sum(values) / len(values), 4) for domain, values in sorted(by_domain.items())})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', required=True, help='A PDF or a directory of PDFs to retrieve from')
+    parser.add_argument('--queries', default=QUERY_SET, help='JSON list of {"domain", "question"} objects')
+    parser.add_argument('--reference', default=embedders.DEFAULT_MODEL_ID, help='Embedder the recall is measured against')
+    parser.add_argument('--candidates', nargs='+', default=DEFAULT_CANDIDATES, help='model_id[@dimensions] to compare')
+    parser.add_argument('--max-chunks', type=int, default=2000, help='Stop reading the PDFs after this many chunks')
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--space-type', default='l2', choices=sorted(SPACES))
+    parser.add_argument('--profile', default='balanced', choices=list(index_profiles.PROFILES),
+                        help='Index profile the HNSW memory estimate is for')
+    parser.add_argument('--concurrency', type=int, default=8, help='Embedding calls in flight')
+    parser.add_argument('--local', action='store_true', help='Use the in-process Bedrock stand-in')
+    parser.add_argument('--bedrock-latency-ms', type=float, default=0.0, help='Simulated Bedrock latency with --local')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.local:
+        from local_standins import FakeBedrockRuntime
+
+        bedrock = FakeBedrockRuntime(latency=args.bedrock_latency_ms / 1000)
+    else:
+        bedrock = rag_clients.get_bedrock_client(max_pool_connections=args.concurrency)
+
+    with open(args.queries) as f:
+        queries = json.load(f)
+    chunks = load_chunks(args.docs, args.max_chunks)
+    print(f"{len(chunks)} chunks, {len(queries)} queries")
+
+    reference, summary = run_embedder(parse_candidate(args.reference), bedrock, chunks, queries, args)
+    results = {'config': vars(args), 'chunks': len(chunks), 'reference': summary, 'candidates': {}}
+    for spec in args.candidates:
+        found, summary = run_embedder(parse_candidate(spec), bedrock, chunks, queries, args)
+        summary['recall_at_k'], summary['recall_by_domain'] = recall(reference, found, queries, args.k)
+        results['candidates'][spec] = summary
+        print(f"{spec}: recall@{args.k} {summary['recall_at_k']} at {summary['dimension']} dims, "
+              f"{summary['bytes_per_vector']} B/vector raw, ~{summary['memory_per_vector_b']} B/vector in HNSW, "
+              f"search p50 {summary['search_p50_ms']}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""
+Throughput benchmark of the ingest and query pipelines, against the local stand-ins for Bedrock, SQS and
+OpenSearch (lib/docker/local_standins.py), so it runs anywhere and runs can be compared.
+
+The code under test is the code that runs in production, only the AWS clients are replaced:
+  * ingest:      PDFs are split in a process pool (chunking.chunk_files) and sent by docs_to_openSearch.ingest_file
+                 to an SQS stand-in; --lambda-concurrency pollers drain it in batches of --sqs-batch-size records
+                 through the indexer Lambda handler, the way the event source mapping invokes it. The handler
+                 embeds with the Bedrock stand-in and bulk writes into the local vector store. Records it reports
+                 as failed are received again once the retry delay it gives them has passed (--retry-base-s), and
+                 go to the dead letters after --max-receive-count receives.
+  * query:       query_against_openSearch.answer_query over the ingested index from --query-concurrency threads,
+                 with unique questions so the caches don't hide the downstream latency
+  * cold start:  import and client creation of the indexer handler and of the query module, each in a fresh
+                 interpreter, see cold_start.py
+
+Every call to a stand-in takes the injected latency; Bedrock throttles calls beyond --bedrock-max-concurrency in
+flight or at --bedrock-throttle-rate, and the vector store rejects --bulk-throttle-rate of the bulk items with a 429.
+
+Reported, as JSON: ingest chunks_per_s (from the first page parsed to the last document indexed), redelivered
+records, dead letters and throttled calls, the per-stage timings from the spans; query p50/p95/p99; peak resident
+memory of the process and of the pool workers; cold start seconds. With --baseline, every headline metric is
+compared with a previous run's output and the script exits with status 1 when one of them regressed by more than
+--tolerance.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py --docs <pdf or dir> --output run.json
+    python benchmarks/pipeline_benchmark.py --docs <pdf or dir> --bedrock-max-concurrency 8 --baseline run.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_DIR = os.path.join(REPO_ROOT, 'lib', 'docker')
+INDEXER_DIR = os.path.join(REPO_ROOT, 'lambda', 'indexer')
+sys.path[:0] = [SHARED_DIR, INDEXER_DIR]
+
+# The modules build their clients at import; point them at dummy endpoints, the stand-ins replace them.
+os.environ.setdefault('opensearch_host', 'localhost')
+os.environ.setdefault('vector_index_name', 'rag-vector-index')
+os.environ.setdefault('vector_field_name', 'vector_field')
+os.environ.setdefault('sqs_queue_url', 'https://sqs.us-east-1.amazonaws.com/000000000000/benchmark')
+os.environ.setdefault('dead_letter_queue_url', 'https://sqs.us-east-1.amazonaws.com/000000000000/benchmark-dlq')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('tracing_exporter', 'memory')
+
+import cold_start  # noqa: E402
+import docs_to_openSearch  # noqa: E402
+import index as indexer  # noqa: E402
+import index_profiles  # noqa: E402
+import query_against_openSearch as query_module  # noqa: E402
+from answer_cache import AnswerCache  # noqa: E402
+from chunking import chunk_files  # noqa: E402
+from ingest_pipeline import list_pdfs  # noqa: E402
+from local_standins import FakeBedrockRuntime, FakeSqs  # noqa: E402
+from tracing import MemoryExporter, percentile  # noqa: E402
+from vector_store import LocalVectorStore  # noqa: E402
+
+QUERY_SET = os.path.join(REPO_ROOT, 'benchmarks', 'mla_c01_queries.json')
+
+COLD_START_PROBE = """
+import json, sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+{init}
+initialized = time.perf_counter()
+print(json.dumps({{'import_s': imported - start, 'init_s': initialized - imported}}))
+"""
+COLD_START_TARGETS = {
+    'indexer': ([INDEXER_DIR, SHARED_DIR], 'index',
+                "import rag_clients\nrag_clients.get_bedrock_client()\nrag_clients.get_opensearch_client('localhost')"),
+    # the query module creates its clients at import
+    'query': ([SHARED_DIR], 'query_against_openSearch', 'pass'),
+}
+
+# Headline metrics compared with --baseline: path in the results, and whether a higher value is better
+HEADLINE_METRICS = {
+    ('ingest', 'chunks_per_s'): True,
+    ('query', 'p50_s'): False,
+    ('query', 'p99_s'): False,
+    ('memory', 'peak_rss_mb'): False,
+    ('cold_start', 'indexer', 'total_s', 'median'): False,
+    ('cold_start', 'query', 'total_s', 'median'): False,
+}
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+class LambdaContext:
+    """
+    The part of the Lambda context the indexer uses, for an invocation with timeout seconds to run.
+    """
+
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def load_container(name, bedrock, store, sqs, exporter):
+    """
+    A fresh copy of the indexer module, for one poller: every poller plays a Lambda container of its own, with its
+    own embedding cache and the embedding concurrency limit it learned from the throttling of its own invocations.
+    """
+    spec = importlib.util.spec_from_file_location(name, os.path.join(INDEXER_DIR, 'index.py'))
+    container = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(container)
+    # the stand-ins in place of its clients
+    container.rag_clients = types.SimpleNamespace(get_bedrock_client=lambda **kwargs: bedrock,
+                                                  get_opensearch_client=lambda *args, **kwargs: store,
+                                                  get_sqs_client=lambda **kwargs: sqs)
+    container.tracer.exporter = exporter
+    return container
+
+
+class QueueDrainer:
+    """
+    Plays the SQS event source mapping: pollers receive batches of records, invoke the handler with them and
+    delete the records that succeeded. The failed ones stay in flight until their visibility timeout, which the
+    handler sets, runs out.
+    """
+
+    def __init__(self, sqs, queue_url, batch_size, timeout):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.queue_arn = 'arn:aws:sqs:{}:{}:{}'.format(*re.match(r'https://sqs\.([^.]+)\.[^/]+/([^/]+)/(.+)',
+                                                                   queue_url).groups())
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.producing = threading.Event()
+        self.producing.set()
+        self.invocations = 0
+        self.redelivered = 0
+        self._lock = threading.Lock()
+
+    def idle(self):
+        return not self.producing.is_set() and not self.sqs.in_flight and not self.sqs.approximate_count(self.queue_url)
+
+    def poll(self, handler):
+        while True:
+            messages = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                                MaxNumberOfMessages=self.batch_size).get('Messages', [])
+            if not messages:
+                if self.idle():
+                    return
+                time.sleep(0.005)
+                continue
+            event = {'Records': [{'messageId': message['MessageId'], 'receiptHandle': message['ReceiptHandle'],
+                                  'body': message['Body'], 'attributes': message['Attributes'],
+                                  'eventSourceARN': self.queue_arn}
+                                 for message in messages]}
+            response = handler(event, LambdaContext(self.timeout))
+            failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {'Id': str(position), 'ReceiptHandle': message['ReceiptHandle']}
+                for position, message in enumerate(messages) if message['MessageId'] not in failed])
+            with self._lock:
+                self.invocations += 1
+                self.redelivered += len(failed)
+
+
+def run_ingest(args, files, bedrock, store, sqs):
+    queue_url = os.environ['sqs_queue_url']
+    exporter = MemoryExporter()
+    containers = [load_container(f'indexer_{n}', bedrock, store, sqs, exporter) for n in range(args.lambda_concurrency)]
+    # the ingest script gets the SQS stand-in in place of its client
+    docs_to_openSearch.sqs = sqs
+    docs_to_openSearch.queue_url = queue_url
+    drainer = QueueDrainer(sqs, queue_url, args.sqs_batch_size, args.lambda_timeout_s)
+
+    stats = []
+    started = time.perf_counter()
+    # the handler and the ingest script print per batch and per file, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()), \
+            ThreadPoolExecutor(max_workers=args.lambda_concurrency) as lambdas, \
+            ProcessPoolExecutor(max_workers=args.workers) as pool:
+        pollers = [lambdas.submit(drainer.poll, container.handler) for container in containers]
+        try:
+            page_stats = {}
+            for path, chunks in chunk_files(pool, files, args.pages_per_task, stats=page_stats):
+                stats.append(docs_to_openSearch.ingest_file(path, chunks, page_stats=page_stats))
+            enqueued = time.perf_counter() - started
+        finally:
+            drainer.producing.clear()
+        for poller in pollers:
+            poller.result()
+    elapsed = time.perf_counter() - started
+
+    indexed = store.count(index=os.environ['vector_index_name'])['count']
+    dead_letter_url = os.environ['dead_letter_queue_url']
+    return {
+        'files': len(files),
+        'pages': sum(file_stats['pages'] for file_stats in stats),
+        'chunks': sum(file_stats['chunks'] for file_stats in stats),
+        'indexed': indexed,
+        'elapsed_s': round(elapsed, 3),
+        'enqueue_s': round(enqueued, 3),
+        'chunks_per_s': round(indexed / elapsed, 2),
+        'lambda_invocations': drainer.invocations,
+        'redelivered': drainer.redelivered,
+        # redriven after too many receives, or sent there by the handler as poison messages
+        'dead_letters': len(sqs.dead_letters.get(queue_url, [])) + sqs.approximate_count(dead_letter_url),
+        'embed_concurrency_limits': [round(container.embed_limiter.limit, 1) for container in containers],
+        'bedrock_throttled': bedrock.throttled,
+        'bulk_throttled': store.throttled,
+        'stages': exporter.summary(),
+    }
+
+
+def load_questions(count):
+    with open(QUERY_SET) as f:
+        questions = [query['question'] for query in json.load(f)]
+    # every question is unique, so the answer and embedding caches don't hide the downstream latency
+    return [f"{questions[n % len(questions)]} ({n})" for n in range(count)]
+
+
+def run_queries(args, bedrock, store):
+    query_module.bedrock = bedrock
+    query_module.client = store
+    query_module.answer_cache = AnswerCache()
+    query_module.tracer.exporter = MemoryExporter()
+
+    def timed(question):
+        started = time.perf_counter()
+        query_module.answer_query(question)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    # answer_query prints every prompt
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=args.query_concurrency) as threads:
+        latencies = list(threads.map(timed, load_questions(args.queries)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(latencies),
+        'p50_s': round(percentile(latencies, 0.50), 4),
+        'p95_s': round(percentile(latencies, 0.95), 4),
+        'p99_s': round(percentile(latencies, 0.99), 4),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'stages': query_module.tracer.exporter.summary(),
+    }
+
+
+def run_cold_starts(runs):
+    results = {}
+    for name, (paths, module, init) in COLD_START_TARGETS.items():
+        code = COLD_START_PROBE.format(paths=paths, module=module, init=init)
+        results[name] = cold_start.summarize([cold_start.run_probe(code) for _ in range(runs)])
+    return results
+
+
+def lookup(results, path):
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: {metric: {'baseline', 'current', 'change', 'regressed'}} for the headline metrics both runs have
+    """
+    comparison = {}
+    for path, higher_is_better in HEADLINE_METRICS.items():
+        current, previous = lookup(results, path), lookup(baseline, path)
+        if not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            continue
+        change = (current - previous) / previous
+        comparison['.'.join(path)] = {
+            'baseline': previous,
+            'current': current,
+            'change': round(change, 4),
+            'regressed': change < -tolerance if higher_is_better else change > tolerance,
+        }
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', required=True, help='A PDF or a directory of PDFs to ingest')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes that split the PDFs')
+    parser.add_argument('--pages-per-task', type=int, default=10)
+    parser.add_argument('--sqs-batch-size', type=int, default=10, help='Records per indexer invocation')
+    parser.add_argument('--lambda-concurrency', type=int, default=4, help='Indexer invocations in flight')
+    parser.add_argument('--max-receive-count', type=int, default=5, help='Receives before a record is dead-lettered')
+    parser.add_argument('--visibility-timeout-s', type=float, default=30, help='Visibility timeout of the queue')
+    parser.add_argument('--retry-base-s', type=int, default=1, help='Least delay before a failed record is retried')
+    parser.add_argument('--lambda-timeout-s', type=float, default=120, help='Timeout of an indexer invocation')
+    parser.add_argument('--embed-latency-ms', type=float, default=50)
+    parser.add_argument('--converse-latency-ms', type=float, default=500)
+    parser.add_argument('--opensearch-latency-ms', type=float, default=20, help='Per bulk, search and msearch call')
+    parser.add_argument('--sqs-latency-ms', type=float, default=5)
+    parser.add_argument('--bedrock-max-concurrency', type=int, help='Embedding calls in flight before Bedrock throttles')
+    parser.add_argument('--bedrock-throttle-rate', type=float, default=0.0, help='Fraction of embedding calls throttled')
+    parser.add_argument('--bulk-throttle-rate', type=float, default=0.0, help='Fraction of bulk items rejected with 429')
+    parser.add_argument('--profile', default='balanced', choices=list(index_profiles.PROFILES))
+    parser.add_argument('--queries', type=int, default=64)
+    parser.add_argument('--query-concurrency', type=int, default=4)
+    parser.add_argument('--cold-start-runs', type=int, default=3, help='0 skips the cold start measurement')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', help='Results JSON of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Relative change that counts as a regression')
+    args = parser.parse_args()
+
+    store = LocalVectorStore(latency=args.opensearch_latency_ms / 1000, throttle_rate=args.bulk_throttle_rate)
+    index_profiles.build_index(store, os.environ['vector_index_name'], args.profile, indexer.embedder,
+                               os.environ['vector_field_name'])
+    # queries get a Bedrock of their own, the throttling settings are about the indexer's embedding load
+    ingest_bedrock = FakeBedrockRuntime(latency=args.embed_latency_ms / 1000,
+                                        max_concurrency=args.bedrock_max_concurrency,
+                                        throttle_rate=args.bedrock_throttle_rate)
+    query_bedrock = FakeBedrockRuntime(latency=args.embed_latency_ms / 1000,
+                                       converse_latency=args.converse_latency_ms / 1000)
+    sqs = FakeSqs(latency=args.sqs_latency_ms / 1000, max_receive_count=args.max_receive_count,
+                  visibility_timeout=args.visibility_timeout_s)
+    os.environ['retry_base_seconds'] = str(args.retry_base_s)
+
+    results = {'config': vars(args)}
+    results['ingest'] = run_ingest(args, list_pdfs(args.docs), ingest_bedrock, store, sqs)
+    ingest_rss = peak_rss_mb()
+    print(f"ingest: {results['ingest']['indexed']} chunks in {results['ingest']['elapsed_s']}s, "
+          f"{results['ingest']['chunks_per_s']} chunks/s, {results['ingest']['redelivered']} redelivered, "
+          f"{results['ingest']['bedrock_throttled']} embedding calls throttled")
+    results['query'] = run_queries(args, query_bedrock, store)
+    print(f"query: p50 {results['query']['p50_s']}s p99 {results['query']['p99_s']}s "
+          f"{results['query']['throughput_rps']} req/s")
+    results['memory'] = {'peak_rss_mb': peak_rss_mb(), 'ingest_peak_rss_mb': ingest_rss,
+                         'workers_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    print(f"memory: peak {results['memory']['peak_rss_mb']}MB, workers {results['memory']['workers_peak_rss_mb']}MB")
+    if args.cold_start_runs:
+        results['cold_start'] = run_cold_starts(args.cold_start_runs)
+        print('cold start: ' + ', '.join(f"{name} {timings['total_s']['median']:.3f}s"
+                                         for name, timings in results['cold_start'].items()))
+
+    regressed = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['comparison'] = compare(results, json.load(f), args.tolerance)
+        regressed = [metric for metric, change in results['comparison'].items() if change['regressed']]
+        for metric, change in results['comparison'].items():
+            print(f"{metric}: {change['baseline']} -> {change['current']} ({change['change']:+.1%})"
+                  f"{'  REGRESSION' if change['regressed'] else ''}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
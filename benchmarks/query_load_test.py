@@ -0,0 +1,144 @@
+"""
+Load test for the query path against the local Bedrock and OpenSearch stand-ins.
+
+Simulates `concurrency` users that each ask questions back to back, and reports the p50/p95/p99 latency and
+the throughput per concurrency level, with the p50/p95/p99 of every stage (embed, search, prompt, converse) from
+the query spans, to tell which stage a latency regression comes from. The "async" engine is the AsyncQueryService behind the Streamlit app,
+the "sync" engine calls query_against_openSearch.answer_query from one thread per user.
+
+Usage:
+    python benchmarks/query_load_test.py --concurrency 1 4 16 64 --requests 128 --converse-latency-ms 2000
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lib', 'docker'))
+
+# The query module builds its clients at import; point them at a dummy endpoint, the stand-ins replace them.
+os.environ.setdefault('opensearch_host', 'localhost')
+os.environ.setdefault('vector_index_name', 'rag-vector-index')
+os.environ.setdefault('vector_field_name', 'vector_field')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('tracing_exporter', 'memory')
+
+import query_against_openSearch as query_module  # noqa: E402
+from answer_cache import AnswerCache  # noqa: E402
+from async_query import AsyncQueryService  # noqa: E402
+from local_standins import FakeBedrockRuntime, FakeOpenSearch, fake_embedding  # noqa: E402
+from tracing import MemoryExporter, percentile  # noqa: E402
+
+TOPICS = ['model monitoring', 'feature store', 'data drift', 'bias detection', 'cost optimization', 'endpoints',
+          'hyperparameter tuning', 'security', 'reliability', 'batch inference', 'data labeling', 'pipelines']
+
+
+def summarize(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'p50_s': round(percentile(latencies, 0.50), 4),
+        'p95_s': round(percentile(latencies, 0.95), 4),
+        'p99_s': round(percentile(latencies, 0.99), 4),
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+    }
+
+
+def questions(count):
+    # every question is unique, so the answer and embedding caches don't hide the downstream latency
+    return [f"{TOPICS[n % len(TOPICS)]} question {n}" for n in range(count)]
+
+
+def build_standins(args, documents=200):
+    bedrock = FakeBedrockRuntime(latency=args.embed_latency_ms / 1000, converse_latency=args.converse_latency_ms / 1000)
+    search_client = FakeOpenSearch(latency=args.search_latency_ms / 1000)
+    for n in range(documents):
+        text = f"{TOPICS[n % len(TOPICS)]} guidance paragraph {n}"
+        search_client.index(os.environ['vector_index_name'], {'vector_field': fake_embedding(text), 'text': text},
+                            id=str(n))
+    return bedrock, search_client
+
+
+def run_sync(args, concurrency, bedrock, search_client):
+    query_module.bedrock = bedrock
+    query_module.client = search_client
+    query_module.answer_cache = AnswerCache()
+
+    def timed(question):
+        started = time.perf_counter()
+        query_module.answer_query(question)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    # answer_query prints every prompt, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed, questions(args.requests)))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_async(args, concurrency, bedrock, search_client):
+    service = AsyncQueryService(bedrock, search_client, os.environ['vector_index_name'],
+                                bedrock_concurrency=args.bedrock_concurrency,
+                                search_concurrency=args.search_concurrency, answer_cache=AnswerCache())
+
+    async def user(queue, latencies):
+        while not queue.empty():
+            question = queue.get_nowait()
+            started = time.perf_counter()
+            await service.answer(question)
+            latencies.append(time.perf_counter() - started)
+
+    async def main():
+        queue = asyncio.Queue()
+        for question in questions(args.requests):
+            queue.put_nowait(question)
+        latencies = []
+        started = time.perf_counter()
+        await asyncio.gather(*(user(queue, latencies) for _ in range(concurrency)))
+        return summarize(latencies, time.perf_counter() - started)
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--engines', nargs='+', default=['async', 'sync'], choices=['async', 'sync'])
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16, 64])
+    parser.add_argument('--requests', type=int, default=128)
+    parser.add_argument('--embed-latency-ms', type=float, default=50)
+    parser.add_argument('--search-latency-ms', type=float, default=20)
+    parser.add_argument('--converse-latency-ms', type=float, default=500)
+    parser.add_argument('--bedrock-concurrency', type=int, default=16)
+    parser.add_argument('--search-concurrency', type=int, default=32)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {'config': vars(args), 'engines': {}}
+    for engine in args.engines:
+        results['engines'][engine] = {}
+        for concurrency in args.concurrency:
+            bedrock, search_client = build_standins(args)
+            run = run_async if engine == 'async' else run_sync
+            query_module.tracer.exporter = MemoryExporter()
+            summary = run(args, concurrency, bedrock, search_client)
+            summary['stages'] = query_module.tracer.exporter.summary()
+            results['engines'][engine][str(concurrency)] = summary
+            print(f"{engine} concurrency={concurrency}: p50 {summary['p50_s']}s p95 {summary['p95_s']}s "
+                  f"p99 {summary['p99_s']}s {summary['throughput_rps']} req/s")
+            print('    ' + ', '.join(f"{stage} p95 {stats['p95_ms']}ms" for stage, stats in summary['stages'].items()))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -41,6 +41,8 @@ const props = {
     OpenSearchEndpoint: openSearchStack.OpenSearchEndpoint,
     VectorIndexName: openSearchStack.VectorIndexName,
     VectorFieldName: openSearchStack.VectorFieldName,
+    EmbeddingModelId: openSearchStack.EmbeddingModelId,
+    EmbeddingDimensions: openSearchStack.EmbeddingDimensions,
     bedrockPolicy: openSearchStack.bedrockPolicy,
     openSearchPolicy: openSearchStack.openSearchPolicy,
     sqs_queue_url: openSearchStack.sqs_queue_url,
@@ -1,15 +1,9 @@
 import os
 import json
 import logging
-import sys
-from pip._internal import main
-
-main(['install', '-I', '-q','boto3','requests','opensearch-py==2.4.2', 'urllib3','--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
-
-import boto3
-import requests
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+import rag_clients
+import index_profiles
+import embedders
 from botocore.exceptions import NoCredentialsError
 
 logger = logging.getLogger()
@@ -18,20 +12,8 @@ logger.setLevel(logging.INFO)
 def get_opensearch_client(endpoint):
     service = "aoss" if "aoss" in endpoint else "es"
     logger.debug(f"Connecting to OpenSearch service: {service} at {endpoint}")
-    return OpenSearch(
-        hosts=[
-            {
-                "host": endpoint,
-                "port": 443,
-            }
-        ],
-        http_auth=AWSV4SignerAuth(
-            boto3.Session().get_credentials(), os.getenv("AWS_REGION"), service
-        ),
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection,
-        pool_maxsize=10,
+    return rag_clients.get_opensearch_client(
+        endpoint, region=os.getenv("AWS_REGION"), service=service, pool_maxsize=10, verify_certs=True
     )
 
 def handler(event, context):
@@ -45,44 +27,29 @@ def handler(event, context):
     print(opensearch_endpoint)
     opensearch_client = get_opensearch_client(opensearch_endpoint)
 
-    try:
-        if event['RequestType'] == 'Create' :
-
-            params = {
-                'index': index_name,
-                'body': {
-                    'settings': {
-                        'index': {
-                            'knn': True,
-                        }
-                    },
-                    'mappings': {
-                        'properties': {
-                            'text': {'type': 'text'},
-                            'vector_field': {
-                                'type': 'knn_vector',
-                                'dimension': 1536,
-                                'method': {
-                                    'engine': 'nmslib',
-                                     'name': 'hnsw',
-
-                                }
-                            }
-                        }
-                    }
-                }
-            }
+    # The index is built from an index profile (engine, HNSW parameters, quantization) and the embedder's output
+    # dimension. IndexName is an alias to a versioned index, so an Update with a new profile or embedder builds
+    # a new index next to the live one. The alias is only moved while the live index is empty: otherwise searches
+    # would find nothing until the new index is backfilled, which lib/docker/reindex.py does before switching it.
+    profile = event.get('IndexProfile')
+    vector_field = event.get('VectorFieldName', 'vector_field')
 
+    try:
+        if event['RequestType'] in ('Create', 'Update'):
             try:
-                opensearch_client.indices.create(index=params['index'], body=params['body'])
+                embedder = embedders.build_embedder(event.get('EmbeddingModelId'), event.get('EmbeddingDimensions'))
+                index_profiles.build_index(opensearch_client, index_name, profile, embedder, vector_field)
             except Exception as e:
                 logger.error(e)
 
         elif event['RequestType'] == 'Delete':
             try:
-                opensearch_client.indices.delete(index=index_name)
+                # the alias' current index, the ones it was swapped away from, and an index from before aliases
+                indices = opensearch_client.indices.get(index=f"{index_name},{index_name}-*", ignore_unavailable=True)
+                for name in sorted(indices):
+                    opensearch_client.indices.delete(index=name)
             except Exception as e:
                 logger.error(e)
 
     except NoCredentialsError:
-        logger.error('Credentials not available.')
\ No newline at end of file
+        logger.error('Credentials not available.')
@@ -1,57 +1,114 @@
-import boto3
 import json
 import os
-import sys
-from pip._internal import main
+import rag_clients
+from opensearch_bulk import BulkItem, bulk_index, DEFAULT_MAX_DOCS, DEFAULT_MAX_BYTES
+from embedding_executor import AimdLimiter, EmbeddingExecutor, DEFAULT_CONCURRENCY
+from embedding_cache import build_cache_from_env
+from embedders import build_embedder_from_env, document_embed_fn
+from indexing import embed_items
+from sqs_consumer import (Deadline, PoisonMessage, is_retryable, queue_url_from_arn, release_for_retry,
+                          send_to_dead_letter, DEFAULT_RETRY_BASE_SECONDS, DEFAULT_RETRY_MAX_SECONDS)
+from tracing import build_tracer_from_env
 
-main(['install', '-I', '-q','boto3','requests','opensearch-py==2.4.2', 'urllib3','--target', '/tmp/', '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0,'/tmp/')
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+# Lives as long as the container, so re-ingested chunks are not embedded again on warm invocations
+embedding_cache = build_cache_from_env()
+# The embedding model and its output options, the same as the query side and the index mapping use
+embedder = build_embedder_from_env()
+# Per-batch EMF log line with the embed and bulk timings, CloudWatch turns it into metrics, see tracing.py
+tracer = build_tracer_from_env('rag-indexer')
+embed_concurrency = int(os.getenv('embed_concurrency', DEFAULT_CONCURRENCY))
+# The embedding concurrency Bedrock currently allows, learned from its throttling. It lives as long as the container
+# too, so a warm invocation starts where the last one left off instead of throttling its way down from the maximum
+embed_limiter = AimdLimiter(embed_concurrency)
+bulk_max_docs = int(os.getenv('bulk_max_docs', DEFAULT_MAX_DOCS))
+# The documents per _bulk request OpenSearch currently accepts, learned from its 429s the same way: the batches of a
+# throttled collection shrink, and grow back while it keeps up
+bulk_limiter = AimdLimiter(bulk_max_docs)
 
 def handler(event, context):
-    # Initialize clients
-    bedrock = boto3.client('bedrock-runtime', 'us-east-1', endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com')
-    credentials = boto3.Session().get_credentials()
-    region = 'us-east-1'
-    service = 'aoss'
-    host = os.getenv('opensearch_host')
-    auth = AWSV4SignerAuth(credentials, region, service)
-    client = OpenSearch(
-        hosts=[{'host': host, 'port': 443}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
-        connection_class=RequestsHttpConnection,
-        pool_maxsize=50
-    )
-
-    def get_embedding(body):
-        modelId = 'amazon.titan-embed-text-v1'
-        accept = 'application/json'
-        contentType = 'application/json'
-        response = bedrock.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
-        response_body = json.loads(response.get('body').read())
-        embedding = response_body.get('embedding')
-        return embedding
-
-    def indexDoc(client, vectors, text):
-        indexDocument = {
-            os.getenv("vector_field_name"): vectors,
-            'text': text
-        }
-        response = client.index(
-            index=os.getenv("vector_index_name"),
-            body=indexDocument,
-            refresh=False
-        )
-        return response
+    with tracer.span('index_batch', records=len(event['Records'])) as batch:
+        return index_records(event, batch, context)
+
 
-    # Process each SQS message
+def index_records(event, batch, context=None):
+    # Clients are created on the first invocation and reused by the container afterwards,
+    # with enough pooled connections for the concurrent embedding calls
+    bedrock = rag_clients.get_bedrock_client(max_pool_connections=embed_concurrency)
+    client = rag_clients.get_opensearch_client(os.getenv('opensearch_host'))
+    sqs = rag_clients.get_sqs_client()
+    records_by_id = {record['messageId']: record for record in event['Records']}
+    source_arn = next(iter(event['Records']), {}).get('eventSourceARN')
+    queue_url = queue_url_from_arn(source_arn) if source_arn else None
+    # Work that would run into the function timeout is not started, its records are returned to the queue instead
+    deadline = Deadline(context, margin=float(os.getenv('deadline_margin_seconds', 5)))
+
+    # Embed every SQS message in the batch concurrently, then write them all with as few _bulk requests as possible.
+    # Messages carry a deterministic document id, so redelivered or re-ingested chunks overwrite instead of duplicating.
+    errors = {}
+    records = []
+    items = []
     for record in event['Records']:
-        message = json.loads(record['body'])
-        exampleContent = message['content']
-        exampleInput = json.dumps({"inputText": exampleContent})
-        exampleVectors = get_embedding(exampleInput)
-        response = indexDoc(client, exampleVectors, exampleContent)
-        print(f"Indexed document: {response}")
+        try:
+            message = json.loads(record['body'])
+            if message.get('action') == 'delete':
+                items.append(BulkItem(record['messageId'], doc_id=message['id'], op_type='delete'))
+            else:
+                # the source file, page and section the chunk came from are stored with it, for filtered searches
+                records.append((record['messageId'], message['content'], message.get('id'), message))
+        except Exception as e:
+            print(f"Failed to parse message {record['messageId']}: {e}")
+            errors[record['messageId']] = PoisonMessage(f'unparseable message: {e}')
+
+    # every embedding call is timed, that is one span per record for the models that embed one text per call
+    executor = EmbeddingExecutor(tracer.timed('embed', document_embed_fn(embedder, bedrock, embedding_cache), batch),
+                                 concurrency=embed_concurrency, limiter=embed_limiter, deadline=deadline.at)
+    throttled = embed_limiter.throttled
+    embedded, embed_failures = embed_items(executor, records, batch_size=embedder.batch_size)
+    for message_id, error in embed_failures:
+        print(f"Failed to embed message {message_id}: {error}")
+        errors[message_id] = error
+    items.extend(embedded)
+    throttled = embed_limiter.throttled - throttled
+    print(f"Embedded {len(embedded)} messages, {throttled} calls throttled, "
+          f"concurrency limit {embed_limiter.limit:.1f}, cache: {embedding_cache.stats()}")
+
+    bulk_throttled = bulk_limiter.throttled
+    with tracer.span('bulk', documents=len(items)):
+        result = bulk_index(
+            client,
+            os.getenv("vector_index_name"),
+            items,
+            max_docs=bulk_max_docs,
+            max_bytes=int(os.getenv('bulk_max_bytes', DEFAULT_MAX_BYTES)),
+            limiter=bulk_limiter,
+        )
+    bulk_throttled = bulk_limiter.throttled - bulk_throttled
+    for message_id, error in result['failed']:
+        print(f"Failed to index message {message_id}: {error}")
+        errors[message_id] = error
+
+    # Poison messages go to the dead-letter queue and are done with. The others are returned to the queue, hidden
+    # for a backoff delay that grows with their receive count so they don't hit a throttled Bedrock or OpenSearch
+    # again right away; the queue's redrive policy dead-letters them after its maxReceiveCount.
+    poison = [records_by_id[message_id] for message_id, error in errors.items() if not is_retryable(error)]
+    failures = [message_id for message_id, error in errors.items() if is_retryable(error)]
+    dead_letter_url = os.getenv('dead_letter_queue_url')
+    if poison and dead_letter_url:
+        failures.extend(send_to_dead_letter(sqs, dead_letter_url, poison, errors))
+    else:
+        failures.extend(record['messageId'] for record in poison)
+    if failures and queue_url:
+        release_for_retry(sqs, queue_url, [records_by_id[message_id] for message_id in failures],
+                          base=int(os.getenv('retry_base_seconds', DEFAULT_RETRY_BASE_SECONDS)),
+                          maximum=int(os.getenv('retry_max_seconds', DEFAULT_RETRY_MAX_SECONDS)))
+    dead_lettered = len(errors) - len(failures)
+    print(f"Indexed {result['succeeded']} documents, {len(failures)} returned to the queue, "
+          f"{dead_lettered} sent to the dead-letter queue, {bulk_throttled} bulk requests throttled, "
+          f"bulk limit {bulk_limiter.limit:.1f} documents")
+    batch.set(embedded=len(embedded), indexed=result['succeeded'], failed=len(failures), dead_lettered=dead_lettered,
+              throttled=throttled, bulk_throttled=bulk_throttled, embed_concurrency_limit=round(embed_limiter.limit, 1),
+              bulk_docs_limit=round(bulk_limiter.limit, 1),
+              embedding_cache_hit_rate=embedding_cache.stats()['hit_rate'])
+
+    # Only the failed messages are returned to the queue, see ReportBatchItemFailures
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
@@ -0,0 +1,151 @@
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_SIZE = 256
+DEFAULT_TTL_SECONDS = 3600
+DEFAULT_VERSION_CHECK_SECONDS = 60
+
+
+def normalize_question(question):
+    """
+    Exact-match key for a question: case, whitespace and trailing punctuation don't change the answer.
+    """
+    return re.sub(r'\s+', ' ', question).strip().rstrip('?!. ').lower()
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class AnswerCache:
+    """
+    Caches generated answers by normalized question text, and optionally serves a cached answer for a new
+    question whose embedding is within similarity_threshold (cosine) of a cached question's embedding.
+    Entries expire after ttl_seconds, the least recently used entry is evicted beyond max_entries, and the
+    whole cache is dropped when the index version it was filled against changes.
+    """
+
+    def __init__(self, max_entries=DEFAULT_SIZE, ttl_seconds=DEFAULT_TTL_SECONDS, similarity_threshold=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.index_version = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _live(self, key, entry, now):
+        if now - entry['created'] > self.ttl_seconds:
+            del self._entries[key]
+            return False
+        return True
+
+    def get(self, question):
+        """
+        :return: The cached answer for the exact (normalized) question, or None
+        """
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._live(key, entry, now):
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry['answer']
+        return None
+
+    def get_similar(self, embedding):
+        """
+        :return: The cached answer of the most similar question above the threshold, or None
+        """
+        if self.similarity_threshold is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        best_key, best_score = None, self.similarity_threshold
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if not self._live(key, entry, now):
+                    continue
+                score = cosine_similarity(embedding, entry['embedding'])
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.semantic_hits += 1
+            return self._entries[best_key]['answer']
+
+    def put(self, question, embedding, answer):
+        key = normalize_question(question)
+        with self._lock:
+            self._entries[key] = {'answer': answer, 'embedding': embedding, 'created': time.time()}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def check_index_version(self, version):
+        """
+        Drops every entry when the index has changed since the cached answers were generated.
+        """
+        with self._lock:
+            if self.index_version is not None and version != self.index_version:
+                self._entries.clear()
+            self.index_version = version
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+        }
+
+
+class IndexVersionTracker:
+    """
+    Polls a cheap index version (for example the document count) at most once per interval.
+    """
+
+    def __init__(self, fetch_version, interval=DEFAULT_VERSION_CHECK_SECONDS):
+        self.fetch_version = fetch_version
+        self.interval = interval
+        self._version = None
+        self._checked = 0.0
+
+    def current(self):
+        now = time.time()
+        if self._version is None or now - self._checked >= self.interval:
+            try:
+                self._version = self.fetch_version()
+            except Exception as e:
+                print(f"Could not read the index version: {e}")
+            self._checked = now
+        return self._version
+
+
+def build_answer_cache_from_env():
+    """
+    Builds the answer cache configured by the environment: answer_cache_size, answer_cache_ttl and
+    answer_cache_similarity (a cosine threshold such as 0.97, semantic hits are off when it is not set).
+    """
+    threshold = os.getenv('answer_cache_similarity')
+    return AnswerCache(
+        max_entries=int(os.getenv('answer_cache_size', DEFAULT_SIZE)),
+        ttl_seconds=float(os.getenv('answer_cache_ttl', DEFAULT_TTL_SECONDS)),
+        similarity_threshold=float(threshold) if threshold else None,
+    )
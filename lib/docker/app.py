@@ -1,12 +1,39 @@
+import time
+import uuid
 import streamlit as st
-from query_against_openSearch import answer_query
+# answer_query runs on the shared async query engine, so many sessions can be served by one container
+from async_query import answer_query
+from conversation_memory import conversation_id
+# the spans of a question end with the time it takes to render its answer, see tracing.py
+from query_against_openSearch import tracer
 
 # Header/Title of streamlit app
 st.title(f""":blue[RAG with Amazon OpenSearch Serverless Vector Search : MLA-C01 Certification Preparation]""")
 
+
+def cognito_user():
+    """
+    The Cognito user signed in through the load balancer, which passes its id in the x-amzn-oidc-identity header.
+    """
+    context = getattr(st, 'context', None)
+    if context is not None:
+        # st.context.headers is case-insensitive, Streamlit 1.37 and later
+        return context.headers.get('X-Amzn-Oidc-Identity')
+    try:
+        # older Streamlit versions only expose the headers through this internal function
+        from streamlit.web.server.websocket_headers import _get_websocket_headers
+        headers = _get_websocket_headers() or {}
+    except Exception:
+        headers = {}
+    return headers.get('X-Amzn-Oidc-Identity')
+
+
 # configuring values for session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+# the model sees the earlier questions and answers of this user's session, see conversation_memory.py
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = conversation_id(cognito_user(), uuid.uuid4().hex)
 # writing the message that is stored in session state
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -27,12 +54,36 @@ if question := st.chat_input("Simply ask me about any TOPIC from MLA-C01 Certifi
         message_placeholder = st.empty()
         # putting a spinning icon to show that the query is in progress
         with st.status("Generating the MCQ Question Set!", expanded=False) as status:
-            # passing the question into the LLM with the Conversation API to generate an answer and preserve Context
-            answer = answer_query(question)
-            # writing the answer to the front end
-            message_placeholder.markdown(f"{answer}")
+            # passing the question into the LLM with the Conversation API, streaming the answer as it is generated
+            stats = {}
+            answer = ""
+            started = time.perf_counter()
+            time_to_first_token = None
+            with tracer.span('request'):
+                chunks = answer_query(question, stream=True, stats=stats,
+                                      conversation_id=st.session_state.conversation_id)
+                # rendering overlaps the stream, so the time spent drawing is recorded apart from the waiting
+                with tracer.span('render') as render:
+                    drawing = 0.0
+                    for text in chunks:
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - started
+                        answer += text
+                        # writing the answer so far to the front end, with a cursor while tokens are still arriving
+                        drawn = time.perf_counter()
+                        message_placeholder.markdown(f"{answer}▌")
+                        drawing += time.perf_counter() - drawn
+                    message_placeholder.markdown(f"{answer}")
+                    render.set(drawing_ms=round(drawing * 1000, 3), time_to_first_token_ms=round((time_to_first_token or 0) * 1000, 3))
+            # recording the perceived latency: time to first token and generation speed
+            total_time = time.perf_counter() - started
+            output_tokens = stats.get('usage', {}).get('outputTokens')
+            generation_time = total_time - (time_to_first_token or 0)
+            tokens_per_second = output_tokens / generation_time if output_tokens and generation_time > 0 else None
+            print(f"timeToFirstTokenS: {time_to_first_token}, totalS: {total_time}, tokensPerSecond: {tokens_per_second}")
             # showing a completion message to the front end
-            status.update(label="MCQ Generated...", state="complete", expanded=False)
+            status.update(label=f"MCQ Generated in {total_time:.1f}s (first token after {time_to_first_token or 0:.1f}s)...",
+                          state="complete", expanded=False)
     # appending the results to the session state
     st.session_state.messages.append({"role": "assistant",
                                       "content": answer})
\ No newline at end of file
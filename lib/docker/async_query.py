@@ -0,0 +1,307 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import query_against_openSearch as query_module
+import rag_clients
+from conversation_memory import is_follow_up_question, prompt_with_summary
+from retrieval import msearch_body
+
+DEFAULT_BEDROCK_CONCURRENCY = 16
+DEFAULT_SEARCH_CONCURRENCY = 32
+
+
+def get_async_opensearch_client(host, region='us-east-1', service='aoss', pool_maxsize=20):
+    """
+    Creates the asyncio OpenSearch client (aiohttp based), signed with the same CLI profile as the sync client.
+    """
+    import boto3
+    from opensearchpy import AsyncOpenSearch, AsyncHttpConnection, AWSV4SignerAsyncAuth
+
+    credentials = boto3.Session(profile_name=os.getenv('profile_name')).get_credentials()
+    return AsyncOpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=AWSV4SignerAsyncAuth(credentials, region, service),
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=AsyncHttpConnection,
+        pool_maxsize=pool_maxsize
+    )
+
+
+def is_async_client(search_client):
+    try:
+        from opensearchpy import AsyncOpenSearch
+    except ImportError:
+        return False
+    return isinstance(search_client, AsyncOpenSearch)
+
+
+class AsyncQueryService:
+    """
+    The embed -> kNN search -> converse chain of answer_query on asyncio. Each downstream has its own semaphore,
+    so one process can have many questions in flight without overloading Bedrock or OpenSearch. boto3 has no
+    asyncio support, so the Bedrock calls run on a thread pool sized to the Bedrock semaphore. The search client
+    can be an AsyncOpenSearch client or a regular (blocking) one.
+    The stages are timed as spans of the query module's tracer. The spans are passed down explicitly: the steps of
+    one question run as different tasks of the loop, so there is no current span to inherit.
+    """
+
+    def __init__(self, bedrock, search_client, index_name, bedrock_concurrency=DEFAULT_BEDROCK_CONCURRENCY,
+                 search_concurrency=DEFAULT_SEARCH_CONCURRENCY, answer_cache=None, embedding_cache=None,
+                 index_version=None, retriever=None, embedder=None, tracer=None, conversations=None):
+        self.bedrock = bedrock
+        self.search_client = search_client
+        self.index_name = index_name
+        self.bedrock_concurrency = bedrock_concurrency
+        self.search_concurrency = search_concurrency
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.index_version = index_version
+        self.retriever = retriever or query_module.retriever
+        self.embedder = embedder or query_module.embedder
+        self.tracer = tracer or query_module.tracer
+        # the conversation memory, see conversation_memory.py; questions asked with a conversation id need it
+        self.conversations = conversations
+        self._executor = ThreadPoolExecutor(max_workers=bedrock_concurrency + search_concurrency,
+                                            thread_name_prefix='async-query')
+        self._bedrock_limit = None
+        self._search_limit = None
+        self._async_search = is_async_client(search_client)
+
+    def _limits(self):
+        # the semaphores are created on first use, so they belong to the loop that runs the service
+        if self._bedrock_limit is None:
+            self._bedrock_limit = asyncio.Semaphore(self.bedrock_concurrency)
+            self._search_limit = asyncio.Semaphore(self.search_concurrency)
+        return self._bedrock_limit, self._search_limit
+
+    async def _run_blocking(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def embed(self, text, parent=None):
+        with self.tracer.start_span('embed', parent) as span:
+            if self.embedding_cache is not None:
+                embedding = self.embedding_cache.get(self.embedder.query_cache_id, text)
+                span.set(cache_hit=embedding is not None)
+                if embedding is not None:
+                    return embedding
+            bedrock_limit, _ = self._limits()
+            async with bedrock_limit:
+                embedding = await self._run_blocking(self.embedder.embed_query, self.bedrock, text)
+        if self.embedding_cache is not None:
+            self.embedding_cache.put(self.embedder.query_cache_id, text, embedding)
+        return embedding
+
+    async def search(self, userQuery, userVectors, parent=None, filters=None):
+        _, search_limit = self._limits()
+        bodies = self.retriever.requests(userQuery, userVectors, filters)
+        with self.tracer.start_span('search', parent, filtered=bool(filters)) as span:
+            async with search_limit:
+                if len(bodies) == 1:
+                    responses = [await self._call_search('search', body=bodies[0], index=self.index_name)]
+                else:
+                    # the kNN and BM25 searches of hybrid retrieval share one msearch round trip
+                    response = await self._call_search('msearch', body=msearch_body(bodies), index=self.index_name)
+                    responses = response['responses']
+            combined = self.retriever.combine(userQuery, responses)
+            span.set(hits=len(combined['hits']['hits']), took_ms=max(response.get('took', 0) for response in responses))
+        return combined
+
+    async def _call_search(self, method, **kwargs):
+        if self._async_search:
+            return await getattr(self.search_client, method)(**kwargs)
+        return await self._run_blocking(getattr(self.search_client, method), **kwargs)
+
+    def _answer_cache(self, filters, history):
+        # the answer cache is keyed by the question alone, so answers from a filtered search, or to a question that
+        # follows earlier turns of a conversation, bypass it
+        return self.answer_cache if not filters and not history else None
+
+    def _conversation(self, conversation_id):
+        return self.conversations.get(conversation_id) if conversation_id else None
+
+    def _add_turn(self, conversation, userQuery, answer):
+        if conversation is not None:
+            self.conversations.add_turn(conversation, userQuery, answer)
+
+    async def _prepare(self, userQuery, request, filters=None, conversation=None):
+        """
+        Runs everything up to the converse call.
+        :param request: The span of the question, the stages are timed under it
+        :param filters: Metadata filters the search is narrowed to, see retrieval.search_filter
+        :param conversation: The conversation whose earlier turns are passed to the model, see conversation_memory.py
+        :return: (cached answer, None, None) on an answer cache hit, otherwise (None, userVectors, messages)
+        """
+        summary, messages = '', []
+        if conversation is not None:
+            # waits for the summary of the conversation's older turns when it is still being generated
+            summary, messages = await self._run_blocking(conversation.history)
+        answer_cache = self._answer_cache(filters, messages)
+        if answer_cache is not None:
+            if self.index_version is not None:
+                answer_cache.check_index_version(await self._run_blocking(self.index_version.current))
+            cachedAnswer = answer_cache.get(userQuery)
+            if cachedAnswer is not None:
+                request.set(answer_cache='exact')
+                return cachedAnswer, None, None
+        # a follow-up on the previous answers reuses the context retrieved for them, rather than embedding and searching
+        context = conversation.reusable_context(userQuery, filters) if messages else None
+        userVectors = None
+        if context is None:
+            userVectors = await self.embed(userQuery, request)
+            if answer_cache is not None:
+                cachedAnswer = answer_cache.get_similar(userVectors)
+                if cachedAnswer is not None:
+                    request.set(answer_cache='semantic')
+                    return cachedAnswer, None, None
+            # a question about the same topic as the last search also reuses its context
+            context = conversation.reusable_context(userQuery, filters, userVectors) if messages else None
+        if context is None:
+            response = await self.search(userQuery, userVectors, request, filters)
+        with self.tracer.start_span('prompt', request, history_messages=len(messages)) as span:
+            if context is None:
+                context = query_module.build_context(response, span)
+                if conversation is not None:
+                    conversation.remember_context(userQuery, userVectors, filters, context)
+            else:
+                span.set(reused_context=True)
+                self.conversations.count_follow_up()
+            if messages and is_follow_up_question(userQuery):
+                prompt_data = query_module.build_follow_up_prompt(userQuery, context)
+            else:
+                prompt_data = query_module.build_prompt(userQuery, context)
+        messages = messages + [{"role": "user", "content": [{"text": prompt_with_summary(summary, prompt_data)}]}]
+        return None, userVectors, messages
+
+    async def answer(self, userQuery, parent=None, filters=None, conversation_id=None):
+        conversation = self._conversation(conversation_id)
+        with self.tracer.start_span('answer_query', parent, stream=False,
+                                    conversation=bool(conversation_id)) as request:
+            cachedAnswer, userVectors, messages = await self._prepare(userQuery, request, filters, conversation)
+            if cachedAnswer is not None:
+                self._add_turn(conversation, userQuery, cachedAnswer)
+                return cachedAnswer
+            bedrock_limit, _ = self._limits()
+            with self.tracer.start_span('converse', request) as span:
+                async with bedrock_limit:
+                    response = await self._run_blocking(query_module.conversation_orchestrator, self.bedrock,
+                                                        query_module.MODEL_ID, query_module.SYSTEM_PROMPTS, messages)
+                span.set(**query_module.converse_attributes(response['usage'], response['metrics']))
+        answer = response['output']['message']['content'][0]['text']
+        if self._answer_cache(filters, messages[:-1]) is not None:
+            self.answer_cache.put(userQuery, userVectors, answer)
+        self._add_turn(conversation, userQuery, answer)
+        return answer
+
+    async def answer_stream(self, userQuery, stats=None, parent=None, filters=None, conversation_id=None):
+        """
+        Async generator over the text of the answer as the model produces it.
+        """
+        conversation = self._conversation(conversation_id)
+        with self.tracer.start_span('answer_query', parent, stream=True,
+                                    conversation=bool(conversation_id)) as request:
+            cachedAnswer, userVectors, messages = await self._prepare(userQuery, request, filters, conversation)
+            if cachedAnswer is not None:
+                self._add_turn(conversation, userQuery, cachedAnswer)
+                yield cachedAnswer
+                return
+            stats = stats if stats is not None else {}
+            answer = ""
+            bedrock_limit, _ = self._limits()
+            # the Bedrock slot is held until the stream is drained, that is when the model is done generating
+            with self.tracer.start_span('converse', request, stream=True) as span:
+                async with bedrock_limit:
+                    response = await self._run_blocking(query_module.conversation_orchestrator_stream, self.bedrock,
+                                                        query_module.MODEL_ID, query_module.SYSTEM_PROMPTS, messages)
+                    events = iter(response['stream'])
+                    while True:
+                        event = await self._run_blocking(next, events, None)
+                        if event is None:
+                            break
+                        if 'contentBlockDelta' in event:
+                            text = event['contentBlockDelta']['delta'].get('text', '')
+                            if not answer:
+                                span.set(first_token_ms=round(span.elapsed_ms(), 3))
+                            answer += text
+                            yield text
+                        elif 'metadata' in event:
+                            stats['usage'] = event['metadata'].get('usage', {})
+                            stats['metrics'] = event['metadata'].get('metrics', {})
+                            span.set(**query_module.converse_attributes(stats['usage'], stats['metrics']))
+        if self._answer_cache(filters, messages[:-1]) is not None:
+            self.answer_cache.put(userQuery, userVectors, answer)
+        self._add_turn(conversation, userQuery, answer)
+
+
+class QueryEngine:
+    """
+    Thin synchronous adapter for Streamlit: runs an AsyncQueryService on one background event loop shared by
+    every session thread, and exposes the same answer_query(question, stream, stats) call as the query module.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='async-query-engine', daemon=True).start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _iterate(self, async_generator):
+        while True:
+            try:
+                yield self.run(async_generator.__anext__())
+            except StopAsyncIteration:
+                return
+
+    def answer_query(self, user_input, stream=False, stats=None, filters=None, conversation_id=None):
+        # the caller's current span (the Streamlit request) is the parent of the question's spans on the loop
+        parent = self.service.tracer.current()
+        if stream:
+            return self._iterate(self.service.answer_stream(user_input, stats, parent, filters, conversation_id))
+        return self.run(self.service.answer(user_input, parent, filters, conversation_id))
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Builds the process-wide engine on first use, sharing the query module's Bedrock client and caches.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            bedrock_concurrency = int(os.getenv('bedrock_concurrency', DEFAULT_BEDROCK_CONCURRENCY))
+            search_concurrency = int(os.getenv('search_concurrency', DEFAULT_SEARCH_CONCURRENCY))
+            if rag_clients.local_backend():
+                # the local vector store is a blocking client, searched from the thread pool
+                search_client = query_module.client
+            else:
+                search_client = get_async_opensearch_client(os.getenv('opensearch_host'), pool_maxsize=search_concurrency)
+            service = AsyncQueryService(
+                query_module.bedrock,
+                search_client,
+                os.getenv('vector_index_name'),
+                bedrock_concurrency=bedrock_concurrency,
+                search_concurrency=search_concurrency,
+                answer_cache=query_module.answer_cache,
+                embedding_cache=query_module.embedding_cache,
+                index_version=query_module.index_version,
+                conversations=query_module.conversations,
+            )
+            _engine = QueryEngine(service)
+        return _engine
+
+
+def answer_query(user_input, stream=False, stats=None, filters=None, conversation_id=None):
+    """
+    Drop-in replacement for query_against_openSearch.answer_query that runs on the shared async engine.
+    """
+    return get_engine().answer_query(user_input, stream=stream, stats=stats, filters=filters,
+                                     conversation_id=conversation_id)
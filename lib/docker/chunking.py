@@ -0,0 +1,256 @@
+"""
+Structure-aware chunking of PDF pages.
+
+The text pypdf extracts is parsed into blocks (headings, list items and paragraphs), and the blocks of a page are
+packed into chunks of up to chunk_tokens tokens. A chunk starts at a heading, so every chunk covers one section;
+list items and paragraphs are kept whole unless a single one is larger than a chunk, in which case it is split at
+sentence boundaries. Chunks never cross a page, so their page number is exact, and each one carries the heading
+of the section it belongs to. No overlap is added between chunks: they end at block boundaries.
+
+Tokens are estimated the way the prompt's context budget counts them (context_builder.estimate_tokens), pass
+count_tokens to size chunks with a model's own tokenizer.
+"""
+import functools
+import itertools
+import os
+import re
+from collections import deque, namedtuple
+
+from context_builder import estimate_tokens
+from ingest_pipeline import build_text_splitter, iter_chunks, iter_page_range, plan_tasks
+
+DEFAULT_CHUNK_TOKENS = 300
+# a page's last chunk below this size is merged into the chunk before it in the same section, rather than being
+# embedded on its own, so a chunk can hold up to DEFAULT_CHUNK_TOKENS + DEFAULT_MIN_TOKENS tokens
+DEFAULT_MIN_TOKENS = 60
+MAX_HEADING_CHARS = 80
+MAX_HEADING_WORDS = 12
+
+BULLET_PATTERN = re.compile(r"^([•●▪◦‣∙·○■□➢►\-\*–]|\(?\d{1,2}[.)]|\(?[a-zA-Z][.)])\s+")
+NUMBERED_HEADING_PATTERN = re.compile(r"^(\d+(?:\.\d+)*)\.?\s+[A-Z]")
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+Block = namedtuple('Block', ['kind', 'text'])
+# The chunks of one page range and the section that is open at its end, for the ranges that follow
+RangeChunks = namedtuple('RangeChunks', ['chunks', 'section', 'pages', 'chars'])
+
+
+def heading_strength(line):
+    """
+    :return: 2 for a line that can only be a heading (numbered like "2.1 Data preparation", or all capitals),
+        1 for a line that reads like a title (mostly capitalized words), 0 for text
+    """
+    words = line.split()
+    if len(line) > MAX_HEADING_CHARS or len(words) > MAX_HEADING_WORDS or line[-1] in '.,;:!?':
+        return 0
+    letters = [char for char in line if char.isalpha()]
+    if NUMBERED_HEADING_PATTERN.match(line) or (len(letters) >= 3 and all(char.isupper() for char in letters)):
+        return 2
+    long_words = [word for word in words if len(word) > 3]
+    if line[0].isupper() and long_words and sum(word[0].isupper() for word in long_words) / len(long_words) >= 0.6:
+        return 1
+    return 0
+
+
+def join_lines(lines):
+    """
+    Joins the wrapped lines of a block, undoing the hyphenation of words split across lines.
+    """
+    text = lines[0]
+    for line in lines[1:]:
+        if text.endswith('-') and line[:1].islower():
+            text = text[:-1] + line
+        else:
+            text += ' ' + line
+    return text
+
+
+def parse_blocks(text):
+    """
+    Splits the text of a page into heading, list_item and paragraph blocks. A title-like line only starts a
+    heading when the line before it ended a block, so one wrapped in the middle of a paragraph stays in it.
+    """
+    blocks = []
+    kind, lines = None, []
+    block_ended = True
+    for line in (line.strip() for line in text.splitlines()):
+        if not line:
+            block_ended = True
+            continue
+        if BULLET_PATTERN.match(line):
+            starts = 'list_item'
+        elif heading_strength(line) > (0 if block_ended else 1):
+            starts = 'heading'
+        elif block_ended or kind == 'heading':
+            starts = 'paragraph'
+        else:
+            starts = None
+        if starts:
+            if lines:
+                blocks.append(Block(kind, join_lines(lines)))
+            kind, lines = starts, []
+        lines.append(line)
+        block_ended = kind == 'heading' or line[-1] in '.!?:'
+    if lines:
+        blocks.append(Block(kind, join_lines(lines)))
+    return blocks
+
+
+def split_long_text(text, max_tokens, count_tokens=estimate_tokens):
+    """
+    Splits a block that is larger than a chunk at sentence boundaries, and a sentence that is still too large
+    at word boundaries.
+    """
+    pieces = []
+    for sentence in SENTENCE_END_PATTERN.split(text):
+        if count_tokens(sentence) <= max_tokens:
+            pieces.append(sentence)
+            continue
+        words = []
+        for word in sentence.split():
+            if words and count_tokens(' '.join(words + [word])) > max_tokens:
+                pieces.append(' '.join(words))
+                words = []
+            words.append(word)
+        if words:
+            pieces.append(' '.join(words))
+    parts = []
+    for piece in pieces:
+        if parts and count_tokens(parts[-1] + ' ' + piece) <= max_tokens:
+            parts[-1] += ' ' + piece
+        else:
+            parts.append(piece)
+    return parts
+
+
+class StructuredTextSplitter:
+    """
+    Splits page documents into section-aligned chunks of up to chunk_tokens tokens. Drop-in for the langchain
+    splitters' split_documents. The current section carries over from one page to the next, so the pages of a
+    document must be split in order by one splitter.
+    """
+
+    def __init__(self, chunk_tokens=DEFAULT_CHUNK_TOKENS, min_tokens=DEFAULT_MIN_TOKENS, count_tokens=estimate_tokens,
+                 section=None):
+        self.chunk_tokens = chunk_tokens
+        self.min_tokens = min_tokens
+        self.count_tokens = count_tokens
+        self.section = section
+
+    def split_text(self, text):
+        """
+        :return: A list of (text, section, tokens) for the chunks of one page
+        """
+        chunks = []
+        parts, kinds, tokens, section = [], [], 0, self.section
+
+        def close():
+            chunks.append(('\n'.join(parts), section, tokens))
+            return [], [], 0, self.section
+
+        for block in parse_blocks(text):
+            if block.kind == 'heading':
+                if set(kinds) - {'heading'}:
+                    parts, kinds, tokens, section = close()
+                # of headings stacked on top of each other, the last one names the section
+                self.section = section = block.text
+            pieces = [block.text]
+            if self.count_tokens(block.text) > self.chunk_tokens:
+                pieces = split_long_text(block.text, self.chunk_tokens, self.count_tokens)
+            for piece in pieces:
+                size = self.count_tokens(piece)
+                # a heading is never left at the end of a chunk, it goes with the text that follows it
+                if set(kinds) - {'heading'} and tokens + size > self.chunk_tokens:
+                    parts, kinds, tokens, section = close()
+                parts.append(piece)
+                kinds.append(block.kind)
+                tokens += size
+        if parts:
+            if chunks and tokens < self.min_tokens and chunks[-1][1] == section:
+                previous_text, _, previous_tokens = chunks.pop()
+                parts, tokens = [previous_text] + parts, previous_tokens + tokens
+            close()
+        return chunks
+
+    def split_documents(self, documents):
+        from langchain.schema import Document
+
+        return [
+            Document(page_content=text, metadata=dict(document.metadata, section=section, tokens=tokens))
+            for document in documents
+            for text, section, tokens in self.split_text(document.page_content)
+        ]
+
+
+def split_page_range(path, start, stop, chunker=None):
+    """
+    Process pool task: parses pages start..stop-1 of a PDF and splits them into chunks. The section of the chunks
+    that come before the first heading of the range is not known here and is left as None, see iter_ranges.
+    :param chunker: The kind of splitter, see ingest_pipeline.build_text_splitter; the chunker environment
+        variable of the worker process without it
+    :return: RangeChunks with (text, metadata) tuples
+    """
+    splitter = build_text_splitter(chunker)
+    pages = []
+
+    def counted(pages_iter):
+        for page in pages_iter:
+            pages.append(len(page.page_content))
+            yield page
+
+    chunks = [(chunk.page_content, chunk.metadata)
+              for chunk in iter_chunks(counted(iter_page_range(path, start, stop)), splitter)]
+    # only the structured splitter knows about sections
+    return RangeChunks(chunks, getattr(splitter, 'section', None), len(pages), sum(pages))
+
+
+def iter_ranges(pool, tasks, split=split_page_range, max_in_flight=None):
+    """
+    Splits page ranges in a process pool and yields the results in task order, giving the chunks at the start of
+    a range the section that was open at the end of the range before it in the same file. Only max_in_flight
+    tasks are submitted ahead of the one being consumed, so the chunks of a large ingest are not all held in
+    memory while the first ones are embedded.
+    :param tasks: (path, start, stop) page ranges, see ingest_pipeline.plan_tasks
+    :param split: The task, returns RangeChunks whose chunks are tuples that end with their metadata
+    :param max_in_flight: Defaults to the pool's worker count
+    :return: A generator of ((path, start, stop), RangeChunks)
+    """
+    max_in_flight = max_in_flight or getattr(pool, '_max_workers', None) or os.cpu_count() or 1
+    tasks = iter(tasks)
+    futures = deque((task, pool.submit(split, *task)) for task in itertools.islice(tasks, max_in_flight))
+    sections = {}
+    while futures:
+        task, future = futures.popleft()
+        result = future.result()
+        # keep the workers busy while the caller works on this result
+        for next_task in itertools.islice(tasks, 1):
+            futures.append((next_task, pool.submit(split, *next_task)))
+        path = task[0]
+        for chunk in result.chunks:
+            if chunk[-1].get('section') is None:
+                chunk[-1]['section'] = sections.get(path)
+        if result.section is not None:
+            sections[path] = result.section
+        yield task, result
+
+
+def chunk_files(pool, files, pages_per_task=10, stats=None, chunker=None):
+    """
+    Splits PDFs in a process pool, one task per page range, so a single large file is still split by every worker.
+    :param stats: Optional dict that receives the pages and page characters parsed, per file
+    :param chunker: The kind of splitter, the chunker environment variable of this process without it
+    :return: A generator of (path, generator of (text, metadata)) in file order, the chunks in page order
+    """
+    def file_chunks(path, ranges):
+        for _, result in ranges:
+            if stats is not None:
+                file_stats = stats.setdefault(path, {'pages': 0, 'page_chars': 0})
+                file_stats['pages'] += result.pages
+                file_stats['page_chars'] += result.chars
+            yield from result.chunks
+
+    # resolved once here, so every worker splits with the chunker this process is configured with
+    split = functools.partial(split_page_range, chunker=chunker or os.getenv('chunker', 'structured'))
+    for path, ranges in itertools.groupby(iter_ranges(pool, plan_tasks(files, pages_per_task), split),
+                                          key=lambda item: item[0][0]):
+        yield path, file_chunks(path, ranges)
@@ -0,0 +1,124 @@
+import math
+import os
+from collections import namedtuple
+
+from retrieval import hit_text
+
+# Budget for the retrieved context in the prompt, per generation model, in (estimated) tokens
+MODEL_CONTEXT_BUDGETS = {
+    'amazon.titan-text-premier-v1:0': 3000,
+}
+DEFAULT_CONTEXT_BUDGET = 3000
+# Titan and most English tokenizers average about four characters per token
+CHARS_PER_TOKEN = 4
+# Smallest suffix/prefix match treated as splitter overlap rather than a coincidence
+MIN_OVERLAP_CHARS = 20
+# chunk_overlap of the splitter plus slack for where the separators fall
+MAX_OVERLAP_CHARS = 250
+
+Passage = namedtuple('Passage', ['text', 'source', 'page'])
+Context = namedtuple('Context', ['text', 'tokens', 'naive_tokens', 'saved_tokens', 'passages'])
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def overlap_length(first, second, max_overlap=MAX_OVERLAP_CHARS):
+    """
+    Length of the longest suffix of first that is also a prefix of second, as the text splitter's
+    chunk_overlap produces for neighbouring chunks.
+    """
+    for length in range(min(len(first), len(second), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def merge_passages(first, second):
+    """
+    Merges two passages when one contains the other or they overlap at the edges.
+    :return: The merged text, or None when the passages are unrelated
+    """
+    if second.text in first.text:
+        return first.text
+    if first.text in second.text:
+        return second.text
+    length = overlap_length(first.text, second.text)
+    if length:
+        return first.text + second.text[length:]
+    length = overlap_length(second.text, first.text)
+    if length:
+        return second.text + first.text[length:]
+    return None
+
+
+def passages_from_hits(hits):
+    passages = []
+    for hit in hits:
+        source = hit.get('_source', {})
+        passages.append(Passage(hit_text(hit).strip(), source.get('source'), source.get('page')))
+    return passages
+
+
+def deduplicate(passages):
+    """
+    Collapses overlapping and repeated chunks into single passages and merges chunks from the same page,
+    keeping the order in which each passage was first retrieved.
+    """
+    merged = []
+    for passage in passages:
+        for position, existing in enumerate(merged):
+            text = merge_passages(existing, passage)
+            if text is None and passage.page is not None and (existing.source, existing.page) == (passage.source, passage.page):
+                text = existing.text + '\n' + passage.text
+            if text is not None:
+                merged[position] = existing._replace(text=text)
+                break
+        else:
+            merged.append(passage)
+    return merged
+
+
+def format_passage(passage):
+    if passage.page is None:
+        return passage.text
+    # pages are numbered from 0 by the PDF loader
+    return f"[{passage.source}, page {passage.page + 1}]\n{passage.text}"
+
+
+def naive_context(hits):
+    """
+    The context as answer_query used to build it, kept to report how many tokens the builder saves.
+    """
+    return ''.join("Info = " + str(hit.get('fields', {}).get('text', [])) for hit in hits)
+
+
+def build_context(hits, token_budget=DEFAULT_CONTEXT_BUDGET):
+    """
+    Builds the prompt context from search hits: overlapping and same-page chunks are merged, and the passages
+    are packed in retrieval order until the token budget is used up. A passage that does not fit entirely is
+    cut at the budget when nothing has been packed yet, otherwise skipped in favour of smaller later ones.
+    :return: A Context with the text, its estimated tokens, and the tokens saved compared to the naive join
+    """
+    packed = []
+    used = 0
+    for passage in deduplicate(passages_from_hits(hits)):
+        text = format_passage(passage)
+        tokens = estimate_tokens(text) + 1
+        if used + tokens > token_budget:
+            if packed:
+                continue
+            text = text[:token_budget * CHARS_PER_TOKEN]
+            tokens = estimate_tokens(text)
+        packed.append(text)
+        used += tokens
+    text = '\n\n'.join(packed)
+    tokens = estimate_tokens(text)
+    naive_tokens = estimate_tokens(naive_context(hits))
+    return Context(text, tokens, naive_tokens, max(naive_tokens - tokens, 0), len(packed))
+
+
+def context_budget_from_env(model_id):
+    budget = os.getenv('context_token_budget')
+    return int(budget) if budget else MODEL_CONTEXT_BUDGETS.get(model_id, DEFAULT_CONTEXT_BUDGET)
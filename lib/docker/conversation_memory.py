@@ -0,0 +1,275 @@
+"""
+Multi-turn memory for the query path: the questions and answers of a conversation are passed to the model with
+every new question, within a token budget, and the context retrieved for a topic is reused by its follow-ups.
+
+A conversation is keyed by the Cognito user and the browser session. Its most recent turns are kept verbatim;
+when they grow past token_budget the oldest ones are folded into a running summary, by the model (summarize) in
+the background after the answer has been delivered, so the next question doesn't wait for it. A follow-up ("why
+is option B wrong?", "give me 5 more about this") reuses the context of the last search instead of searching
+again: it refers to the previous turn, or its embedding is within follow_up_similarity of the question the
+context was retrieved for.
+
+The store is in memory, per process like the answer cache, and bounded: conversations idle for ttl_seconds
+expire, the least recently used one is evicted beyond max_conversations, and each one holds at most its token
+budget of turns, its summary and one retrieved context.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from answer_cache import cosine_similarity
+from context_builder import CHARS_PER_TOKEN, estimate_tokens
+
+DEFAULT_SIZE = 1000
+DEFAULT_TTL_SECONDS = 4 * 3600
+# Estimated tokens of verbatim turns and summary passed to the model with a new question
+DEFAULT_TOKEN_BUDGET = 4000
+DEFAULT_SUMMARY_TOKENS = 400
+DEFAULT_FOLLOW_UP_SIMILARITY = 0.85
+# A follow-up is a short question that refers back to the conversation explicitly: it starts with a pronoun ("why
+# is that wrong?"), names a question or an option ("question 3", "option B"), asks for "more about this" or about
+# the previous question or answer. A pronoun further into a question ("what does it alert on?") is not enough,
+# that is how new topics are asked about too. Option letters are upper case, so "answer a few ..." is no option
+FOLLOW_UP_MAX_WORDS = 20
+FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(?i:it|its|this|that|these|those|they|them)\b"
+    r"|\b(?i:question|q)\s*#?\s*\d+\b"
+    r"|\b(?i:option|answer|choice)\s+[A-D]\b"
+    r"|\b(?i:more\s+(about|on|like)\s+(it|this|that|these|those|them))\b"
+    r"|\b(?i:(previous|last|above|earlier)\s+(question|answer|one|ones))\b")
+
+Turn = namedtuple('Turn', ['question', 'answer', 'tokens'])
+# The context of the last search, with what it was retrieved for
+RetrievedContext = namedtuple('RetrievedContext', ['question', 'vectors', 'filters', 'text'])
+
+
+def is_follow_up_question(question):
+    return len(question.split()) <= FOLLOW_UP_MAX_WORDS and FOLLOW_UP_PATTERN.search(question) is not None
+
+
+def truncate_tokens(text, tokens):
+    return text if estimate_tokens(text) <= tokens else text[:tokens * CHARS_PER_TOKEN] + ' ...'
+
+
+def summary_prompt(summary, turns, max_tokens):
+    """
+    The prompt that folds turns into the running summary of a conversation.
+    """
+    exchanges = '\n\n'.join(f"User: {turn.question}\nAssistant: {turn.answer}" for turn in turns)
+    previous = f"Summary of the conversation so far:\n{summary}\n\n" if summary else ''
+    return (f"{previous}Later exchanges:\n{exchanges}\n\n"
+            f"Update the summary of this study session in at most {max_tokens * 3 // 4} words. Keep the topics "
+            f"asked about, the questions that were generated and the user's answers and mistakes, so later "
+            f"questions can refer to them. Reply with the summary only.")
+
+
+def prompt_with_summary(summary, prompt):
+    """
+    Puts the summary of the earlier turns of a conversation in front of the prompt of its new question.
+    """
+    if not summary:
+        return prompt
+    return f"Summary of our conversation so far:\n{summary}\n\n{prompt}"
+
+
+def fallback_summary(summary, turns, max_tokens):
+    """
+    The summary without the model, when summarizing fails: the topics that were asked about, newest last.
+    """
+    lines = ([summary] if summary else []) + [f"- The user asked: {turn.question}" for turn in turns]
+    text = '\n'.join(lines)
+    return text[-max_tokens * CHARS_PER_TOKEN:]
+
+
+class Conversation:
+    """
+    The turns, summary and last retrieved context of one conversation. Turns are added once their answer is
+    complete; reading the history waits for a summarization that is still running.
+    """
+
+    def __init__(self, token_budget=DEFAULT_TOKEN_BUDGET, summary_tokens=DEFAULT_SUMMARY_TOKENS,
+                 follow_up_similarity=DEFAULT_FOLLOW_UP_SIMILARITY):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.follow_up_similarity = follow_up_similarity
+        self.turns = []
+        self.summary = ''
+        self.context = None
+        self.updated = time.time()
+        self._compaction = None
+        self._lock = threading.Lock()
+
+    def _wait_for_compaction(self):
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.result()
+
+    def history(self):
+        """
+        :return: (summary, messages): the summary of the turns that no longer fit, and the Converse messages of the
+            most recent turns within the token budget (the newest answer cut to the budget when it doesn't fit alone)
+        """
+        self._wait_for_compaction()
+        with self._lock:
+            summary, turns = self.summary, list(self.turns)
+        budget = self.token_budget - estimate_tokens(summary)
+        kept = []
+        for turn in reversed(turns):
+            if turn.tokens > budget:
+                if not kept:
+                    answer = truncate_tokens(turn.answer, max(budget - estimate_tokens(turn.question), 0))
+                    kept.append(turn._replace(answer=answer))
+                break
+            kept.append(turn)
+            budget -= turn.tokens
+        messages = []
+        for turn in reversed(kept):
+            messages.append({"role": "user", "content": [{"text": turn.question}]})
+            messages.append({"role": "assistant", "content": [{"text": turn.answer}]})
+        return summary, messages
+
+    def reusable_context(self, question, filters=None, vectors=None):
+        """
+        :param vectors: The question's embedding, without it only the wording of the question is considered
+        :return: The text of the last retrieved context when the question is a follow-up of it, otherwise None
+        """
+        context = self.context
+        if context is None or context.filters != filters:
+            return None
+        if is_follow_up_question(question):
+            return context.text
+        if vectors is not None and cosine_similarity(vectors, context.vectors) >= self.follow_up_similarity:
+            return context.text
+        return None
+
+    def remember_context(self, question, vectors, filters, text):
+        self.context = RetrievedContext(question, vectors, filters, text)
+
+    def add_turn(self, question, answer, summarize=None, executor=None):
+        """
+        Adds a completed turn, and folds the oldest turns into the summary when the turns exceed the budget.
+        :param summarize: summarize(summary, turns, max_tokens) returns the new summary, fallback_summary without it
+        :param executor: Summarizes in the background on this executor, in the caller's thread without one
+        """
+        if not answer:
+            return
+        with self._lock:
+            self.turns.append(Turn(question, answer, estimate_tokens(question) + estimate_tokens(answer)))
+            self.updated = time.time()
+            compact = sum(turn.tokens for turn in self.turns) + estimate_tokens(self.summary) > self.token_budget
+            if not compact or len(self.turns) < 2 or (self._compaction is not None and not self._compaction.done()):
+                return
+            if executor is not None:
+                self._compaction = executor.submit(self._compact, summarize)
+                return
+        self._compact(summarize)
+
+    def _compact(self, summarize):
+        with self._lock:
+            # the newest turn stays verbatim, the oldest ones are folded until the rest fit in half the budget
+            tokens = sum(turn.tokens for turn in self.turns)
+            folded = 0
+            while folded < len(self.turns) - 1 and tokens > (self.token_budget - self.summary_tokens) // 2:
+                tokens -= self.turns[folded].tokens
+                folded += 1
+            summary, turns = self.summary, self.turns[:folded]
+        if not turns:
+            return
+        try:
+            text = summarize(summary, turns, self.summary_tokens) if summarize else None
+        except Exception as e:
+            print(f"Could not summarize the conversation: {e}")
+            text = None
+        text = truncate_tokens(text, self.summary_tokens) if text else fallback_summary(summary, turns,
+                                                                                         self.summary_tokens)
+        with self._lock:
+            # unless another compaction of the same turns got there first
+            if self.turns[:len(turns)] == turns:
+                self.summary = text
+                del self.turns[:len(turns)]
+
+
+class ConversationStore:
+    """
+    The conversations of a process by id, see the module docstring.
+    """
+
+    def __init__(self, max_conversations=DEFAULT_SIZE, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 token_budget=DEFAULT_TOKEN_BUDGET, summary_tokens=DEFAULT_SUMMARY_TOKENS,
+                 follow_up_similarity=DEFAULT_FOLLOW_UP_SIMILARITY, summarize=None, summarize_workers=2):
+        """
+        :param summarize: summarize(summary, turns, max_tokens) returns the updated summary of a conversation
+        :param summarize_workers: Threads that summarize in the background, 0 summarizes when the turn is added
+        """
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.follow_up_similarity = follow_up_similarity
+        self.summarize = summarize
+        self.follow_ups = 0
+        self.evicted = 0
+        self._executor = ThreadPoolExecutor(max_workers=summarize_workers,
+                                            thread_name_prefix='conversation-summary') if summarize_workers else None
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        """
+        :return: The conversation, a new one when the id is unknown or its conversation expired
+        """
+        now = time.time()
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None or now - conversation.updated > self.ttl_seconds:
+                conversation = Conversation(self.token_budget, self.summary_tokens, self.follow_up_similarity)
+                self._conversations[conversation_id] = conversation
+            self._conversations.move_to_end(conversation_id)
+            conversation.updated = now
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.evicted += 1
+        return conversation
+
+    def add_turn(self, conversation, question, answer):
+        conversation.add_turn(question, answer, self.summarize, self._executor)
+
+    def count_follow_up(self):
+        with self._lock:
+            self.follow_ups += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._conversations.clear()
+
+    def stats(self):
+        return {
+            'conversations': len(self._conversations),
+            'follow_ups': self.follow_ups,
+            'evicted': self.evicted,
+        }
+
+
+def conversation_id(user, session):
+    """
+    The key of a conversation: the Cognito user (the ALB's x-amzn-oidc-identity header) and the browser session.
+    """
+    return f"{user or 'anonymous'}:{session}"
+
+
+def build_conversation_store_from_env(summarize=None):
+    """
+    Builds the conversation store configured by the environment: conversation_store_size, conversation_ttl,
+    conversation_token_budget, conversation_summary_tokens and conversation_follow_up_similarity.
+    """
+    return ConversationStore(
+        max_conversations=int(os.getenv('conversation_store_size', DEFAULT_SIZE)),
+        ttl_seconds=float(os.getenv('conversation_ttl', DEFAULT_TTL_SECONDS)),
+        token_budget=int(os.getenv('conversation_token_budget', DEFAULT_TOKEN_BUDGET)),
+        summary_tokens=int(os.getenv('conversation_summary_tokens', DEFAULT_SUMMARY_TOKENS)),
+        follow_up_similarity=float(os.getenv('conversation_follow_up_similarity', DEFAULT_FOLLOW_UP_SIMILARITY)),
+        summarize=summarize,
+    )
@@ -0,0 +1,155 @@
+"""
+Direct ingest mode for bulk backfills. Instead of sending chunks through SQS to the indexer Lambda, this
+parses and splits the PDFs in a process pool, embeds the chunks with the indexer's embedding executor,
+and writes them to OpenSearch with the indexer's bulk writer, reporting throughput as it goes.
+
+With --local the Bedrock and OpenSearch clients are replaced by the in-process stand-ins, so backfill
+speed can be measured offline; --bedrock-latency-ms simulates the per-call latency of the real service.
+
+Usage:
+    python direct_ingest.py wellarchitected-machine-learning-lens.pdf
+    python direct_ingest.py ./pdfs --local --bedrock-latency-ms 150 --workers 4 --embed-concurrency 16
+"""
+import argparse
+import functools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import rag_clients
+from chunking import iter_ranges, split_page_range
+from embedding_cache import build_cache_from_env
+from embedders import build_embedder_from_env, document_embed_fn
+from embedding_executor import EmbeddingExecutor, DEFAULT_CONCURRENCY
+from fingerprints import document_id, source_name
+from indexing import embed_items
+from ingest_pipeline import list_pdfs, plan_tasks
+from opensearch_bulk import bulk_index, DEFAULT_MAX_DOCS
+
+
+def split_pages(path, start, stop, root=None):
+    """
+    Worker process task: parses pages start..stop-1 of a PDF and splits them into chunks.
+    :param root: The directory being ingested, the source is named by its path under it, see fingerprints.source_name
+    :return: RangeChunks of (doc_id, text, metadata) tuples, the metadata holds the source name, page and section
+    """
+    source = source_name(path, root)
+    result = split_page_range(path, start, stop)
+    return result._replace(chunks=[
+        (document_id(source, metadata['page'], text), text, dict(metadata, source=source))
+        for text, metadata in result.chunks
+    ])
+
+
+class Progress:
+    """
+    Tracks chunk counters and prints the throughput at most once per interval.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.last_report = self.started
+        self.counters = {'chunks': 0, 'embedded': 0, 'indexed': 0, 'failed': 0}
+
+    def add(self, **counts):
+        for name, count in counts.items():
+            self.counters[name] += count
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            print(f"{self.counters['indexed']}/{self.counters['chunks']} chunks indexed, "
+                  f"{self.chunks_per_second():.1f} chunks/s")
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def chunks_per_second(self):
+        return self.counters['indexed'] / max(self.elapsed(), 1e-9)
+
+    def summary(self):
+        return dict(self.counters, seconds=round(self.elapsed(), 3), chunks_per_second=round(self.chunks_per_second(), 2))
+
+
+def direct_ingest(files, bedrock, client, index_name, vector_field, workers=4, pages_per_task=10,
+                  embed_concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_MAX_DOCS, embedding_cache=None, embedder=None,
+                  root=None):
+    """
+    Runs the backfill: a process pool parses and splits page ranges, chunks are embedded in batches of batch_size
+    by a thread pool, and each embedded batch is bulk written while the next one is being embedded.
+    :param root: The file or directory the files were listed from, see fingerprints.source_name
+    :return: The progress summary, with chunk counters and chunks per second
+    """
+    embedder = embedder or build_embedder_from_env()
+    executor = EmbeddingExecutor(document_embed_fn(embedder, bedrock, embedding_cache), concurrency=embed_concurrency)
+    progress = Progress()
+    pending = []
+    writes = []
+
+    def write(items):
+        result = bulk_index(client, index_name, items, max_docs=batch_size)
+        progress.add(indexed=result['succeeded'], failed=len(result['failed']))
+
+    def flush(chunks):
+        items, failures = embed_items(executor, [(doc_id, text, doc_id, metadata) for doc_id, text, metadata in chunks],
+                                      vector_field, batch_size=embedder.batch_size)
+        progress.add(embedded=len(items), failed=len(failures))
+        writes.append(writer.submit(write, items))
+
+    # one writer thread keeps the bulk requests in order and overlaps them with embedding
+    with ProcessPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=1) as writer:
+        split = functools.partial(split_pages, root=root)
+        for _, result in iter_ranges(pool, plan_tasks(files, pages_per_task), split):
+            chunks = result.chunks
+            progress.add(chunks=len(chunks))
+            pending.extend(chunks)
+            while len(pending) >= batch_size:
+                flush(pending[:batch_size])
+                pending = pending[batch_size:]
+        if pending:
+            flush(pending)
+        for future in writes:
+            future.result()
+
+    summary = progress.summary()
+    summary['throttled'] = executor.limiter.throttled
+    if embedding_cache is not None:
+        summary['embedding_cache'] = embedding_cache.stats()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='A PDF or a directory of PDFs')
+    parser.add_argument('--local', action='store_true', help='Use the Bedrock stand-in and the local vector store')
+    parser.add_argument('--bedrock-latency-ms', type=float, default=0.0, help='Simulated Bedrock latency with --local')
+    parser.add_argument('--store', help='With --local, keep the local vector store in this directory instead of in memory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--pages-per-task', type=int, default=10)
+    parser.add_argument('--embed-concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MAX_DOCS)
+    parser.add_argument('--index', default=os.getenv('vector_index_name', 'rag-vector-index'))
+    parser.add_argument('--vector-field', default=os.getenv('vector_field_name', 'vector_field'))
+    args = parser.parse_args()
+
+    if args.local:
+        from local_standins import FakeBedrockRuntime
+        from vector_store import LocalVectorStore
+
+        bedrock = FakeBedrockRuntime(latency=args.bedrock_latency_ms / 1000)
+        client = LocalVectorStore(args.store)
+    else:
+        bedrock = rag_clients.get_bedrock_client(max_pool_connections=args.embed_concurrency)
+        client = rag_clients.get_opensearch_client(os.getenv('opensearch_host'))
+
+    summary = direct_ingest(
+        list_pdfs(args.path), bedrock, client, args.index, args.vector_field,
+        workers=args.workers, pages_per_task=args.pages_per_task, embed_concurrency=args.embed_concurrency,
+        batch_size=args.batch_size, embedding_cache=build_cache_from_env(), root=args.path,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,11 @@ import boto3
 import json
 from dotenv import load_dotenv
 import os
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
-from langchain.text_splitter import CharacterTextSplitter, RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader, PyPDFDirectoryLoader
+from concurrent.futures import ProcessPoolExecutor
+from chunking import chunk_files
+from ingest_pipeline import SqsBatchSender, list_pdfs
+from fingerprints import IngestManifest, document_id, file_hash, source_name
+import rag_clients
 
 # loading in environment variables
 load_dotenv()
@@ -13,102 +15,125 @@ load_dotenv()
 sqs = boto3.client('sqs', region_name='us-east-1')
 queue_url = os.getenv('sqs_queue_url')
 
-# instantiating the bedrock client, with specific CLI profile
-boto3.setup_default_session(profile_name=os.getenv('profile_name'))
-bedrock = boto3.client('bedrock-runtime', 'us-east-1', endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com')
-opensearch = boto3.client("opensearchserverless", 'us-east-1')
-
-# Instantiating the OpenSearch client, with specific CLI profile
-host = os.getenv('opensearch_host')  # cluster endpoint, for example: my-test-domain.us-east-1.aoss.amazonaws.com
-region = 'us-east-1'
-service = 'aoss'
-credentials = boto3.Session(profile_name=os.getenv('profile_name')).get_credentials()
-auth = AWSV4SignerAuth(credentials, region, service)
-print(os.getenv('profile_name'))
-client = OpenSearch(
-    hosts=[{'host': host, 'port': 443}],
-    http_auth=auth,
-    use_ssl=True,
-    verify_certs=False,
-    ssl_show_warn = False,
-    connection_class=RequestsHttpConnection,
-    pool_maxsize=50
-)
-
-# loading in PDF, can use PyPDFDirectoryLoader if you want to load in a directory of PDFs
-# TODO: Change PDF loader and chunker
-loader = PyPDFLoader("wellarchitected-machine-learning-lens.pdf")
-documents = loader.load()
-
-# implementing a text splitter based on number of characters
-# TODO: PLAY WITH THESE VALUES TO OPTIMIZE FOR YOUR USE CASE
-text_splitter = RecursiveCharacterTextSplitter(
-    # Play with Chunk Size
-    chunk_size=600,
-    chunk_overlap=100,
-)
-
-# Performing the splitting of the document(s)
-doc = text_splitter.split_documents(documents)
-
-# Providing insights into the average length of documents, and amount of character before and after splitting
-avg_doc_length = lambda documents: sum([len(doc.page_content) for doc in documents]) // len(documents)
-avg_char_count_pre = avg_doc_length(documents)
-avg_char_count_post = avg_doc_length(doc)
-print(f'Average length among {len(documents)} documents loaded is {avg_char_count_pre} characters.')
-print(f'After the split we have {len(doc)} documents more than the original {len(documents)}.')
-print(f'Average length among {len(doc)} documents (after split) is {avg_char_count_post} characters.')
-
-# Send each document chunk to SQS
-for i in doc:
-    exampleContent = i.page_content
-    message = json.dumps({"content": exampleContent})
-    response = sqs.send_message(
-        QueueUrl=queue_url,
-        MessageBody=message
-    )
-    print(f"Sent message to SQS: {response.get('MessageId')}")
-
-"""
-def get_embedding(body):
-    modelId = 'amazon.titan-embed-text-v1'
-    accept = 'application/json'
-    contentType = 'application/json'
-    response = bedrock.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
-    response_body = json.loads(response.get('body').read())
-    embedding = response_body.get('embedding')
-    return embedding
-
-
-def indexDoc(client, vectors, text):
-    # TODO: You can add more metadata fields if you wanted to!
-    indexDocument = {
-        os.getenv("vector_field_name"): vectors,
-        'text': text
-
-    }
-    # Configuring the specific index
-    response = client.index(
-        index=os.getenv("vector_index_name"),
-        body=indexDocument,
-        refresh=False
-    )
-    print(response)
-    return response
-
-
-# The process of iterating through each chunk of the document you are trying to index, and generate embeddings for.
-for i in doc:
-    # The text data of each chunk
-    exampleContent = i.page_content
-    # Generating the embeddings for each chunk of text data
-    exampleInput = json.dumps({"inputText": exampleContent})
-    exampleVectors = get_embedding(exampleInput)
-    # setting the text data as the text variable, and generated vector to a vector variable
-    # TODO: You can add more metadata fields here if you wanted to by configuring it here and adding them to the indexDocument dictionary above
-    text = exampleContent
-    vectors = exampleVectors
-    # calling the indexDoc function, passing in the OpenSearch Client, the created vector, and corresponding text data
-    # TODO: If you wanted to add metadata you would pass it in here
-    indexDoc(client, vectors, text)
-"""
\ No newline at end of file
+# loading in PDF(s): a single file, or a directory of PDFs using the same pattern as PyPDFDirectoryLoader
+docs_path = os.getenv('docs_path', 'wellarchitected-machine-learning-lens.pdf')
+# worker processes that parse and split the PDFs, each one takes pages_per_task pages at a time
+ingest_workers = int(os.getenv('ingest_workers', 4))
+pages_per_task = int(os.getenv('ingest_pages_per_task', 10))
+# record of the chunks already sent for indexing, so that re-runs only send the difference; without one it is
+# rebuilt from the index
+manifest_path = os.getenv('ingest_manifest_path', '.ingest_manifest.json')
+
+
+def ingest_file(path, chunks, previous_ids=frozenset(), page_stats=None, source=None):
+    """
+    Streams the chunks of one PDF to SQS in SendMessageBatch calls as its page ranges finish splitting, so the
+    first chunk is enqueued long before the last page is parsed.
+    Chunks get deterministic ids, and only the ones that are not in previous_ids are sent for embedding and
+    indexing. Ids from the previous run that no longer exist are sent as deletes.
+    :param path: The PDF to ingest
+    :param chunks: The (text, metadata) chunks of the file in page order, from chunking.chunk_files
+    :param previous_ids: The chunk ids indexed for this file by the previous run, from the manifest
+    :param page_stats: The dict chunk_files counts the pages of the files in
+    :param source: The name of the file in the chunk ids and metadata, see fingerprints.source_name; its file
+        name without it
+    :return: Counters for the file and the set of ids now indexed, used for the summary and the manifest
+    """
+    stats = {'file': path, 'pages': 0, 'page_chars': 0, 'chunks': 0, 'chunk_chars': 0, 'unchanged': 0}
+    source = source or os.path.basename(path)
+    current_ids = set()
+
+    with SqsBatchSender(sqs, queue_url) as sender:
+        for text, metadata in chunks:
+            stats['chunks'] += 1
+            stats['chunk_chars'] += len(text)
+            page = metadata.get('page')
+            doc_id = document_id(source, page, text)
+            if doc_id in current_ids:
+                # the same text repeated on the same page maps to the same document
+                continue
+            current_ids.add(doc_id)
+            if doc_id in previous_ids:
+                stats['unchanged'] += 1
+                continue
+            sender.send({"content": text, "id": doc_id, "source": source, "page": page,
+                         "section": metadata.get('section')})
+        removed_ids = set(previous_ids) - current_ids
+        for doc_id in removed_ids:
+            sender.send({"action": "delete", "id": doc_id})
+    stats.update((page_stats or {}).get(path, {}))
+    stats['removed'] = len(removed_ids)
+    stats['sent'] = sender.sent
+    stats['failed'] = len(sender.failed)
+    stats['batches'] = sender.batches
+    # chunks that did not reach the queue are left out of the manifest, and failed deletes are kept in it,
+    # so the next run retries both
+    for body, error in sender.failed:
+        print(f"Failed to send message to SQS: {error}")
+        message = json.loads(body)
+        if message.get('action') == 'delete':
+            current_ids.add(message['id'])
+        else:
+            current_ids.discard(message['id'])
+    stats['ids'] = current_ids
+    return stats
+
+
+def delete_source(ids):
+    """
+    Sends deletes for every chunk of a source file that is no longer part of the corpus.
+    """
+    with SqsBatchSender(sqs, queue_url) as sender:
+        for doc_id in ids:
+            sender.send({"action": "delete", "id": doc_id})
+    return sender
+
+
+def print_summary(stats):
+    # Providing insights into the average length of documents, and amount of character before and after splitting
+    print(f"{stats['file']}: average length among {stats['pages']} pages loaded is "
+          f"{stats['page_chars'] // max(stats['pages'], 1)} characters.")
+    print(f"After the split we have {stats['chunks']} documents more than the original {stats['pages']}.")
+    print(f"Average length among {stats['chunks']} documents (after split) is "
+          f"{stats['chunk_chars'] // max(stats['chunks'], 1)} characters.")
+    print(f"{stats['unchanged']} chunks unchanged since the last run, {stats['removed']} removed.")
+    print(f"Sent {stats['sent']} messages to SQS in {stats['batches']} batches, {stats['failed']} failed.")
+
+
+if __name__ == '__main__':
+    manifest = IngestManifest(manifest_path)
+    if not os.path.exists(manifest_path):
+        # a new container or task starts without the manifest of the last run, the index has the same chunk ids
+        manifest.rebuild(rag_clients.get_opensearch_client(os.getenv('opensearch_host')),
+                         os.getenv('vector_index_name'))
+        print(f"Rebuilt the ingest manifest from the index: {len(manifest.sources)} source files.")
+    files = list_pdfs(docs_path)
+    # files whose bytes have not changed since the last run are skipped without being parsed
+    hashes = {path: file_hash(path) for path in files}
+    # files are keyed by their path under docs_path, the same file name can be in several subdirectories
+    sources = {path: source_name(path, docs_path) for path in files}
+    changed = [path for path in files if not manifest.is_unchanged(sources[path], hashes[path])]
+    print(f"{len(files) - len(changed)} of {len(files)} files unchanged since the last run.")
+
+    def record(stats):
+        print_summary(stats)
+        manifest.update(sources[stats['file']], hashes[stats['file']], stats['ids'])
+        manifest.save()
+
+    if changed:
+        # parsing PDFs is CPU bound, so the page ranges of every file are split in worker processes while the
+        # chunks of the files before are being sent
+        page_stats = {}
+        with ProcessPoolExecutor(max_workers=ingest_workers) as pool:
+            for path, chunks in chunk_files(pool, changed, pages_per_task, stats=page_stats):
+                record(ingest_file(path, chunks, manifest.document_ids(sources[path]), page_stats, sources[path]))
+
+    # removing the chunks of source files that have been deleted since the last run
+    current_sources = set(sources.values())
+    for source in [source for source in manifest.sources if source not in current_sources]:
+        sender = delete_source(manifest.document_ids(source))
+        print(f"{source}: sent {sender.sent} deletes, {len(sender.failed)} failed.")
+        if not sender.failed:
+            del manifest.sources[source]
+    manifest.save()
+
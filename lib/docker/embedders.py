@@ -0,0 +1,126 @@
+import json
+import os
+
+TITAN_V1_MODEL_ID = 'amazon.titan-embed-text-v1'
+TITAN_V2_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+DEFAULT_MODEL_ID = TITAN_V1_MODEL_ID
+
+# Output sizes Titan Text Embeddings v2 can be asked for, 1024 is the full vector
+TITAN_V2_DIMENSIONS = (256, 512, 1024)
+# Cohere embed v3 takes up to 96 texts per call, of up to 2048 characters each
+COHERE_MAX_BATCH = 96
+COHERE_MAX_CHARS = 2048
+
+
+class TitanEmbedder:
+    """
+    Amazon Titan Text Embeddings. v1 returns 1536 floats; v2 returns 256, 512 or 1024 and can normalize them
+    to unit length. One text per call.
+    """
+
+    batch_size = 1
+
+    def __init__(self, model_id=DEFAULT_MODEL_ID, dimensions=None, normalize=None):
+        self.model_id = model_id
+        if model_id == TITAN_V1_MODEL_ID:
+            if dimensions not in (None, 1536) or normalize:
+                raise ValueError(f"{model_id} only returns 1536 unnormalized dimensions")
+            self.dimension = 1536
+            self.body_options = {}
+        else:
+            dimensions = int(dimensions or 1024)
+            if dimensions not in TITAN_V2_DIMENSIONS:
+                raise ValueError(f"{model_id} supports {TITAN_V2_DIMENSIONS} dimensions, not {dimensions}")
+            self.dimension = dimensions
+            self.body_options = {'dimensions': dimensions, 'normalize': True if normalize is None else normalize}
+
+    @property
+    def cache_id(self):
+        """
+        Identifies the vectors this embedder produces in the embedding cache, output options included.
+        """
+        if not self.body_options:
+            return self.model_id
+        return f"{self.model_id}:{self.body_options['dimensions']}:{'norm' if self.body_options['normalize'] else 'raw'}"
+
+    @property
+    def query_cache_id(self):
+        # queries and documents are embedded the same way
+        return self.cache_id
+
+    def embed_query(self, bedrock, text):
+        body = json.dumps(dict(self.body_options, inputText=text))
+        response = bedrock.invoke_model(body=body, modelId=self.model_id, accept='application/json',
+                                        contentType='application/json')
+        return json.loads(response.get('body').read()).get('embedding')
+
+    def embed_documents(self, bedrock, texts):
+        return [self.embed_query(bedrock, text) for text in texts]
+
+
+class CohereEmbedder:
+    """
+    Cohere Embed v3 on Bedrock: 1024 dimensions, many texts per call, and different input types for the
+    indexed documents and the search queries.
+    """
+
+    dimension = 1024
+
+    def __init__(self, model_id='cohere.embed-english-v3', batch_size=COHERE_MAX_BATCH, dimensions=None, normalize=None):
+        if dimensions not in (None, 1024):
+            raise ValueError(f"{model_id} only returns 1024 dimensions")
+        self.model_id = model_id
+        self.batch_size = min(batch_size, COHERE_MAX_BATCH)
+        self.cache_id = model_id
+        # queries are embedded with another input type, so their vectors are cached apart from the documents'
+        self.query_cache_id = f"{model_id}:search_query"
+
+    def _invoke(self, bedrock, texts, input_type):
+        body = json.dumps({'texts': [text[:COHERE_MAX_CHARS] for text in texts], 'input_type': input_type,
+                           'truncate': 'END'})
+        response = bedrock.invoke_model(body=body, modelId=self.model_id, accept='*/*', contentType='application/json')
+        return json.loads(response.get('body').read())['embeddings']
+
+    def embed_query(self, bedrock, text):
+        return self._invoke(bedrock, [text], 'search_query')[0]
+
+    def embed_documents(self, bedrock, texts):
+        return self._invoke(bedrock, texts, 'search_document')
+
+
+def build_embedder(model_id=None, dimensions=None, normalize=None):
+    """
+    Builds the embedder for a Bedrock embedding model id.
+    :param dimensions: Output dimensions, for the models that support several
+    :param normalize: Whether to return unit length vectors, for the models that support it
+    """
+    model_id = model_id or DEFAULT_MODEL_ID
+    if model_id.startswith('amazon.titan-embed-text'):
+        return TitanEmbedder(model_id, dimensions, normalize)
+    if model_id.startswith('cohere.embed'):
+        return CohereEmbedder(model_id, dimensions=dimensions, normalize=normalize)
+    raise ValueError(f"Unsupported embedding model {model_id!r}")
+
+
+def build_embedder_from_env():
+    """
+    Builds the embedder configured by the environment: embedding_model_id, embedding_dimensions and
+    embedding_normalize (true or false).
+    """
+    normalize = os.getenv('embedding_normalize')
+    return build_embedder(
+        os.getenv('embedding_model_id') or None,
+        int(os.getenv('embedding_dimensions')) if os.getenv('embedding_dimensions') else None,
+        normalize.lower() == 'true' if normalize else None,
+    )
+
+
+def document_embed_fn(embedder, bedrock, embedding_cache=None):
+    """
+    The function an EmbeddingExecutor calls to embed a batch of up to embedder.batch_size document texts,
+    going through the embedding cache when there is one.
+    """
+    embed_batch = lambda texts: embedder.embed_documents(bedrock, texts)
+    if embedding_cache is not None:
+        embed_batch = embedding_cache.wrap_batch(embed_batch, embedder.cache_id)
+    return embed_batch
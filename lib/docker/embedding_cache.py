@@ -0,0 +1,195 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+DEFAULT_LRU_SIZE = 2048
+DEFAULT_PERSISTENT_SIZE = 100000
+DEFAULT_TOUCH_BATCH = 256
+
+
+def normalize_text(text):
+    """
+    Normalizes text before hashing so that whitespace and unicode form differences don't cause cache misses.
+    """
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def cache_key(model_id, text):
+    """
+    Content-addressed key for an embedding: the model id and a hash of the normalized text.
+    """
+    digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+    return f"{model_id}:{digest}"
+
+
+class LruTier:
+    """
+    In-process tier, bounded by entry count and evicting the least recently used embedding.
+    """
+
+    def __init__(self, max_entries=DEFAULT_LRU_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key, embedding):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqliteTier:
+    """
+    Persistent tier in a local SQLite file. Embeddings are stored as float32 blobs and the least recently
+    used rows are evicted once the table grows past max_entries. A hit only records its time in memory; the
+    last_used column is written with the next put, or once touch_batch hits are pending, so reads don't
+    commit.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_PERSISTENT_SIZE, touch_batch=DEFAULT_TOUCH_BATCH):
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB, last_used REAL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._connection.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.touch_batch:
+                self._write_touched()
+                self._connection.commit()
+        return array('f', row[0]).tolist()
+
+    def _write_touched(self):
+        self._connection.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                     [(used, key) for key, used in self._touched.items()])
+        self._touched.clear()
+
+    def put(self, key, embedding):
+        blob = array('f', embedding).tobytes()
+        with self._lock:
+            self._touched.pop(key, None)
+            self._write_touched()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)',
+                (key, blob, time.time())
+            )
+            (count,) = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    'DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+            self._connection.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+
+class EmbeddingCache:
+    """
+    Looks embeddings up tier by tier, fastest first, and copies a hit from a slower tier into the faster ones.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.hits = 0
+        self.misses = 0
+        self.tier_hits = [0] * len(tiers)
+        self._lock = threading.Lock()
+
+    def get(self, model_id, text):
+        key = cache_key(model_id, text)
+        for position, tier in enumerate(self.tiers):
+            embedding = tier.get(key)
+            if embedding is not None:
+                for faster_tier in self.tiers[:position]:
+                    faster_tier.put(key, embedding)
+                with self._lock:
+                    self.hits += 1
+                    self.tier_hits[position] += 1
+                return embedding
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, model_id, text, embedding):
+        key = cache_key(model_id, text)
+        for tier in self.tiers:
+            tier.put(key, embedding)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'tier_hits': list(self.tier_hits),
+            'tier_sizes': [len(tier) for tier in self.tiers],
+        }
+
+    def wrap(self, embed_fn, model_id):
+        """
+        Returns a text -> embedding callable that only calls embed_fn on a cache miss.
+        """
+        def cached_embed(text):
+            embedding = self.get(model_id, text)
+            if embedding is None:
+                embedding = embed_fn(text)
+                self.put(model_id, text, embedding)
+            return embedding
+        return cached_embed
+
+    def wrap_batch(self, embed_batch_fn, model_id):
+        """
+        Returns a texts -> embeddings callable that only passes the cache misses on to embed_batch_fn.
+        """
+        def cached_embed_batch(texts):
+            embeddings = [self.get(model_id, text) for text in texts]
+            missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+            if missing:
+                for position, embedding in zip(missing, embed_batch_fn([texts[position] for position in missing])):
+                    self.put(model_id, texts[position], embedding)
+                    embeddings[position] = embedding
+            return embeddings
+        return cached_embed_batch
+
+
+def build_cache_from_env():
+    """
+    Builds the embedding cache configured by the environment:
+    embedding_cache_size bounds the in-process LRU tier, embedding_cache_path adds a SQLite tier.
+    """
+    tiers = [LruTier(int(os.getenv('embedding_cache_size', DEFAULT_LRU_SIZE)))]
+    path = os.getenv('embedding_cache_path')
+    if path:
+        tiers.append(SqliteTier(path, int(os.getenv('embedding_cache_persistent_size', DEFAULT_PERSISTENT_SIZE))))
+    return EmbeddingCache(tiers)
@@ -0,0 +1,135 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 8
+
+# Error codes Bedrock uses when a caller goes over its quota. These are retried with a smaller concurrency.
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException')
+
+
+def is_throttling_error(error):
+    """
+    Checks a botocore ClientError for a throttling code without importing botocore.
+    """
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code in THROTTLING_ERROR_CODES
+
+
+class AimdLimiter:
+    """
+    Concurrency limit that grows additively while calls succeed and shrinks multiplicatively when they are throttled.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, decrease_factor=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or maximum)
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def _adjust(self, throttled):
+        if throttled:
+            self.throttled += 1
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        else:
+            # Grow by one full slot per `limit` successes, i.e. roughly one slot per round of calls
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            self._adjust(throttled)
+            self._condition.notify_all()
+
+    def observe(self, throttled=False, successes=1):
+        """
+        Adjusts the limit without holding a slot, for a limit on something other than concurrent calls, such as
+        the documents per _bulk request: shrinks it once when throttled, grows it once per success otherwise.
+        """
+        with self._condition:
+            for _ in range(1 if throttled else successes):
+                self._adjust(throttled)
+            self._condition.notify_all()
+
+
+class EmbeddingExecutor:
+    """
+    Embeds many batches of texts concurrently while keeping the number of in-flight Bedrock calls under an AIMD
+    limit.
+    """
+
+    def __init__(self, embed_fn, concurrency=DEFAULT_CONCURRENCY, max_retries=6, base_delay=0.2, max_delay=5.0,
+                 limiter=None, deadline=None):
+        """
+        :param embed_fn: A callable that takes one batch, a list of up to embedder.batch_size texts, and returns
+            one embedding per text in the same order, see embedders.document_embed_fn. It is called once per batch
+            passed to embed_all, so a throttled call retries the whole batch
+        :param concurrency: The maximum number of concurrent embedding calls
+        :param max_retries: How often a throttled call is retried before its error is surfaced
+        :param limiter: An AimdLimiter to share with other executors, so the limit learned from throttling carries
+            over to them, a new one by default
+        :param deadline: A time.monotonic() time after which no call is started or retried, the texts left fail
+            with a TimeoutError
+        """
+        self.embed_fn = embed_fn
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = limiter or AimdLimiter(concurrency)
+        self.deadline = deadline
+
+    def _embed_with_backoff(self, batch):
+        attempt = 0
+        while True:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                raise TimeoutError('deadline passed before the batch was embedded')
+            self.limiter.acquire()
+            try:
+                embeddings = self.embed_fn(batch)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self.limiter.release(throttled=throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+                # Full jitter exponential backoff so the retries of one burst don't line up again
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if self.deadline is not None and time.monotonic() + delay >= self.deadline:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.limiter.release()
+            return embeddings
+
+    def embed_all(self, batches, return_exceptions=False):
+        """
+        Embeds every batch and returns the results of embed_fn in input order.
+        :param batches: The batches of texts to embed, one embed_fn call each
+        :param return_exceptions: Return a failed batch's exception in its slot instead of raising it
+        :return: A list with one list of embeddings (or exception) per batch
+        """
+        batches = list(batches)
+        if not batches:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as pool:
+            futures = [pool.submit(self._embed_with_backoff, batch) for batch in batches]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    results.append(e)
+            return results
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+
+from embedding_cache import normalize_text
+from opensearch_bulk import scroll_pages
+
+
+def content_hash(text):
+    """
+    Fingerprint of a chunk's text, insensitive to whitespace differences.
+    """
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    """
+    Fingerprint of a source file, used to skip files that have not changed since the last run.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_name(path, root=None):
+    """
+    The name a source file goes by in chunk ids, chunk metadata and the ingest manifest: its path relative to the
+    directory being ingested, so files with the same name in different subdirectories don't collide. A file
+    ingested on its own goes by its file name.
+    """
+    if root and os.path.isdir(root):
+        return os.path.relpath(path, root).replace(os.sep, '/')
+    return os.path.basename(path)
+
+
+def document_id(source, page, text):
+    """
+    Deterministic OpenSearch _id for a chunk, built from the source name (see source_name), the page and the
+    content hash. Re-ingesting an unchanged chunk therefore overwrites the same document instead of adding a
+    duplicate.
+    """
+    key = f"{source}:{page}:{content_hash(text)}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class IngestManifest:
+    """
+    Records, per source file, the file hash and the ids of the chunks that have been sent for indexing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.sources = json.load(f)
+
+    def is_unchanged(self, source, source_hash):
+        return self.sources.get(source, {}).get('file_hash') == source_hash
+
+    def document_ids(self, source):
+        return set(self.sources.get(source, {}).get('ids', []))
+
+    def rebuild(self, client, index):
+        """
+        Rebuilds the chunk ids of every source from the source field and _id of the documents in the index, for a
+        run that starts without the manifest of the last one, like a new container. The index has no file hashes,
+        so every file is split again once, but only the chunks missing from the index are sent and the ones that
+        are gone are deleted.
+        """
+        ids = {}
+        if client.indices.exists(index=index):
+            for hits, _ in scroll_pages(client, index, {'query': {'match_all': {}}, '_source': ['source']}):
+                for hit in hits:
+                    source = hit['_source'].get('source')
+                    if source:
+                        ids.setdefault(source, set()).add(hit['_id'])
+        self.sources = {source: {'file_hash': None, 'ids': sorted(source_ids)} for source, source_ids in ids.items()}
+
+    def update(self, source, source_hash, ids):
+        self.sources[source] = {'file_hash': source_hash, 'ids': sorted(ids)}
+
+    def save(self):
+        if not self.path:
+            return
+        # write then rename, so an interrupted run never leaves a truncated manifest behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.sources, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,242 @@
+import copy
+import hashlib
+import json
+import logging
+import time
+
+import embedders
+
+logger = logging.getLogger(__name__)
+
+ENGINE_SPACE_TYPES = {
+    'nmslib': ('l2', 'innerproduct', 'cosinesimil', 'l1', 'linf'),
+    'faiss': ('l2', 'innerproduct', 'cosinesimil'),
+}
+# fp16 is faiss' scalar quantization encoder. The byte vector data type is left out: the writers index the
+# embedding model's floats, which a byte field would reject
+ENGINE_QUANTIZATION = {
+    'nmslib': (),
+    'faiss': ('fp16',),
+}
+
+# Named profiles, from the fastest to the most accurate. A profile key left out (or None) is not sent,
+# so OpenSearch applies its own default; "default" is the mapping the index was always created with.
+PROFILES = {
+    'default': {'engine': 'nmslib'},
+    'low-latency': {'engine': 'faiss', 'space_type': 'l2', 'm': 8, 'ef_construction': 64, 'ef_search': 32},
+    'balanced': {'engine': 'faiss', 'space_type': 'l2', 'm': 16, 'ef_construction': 128, 'ef_search': 100},
+    'high-recall': {'engine': 'faiss', 'space_type': 'l2', 'm': 32, 'ef_construction': 256, 'ef_search': 256},
+    # half the vector memory for a small recall loss
+    'compact-fp16': {'engine': 'faiss', 'space_type': 'l2', 'm': 16, 'ef_construction': 128, 'ef_search': 100,
+                     'quantization': 'fp16'},
+}
+# Engines that apply a knn clause's filter while they search the graph (efficient filtering). nmslib rejects a
+# filter inside the knn clause, its nearest hits can only be filtered afterwards
+KNN_FILTER_ENGINES = ('faiss', 'lucene')
+# How long a knn filter support answer is reused before the mapping behind the alias is read again
+DEFAULT_KNN_FILTER_CHECK_SECONDS = 60
+PROFILE_KEYS = ('engine', 'space_type', 'm', 'ef_construction', 'ef_search', 'quantization', 'dimension')
+
+
+def resolve_profile(profile=None):
+    """
+    Turns a profile name, or a dict of profile keys with an optional "base" profile name, into the full profile.
+    """
+    if profile is None or isinstance(profile, str):
+        profile = {'base': profile or 'default'}
+    base = profile.get('base', 'default')
+    if base not in PROFILES:
+        raise ValueError(f"Unknown index profile {base!r}, expected one of {sorted(PROFILES)}")
+    unknown = set(profile) - set(PROFILE_KEYS) - {'base'}
+    if unknown:
+        raise ValueError(f"Unknown index profile keys {sorted(unknown)}")
+    resolved = dict(PROFILES[base])
+    resolved.update({key: value for key, value in profile.items() if key != 'base'})
+
+    engine = resolved.get('engine', 'nmslib')
+    if engine not in ENGINE_SPACE_TYPES:
+        raise ValueError(f"Unsupported engine {engine!r}, expected one of {sorted(ENGINE_SPACE_TYPES)}")
+    if resolved.get('space_type') and resolved['space_type'] not in ENGINE_SPACE_TYPES[engine]:
+        raise ValueError(f"The {engine} engine does not support the {resolved['space_type']} space type")
+    if resolved.get('quantization') and resolved['quantization'] not in ENGINE_QUANTIZATION[engine]:
+        raise ValueError(f"The {engine} engine does not support {resolved['quantization']} quantization")
+    return resolved
+
+
+def build_index_body(profile=None, embedder=None, vector_field='vector_field'):
+    """
+    Builds the settings and mappings of the vector index for a profile and the embedder that fills it.
+    The vector dimension is the embedder's output size unless the profile sets one, and the embedder is
+    recorded in the mapping's _meta, so vectors of different models never end up in the same index.
+    """
+    embedder = embedder or embedders.build_embedder()
+    profile = resolve_profile(profile)
+    engine = profile.get('engine', 'nmslib')
+    parameters = {key: profile[key] for key in ('m', 'ef_construction') if profile.get(key) is not None}
+    index_settings = {'knn': True}
+    if profile.get('ef_search') is not None:
+        if engine == 'faiss':
+            parameters['ef_search'] = profile['ef_search']
+        else:
+            # nmslib takes ef_search from the index settings instead of the method
+            index_settings['knn.algo_param.ef_search'] = profile['ef_search']
+    if profile.get('quantization') == 'fp16':
+        parameters['encoder'] = {'name': 'sq', 'parameters': {'type': 'fp16'}}
+
+    method = {'engine': engine, 'name': 'hnsw'}
+    if profile.get('space_type'):
+        method['space_type'] = profile['space_type']
+    if parameters:
+        method['parameters'] = parameters
+    vector_mapping = {
+        'type': 'knn_vector',
+        'dimension': int(profile.get('dimension') or embedder.dimension),
+        'method': method,
+    }
+    return {
+        'settings': {'index': index_settings},
+        'mappings': {
+            '_meta': {'embedder': embedder.cache_id},
+            'properties': {
+                'text': {'type': 'text'},
+                # chunk metadata, for citing pages and for filtered searches (retrieval.search_filter)
+                'source': {'type': 'keyword'},
+                'section': {'type': 'keyword'},
+                'page': {'type': 'integer'},
+                vector_field: vector_mapping,
+            }
+        }
+    }
+
+
+def supports_knn_filter(client, index, vector_field='vector_field'):
+    """
+    :param index: An index, or an alias
+    :return: True when every index it names has an engine in KNN_FILTER_ENGINES for the vector field
+    """
+    engines = {
+        description.get('mappings', {}).get('properties', {}).get(vector_field, {}).get('method', {}).get('engine',
+                                                                                                         'nmslib')
+        for description in client.indices.get(index=index).values()
+    }
+    return bool(engines) and engines <= set(KNN_FILTER_ENGINES)
+
+
+class KnnFilterSupport:
+    """
+    supports_knn_filter for an alias, read again at most once every ttl seconds, so a reindex onto another engine
+    is picked up without reading the mapping for every query. A failed read keeps the last answer, False before
+    the first one: post-filtering works on every engine.
+    """
+
+    def __init__(self, client, index, vector_field='vector_field', ttl=DEFAULT_KNN_FILTER_CHECK_SECONDS):
+        self.client = client
+        self.index = index
+        self.vector_field = vector_field
+        self.ttl = ttl
+        self._supported = False
+        self._expires = 0.0
+
+    def __call__(self):
+        now = time.monotonic()
+        if now >= self._expires:
+            try:
+                self._supported = supports_knn_filter(self.client, self.index, self.vector_field)
+            except Exception as e:
+                logger.warning(f"Could not read the knn engine of {self.index}: {e}")
+            self._expires = now + self.ttl
+        return self._supported
+
+
+def memory_per_vector(dimension, profile=None):
+    """
+    Estimated native memory one vector takes in the HNSW graph, after the k-NN plugin's sizing guide:
+    1.1 * (bytes per vector + 8 * m).
+    """
+    profile = resolve_profile(profile)
+    bytes_per_value = 2 if profile.get('quantization') == 'fp16' else 4
+    return round(1.1 * (bytes_per_value * dimension + 8 * (profile.get('m') or 16)))
+
+
+def versioned_index_name(alias, body):
+    """
+    Names the concrete index behind the alias after its settings and mappings, so rebuilding with an
+    unchanged profile resolves to the index that already exists.
+    """
+    fingerprint = hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+    return f"{alias}-{fingerprint}"
+
+
+def alias_targets(client, alias):
+    """
+    :return: The indices the alias points to, an empty list when there is no such alias
+    """
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias))
+
+
+def ensure_index(client, name, body):
+    """
+    Creates the index unless it exists.
+    :return: True when the index was created
+    """
+    if client.indices.exists(index=name):
+        return False
+    client.indices.create(index=name, body=copy.deepcopy(body))
+    return True
+
+
+def swap_alias(client, alias, index_name):
+    """
+    Points the alias at index_name, removing it from every other index in the same atomic request.
+    When the alias' name is still held by a concrete index, from before the index was versioned, that index is
+    removed in the same request, so searches go from the old index to the new one without a gap.
+    :return: The indices the alias pointed to before
+    """
+    previous = alias_targets(client, alias)
+    actions = [{'remove': {'index': old, 'alias': alias}} for old in previous if old != index_name]
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    if not previous and client.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+        previous = [alias]
+    client.indices.update_aliases(body={'actions': actions})
+    return previous
+
+
+def live_document_count(client, alias):
+    """
+    :return: The number of documents searches through the alias see: in the indices it points to, or in a
+        concrete index holding its name
+    """
+    targets = alias_targets(client, alias)
+    if not targets and client.indices.exists(index=alias):
+        targets = [alias]
+    return sum(client.count(index=name)['count'] for name in targets)
+
+
+def build_index(client, alias, profile=None, embedder=None, vector_field='vector_field'):
+    """
+    Builds the index for the profile. The alias is only pointed at it while the index the alias points to is
+    empty (a new stack, or a profile changed before anything was ingested): otherwise searches would go to an
+    empty index, so the new one is left for reindex.py to backfill, validate and switch the alias to.
+    The previous index is left in place, to be backfilled from or rolled back to, and is removed when the stack
+    is deleted.
+    :return: (the concrete index name, the indices the alias points to before, True when the alias was swapped)
+    """
+    body = build_index_body(profile, embedder, vector_field)
+    index_name = versioned_index_name(alias, body)
+    previous = alias_targets(client, alias)
+    if previous == [index_name]:
+        logger.info(f"{alias} already points to {index_name}")
+        return index_name, previous, False
+    if ensure_index(client, index_name, body):
+        logger.info(f"Created {index_name}")
+    live = live_document_count(client, alias)
+    if live:
+        logger.warning(f"{alias} still points to {previous or alias} ({live} documents). Backfill {index_name} and "
+                       f"switch the alias with reindex.py --copy (or --source when the embedder changed)")
+        return index_name, previous, False
+    swap_alias(client, alias, index_name)
+    logger.info(f"Swapped {alias} from {previous} to {index_name}")
+    return index_name, previous, True
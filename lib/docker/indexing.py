@@ -0,0 +1,51 @@
+import os
+
+from opensearch_bulk import BulkItem
+
+
+# Chunk metadata stored next to the text, see the mapping in index_profiles.build_index_body
+METADATA_FIELDS = ('source', 'section', 'page')
+
+
+def build_document(vectors, text, vector_field=None, metadata=None):
+    """
+    Builds the OpenSearch document for one chunk.
+    :param vectors: The embedding of the chunk
+    :param text: The text data of the chunk
+    :param vector_field: The knn_vector field name, defaults to the vector_field_name environment variable
+    :param metadata: The source file name, section heading and page number of the chunk, the ones that are set
+        are stored so searches can be filtered on them
+    """
+    document = {
+        vector_field or os.getenv("vector_field_name"): vectors,
+        'text': text
+    }
+    for field in METADATA_FIELDS:
+        if (metadata or {}).get(field) is not None:
+            document[field] = metadata[field]
+    return document
+
+
+def embed_items(executor, chunks, vector_field=None, batch_size=1):
+    """
+    Embeds chunks concurrently and turns them into bulk index items.
+    :param executor: An EmbeddingExecutor whose embed_fn takes a list of texts, see embedders.document_embed_fn
+    :param chunks: A list of (key, text, doc_id) or (key, text, doc_id, metadata) tuples, key is the caller's
+        handle for the chunk
+    :param batch_size: The number of texts per embedding call, the embedder's batch_size
+    :return: The BulkItems for the chunks that were embedded, and a list of (key, error) for the ones that were not
+    """
+    texts = [chunk[1] for chunk in chunks]
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    embeddings = []
+    # a failed call fails every chunk of its batch
+    for batch, result in zip(batches, executor.embed_all(batches, return_exceptions=True)):
+        embeddings.extend([result] * len(batch) if isinstance(result, Exception) else result)
+    items = []
+    failures = []
+    for (key, text, doc_id, *metadata), vectors in zip(chunks, embeddings):
+        if isinstance(vectors, Exception):
+            failures.append((key, vectors))
+            continue
+        items.append(BulkItem(key, build_document(vectors, text, vector_field, *metadata), doc_id))
+    return items, failures
@@ -0,0 +1,157 @@
+import glob
+import json
+import os
+import random
+import time
+
+# SQS limits for a single SendMessageBatch call
+SQS_MAX_BATCH_MESSAGES = 10
+SQS_MAX_BATCH_BYTES = 256 * 1024
+
+# Same default pattern PyPDFDirectoryLoader uses: every PDF below the directory, skipping hidden files
+PDF_GLOB = '**/[!.]*.pdf'
+
+
+def build_text_splitter(kind=None):
+    """
+    Builds the chunker set by the chunker environment variable: structured (default) splits at headings, lists
+    and pages into chunks of up to chunk_tokens tokens (see chunking.py), recursive is the previous
+    character-based splitter, kept for comparison.
+    """
+    kind = kind or os.getenv('chunker', 'structured')
+    if kind == 'structured':
+        from chunking import StructuredTextSplitter, DEFAULT_CHUNK_TOKENS, DEFAULT_MIN_TOKENS
+
+        return StructuredTextSplitter(chunk_tokens=int(os.getenv('chunk_tokens', DEFAULT_CHUNK_TOKENS)),
+                                      min_tokens=int(os.getenv('chunk_min_tokens', DEFAULT_MIN_TOKENS)))
+    if kind == 'recursive':
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        return RecursiveCharacterTextSplitter(chunk_size=600, chunk_overlap=100)
+    raise ValueError(f"Unknown chunker {kind!r}, expected structured or recursive")
+
+
+def list_pdfs(path):
+    """
+    Resolves a PDF file or a directory of PDFs into the list of files to ingest.
+    """
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, PDF_GLOB), recursive=True))
+    return [path]
+
+
+def iter_pages(path):
+    """
+    Yields the pages of a PDF one at a time instead of loading the whole document up front.
+    """
+    from langchain.document_loaders import PyPDFLoader
+
+    yield from PyPDFLoader(path).lazy_load()
+
+
+def page_count(path):
+    from pypdf import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+def plan_tasks(files, pages_per_task):
+    """
+    Cuts every PDF into page ranges, so a single large file is still parsed by several workers.
+    """
+    tasks = []
+    for path in files:
+        pages = page_count(path)
+        tasks.extend((path, start, min(start + pages_per_task, pages)) for start in range(0, pages, pages_per_task))
+    return tasks
+
+
+def iter_page_range(path, start, stop):
+    """
+    Yields pages start..stop-1 of a PDF as documents shaped like PyPDFLoader's, so that several workers
+    can parse different parts of the same file.
+    """
+    from pypdf import PdfReader
+    from langchain.schema import Document
+
+    reader = PdfReader(path)
+    for page_number in range(start, min(stop, len(reader.pages))):
+        text = reader.pages[page_number].extract_text()
+        yield Document(page_content=text, metadata={'source': path, 'page': page_number})
+
+
+def iter_chunks(pages, text_splitter):
+    """
+    Splits each page as soon as it has been parsed, so only one page's chunks are held in memory.
+    """
+    for page in pages:
+        yield from text_splitter.split_documents([page])
+
+
+class SqsBatchSender:
+    """
+    Buffers messages and sends them with SendMessageBatch once the buffer reaches the SQS message or byte limit.
+    A call that raises and the entries SQS fails on its side are retried with full jitter backoff; entries that
+    still fail, or that fail because of the message itself, are recorded in failed as (body, error).
+    """
+
+    def __init__(self, sqs, queue_url, max_messages=SQS_MAX_BATCH_MESSAGES, max_bytes=SQS_MAX_BATCH_BYTES,
+                 max_attempts=4, base_delay=0.2, max_delay=5.0):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sent = 0
+        self.failed = []
+        self.batches = 0
+        self._entries = []
+        self._size = 0
+
+    def send(self, message):
+        body = json.dumps(message)
+        size = len(body.encode('utf-8'))
+        if self._entries and (len(self._entries) >= self.max_messages or self._size + size > self.max_bytes):
+            self.flush()
+        self._entries.append({'Id': str(len(self._entries)), 'MessageBody': body})
+        self._size += size
+
+    def flush(self):
+        if not self._entries:
+            return
+        entries = self._entries
+        self._entries = []
+        self._size = 0
+        errors = {}
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))))
+            try:
+                response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                errors = {entry['Id']: str(e) for entry in entries}
+                continue
+            self.batches += 1
+            self.sent += len(response.get('Successful', []))
+            by_id = {entry['Id']: entry for entry in entries}
+            errors = {}
+            retry = []
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    # the message itself was rejected, sending it again fails the same way
+                    self.failed.append((by_id[failure['Id']]['MessageBody'], failure.get('Message')))
+                else:
+                    errors[failure['Id']] = failure.get('Message')
+                    retry.append(by_id[failure['Id']])
+            entries = retry
+            if not entries:
+                return
+        self.failed.extend((entry['MessageBody'], errors.get(entry['Id'])) for entry in entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
@@ -0,0 +1,149 @@
+"""
+A small pure-Python HNSW graph, so the local OpenSearch stand-in answers kNN queries approximately, the way
+the engines do. Its recall responds to m, ef_construction, ef_search and quantization like the real index,
+which is what lets index profiles be compared locally. It is far slower than faiss or nmslib.
+"""
+import heapq
+import math
+import operator
+import random
+import struct
+
+
+def dot(a, b):
+    return sum(map(operator.mul, a, b))
+
+
+def l2_squared(a, b):
+    return sum((x - y) * (x - y) for x, y in zip(a, b))
+
+
+# The distance each space type orders by, and the score OpenSearch reports for that distance
+SPACES = {
+    'l2': (l2_squared, lambda distance: 1 / (1 + distance)),
+    'innerproduct': (lambda a, b: -dot(a, b),
+                     lambda distance: 1 - distance if distance <= 0 else 1 / (1 + distance)),
+    'cosinesimil': (lambda a, b: 1 - dot(a, b) / (math.sqrt(dot(a, a) * dot(b, b)) or 1),
+                    lambda distance: (2 - distance) / 2),
+}
+
+
+def quantize(vector, quantization=None):
+    """
+    Rounds a vector the way the index stores it: fp16 through half precision floats.
+    """
+    if quantization == 'fp16':
+        return list(struct.unpack(f'{len(vector)}e', struct.pack(f'{len(vector)}e', *vector)))
+    return list(vector)
+
+
+class HnswGraph:
+    """
+    Hierarchical navigable small world graph over vectors keyed by document id. Deleting rebuilds the graph.
+    """
+
+    def __init__(self, space_type='l2', m=16, ef_construction=100, ef_search=100, seed=0):
+        self.distance, self.score = SPACES[space_type]
+        self.m = m
+        self.max_neighbours = {0: 2 * m}
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_factor = 1 / math.log(max(m, 2))
+        self.vectors = {}
+        self.layers = []
+        self.entry = None
+        self.distance_computations = 0
+        self._random = random.Random(seed)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def _distance(self, query, key):
+        self.distance_computations += 1
+        return self.distance(query, self.vectors[key])
+
+    def _search_layer(self, query, entries, ef, layer):
+        """
+        Greedy best-first search of one layer.
+        :return: Up to ef (distance, key) pairs, closest first
+        """
+        visited = set(entries)
+        candidates = [(self._distance(query, key), key) for key in entries]
+        heapq.heapify(candidates)
+        # max-heap of the best ef found so far, as (-distance, key)
+        found = [(-distance, key) for distance, key in candidates]
+        heapq.heapify(found)
+        while len(found) > ef:
+            heapq.heappop(found)
+        while candidates:
+            distance, key = heapq.heappop(candidates)
+            if distance > -found[0][0]:
+                break
+            for neighbour in self.layers[layer].get(key, ()):
+                if neighbour in visited:
+                    continue
+                visited.add(neighbour)
+                neighbour_distance = self._distance(query, neighbour)
+                if len(found) < ef or neighbour_distance < -found[0][0]:
+                    heapq.heappush(candidates, (neighbour_distance, neighbour))
+                    heapq.heappush(found, (-neighbour_distance, neighbour))
+                    if len(found) > ef:
+                        heapq.heappop(found)
+        return sorted((-distance, key) for distance, key in found)
+
+    def add(self, key, vector):
+        if key in self.vectors:
+            self.remove(key)
+        self.vectors[key] = vector
+        level = int(-math.log(1 - self._random.random()) * self.level_factor)
+        top = len(self.layers) - 1
+        while len(self.layers) <= level:
+            self.layers.append({})
+        for layer in range(level + 1):
+            self.layers[layer][key] = []
+        if self.entry is None:
+            self.entry = key
+            return
+
+        # descend greedily through the layers above the new node's, then link it on each of its layers
+        entries = [self.entry]
+        for layer in range(top, level, -1):
+            entries = [self._search_layer(vector, entries, 1, layer)[0][1]]
+        for layer in range(min(level, top), -1, -1):
+            found = self._search_layer(vector, entries, self.ef_construction, layer)
+            limit = self.max_neighbours.get(layer, self.m)
+            neighbours = [other for _, other in found if other != key][:self.m]
+            self.layers[layer][key] = neighbours
+            for neighbour in neighbours:
+                links = self.layers[layer][neighbour]
+                links.append(key)
+                if len(links) > limit:
+                    links.sort(key=lambda other: self.distance(self.vectors[neighbour], self.vectors[other]))
+                    del links[limit:]
+            entries = [other for _, other in found]
+        if level > top:
+            self.entry = key
+
+    def remove(self, key):
+        vectors = self.vectors
+        vectors.pop(key, None)
+        self.vectors, self.layers, self.entry = {}, [], None
+        for other, vector in vectors.items():
+            self.add(other, vector)
+
+    def search(self, query, k, ef=None, keys=None):
+        """
+        :param keys: Only search these vectors, which are compared exactly instead of walking the graph; that is how
+            the k-NN plugin answers a filtered search when the filter matches few documents
+        :return: Up to k (score, key) pairs, best first
+        """
+        if keys is not None:
+            found = sorted((self._distance(query, key), key) for key in keys if key in self.vectors)
+            return [(self.score(distance), key) for distance, key in found[:k]]
+        if self.entry is None:
+            return []
+        entries = [self.entry]
+        for layer in range(len(self.layers) - 1, 0, -1):
+            entries = [self._search_layer(query, entries, 1, layer)[0][1]]
+        found = self._search_layer(query, entries, max(ef or self.ef_search, k), 0)
+        return [(self.score(distance), key) for distance, key in found[:k]]
@@ -0,0 +1,571 @@
+"""
+In-process stand-ins for Amazon Bedrock and OpenSearch, so the ingest and query paths can be run and
+benchmarked without AWS. They implement only the subset of each client's API that this project calls.
+"""
+import fnmatch
+import hashlib
+import io
+import itertools
+import json
+import math
+import random
+import re
+import uuid
+import threading
+import time
+
+from answer_cache import cosine_similarity
+from local_ann import HnswGraph, quantize
+from retrieval import bm25_scores
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def fake_embedding(text, dimension=1536):
+    """
+    Deterministic embedding built by hashing each word into one of `dimension` signed buckets.
+    Texts that share words end up close to each other, which is enough for retrieval to behave sensibly.
+    """
+    vector = [0.0] * dimension
+    for token in tokenize(text):
+        digest = int(hashlib.md5(token.encode('utf-8')).hexdigest(), 16)
+        vector[digest % dimension] += 1.0 if (digest >> 64) & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return [value / norm for value in vector]
+
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def matches_filter(source, clause):
+    """
+    Whether a document matches an OpenSearch filter clause. Supports bool, term, terms, range and match_all.
+    """
+    (kind, params), = clause.items()
+    if kind == 'match_all':
+        return True
+    if kind == 'bool':
+        return (all(matches_filter(source, inner) for key in ('filter', 'must') for inner in as_list(params.get(key, [])))
+                and not any(matches_filter(source, inner) for inner in as_list(params.get('must_not', [])))
+                and (not params.get('should') or any(matches_filter(source, inner) for inner in as_list(params['should']))))
+    (field, value), = params.items()
+    actual = source.get(field)
+    if kind == 'term':
+        return actual == (value['value'] if isinstance(value, dict) else value)
+    if kind == 'terms':
+        return actual in value
+    if kind == 'range':
+        if actual is None:
+            return False
+        checks = {'gt': actual.__gt__, 'gte': actual.__ge__, 'lt': actual.__lt__, 'lte': actual.__le__}
+        return all(checks[operator](bound) for operator, bound in value.items() if operator in checks)
+    raise ValueError(f"Unsupported filter clause {kind!r}")
+
+
+class FakeThrottlingError(Exception):
+    """
+    Shaped like a botocore ClientError, so is_throttling_error recognizes it.
+    """
+
+    def __init__(self, operation):
+        super().__init__(f"An error occurred (ThrottlingException) when calling the {operation} operation: Rate exceeded")
+        self.response = {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}
+
+
+class FakeBedrockRuntime:
+    """
+    Stand-in for the bedrock-runtime client with an injectable per-call latency. converse_latency, when given,
+    replaces latency for the converse calls, which take far longer than embedding calls.
+    Throttling is simulated two ways: a call made while max_concurrency calls are already in flight is rejected,
+    the way a model's concurrency quota rejects it, and throttle_rate rejects that fraction of the calls at random.
+    """
+
+    def __init__(self, dimension=1536, latency=0.0, answer=None, converse_latency=None, max_concurrency=None,
+                 throttle_rate=0.0, seed=0):
+        self.dimension = dimension
+        self.latency = latency
+        self.converse_latency = latency if converse_latency is None else converse_latency
+        self.answer = answer or 'Question 1) This is a canned answer from the local Bedrock stand-in.'
+        self.max_concurrency = max_concurrency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self.throttled = 0
+        self._in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _admit(self, operation):
+        """
+        Counts the call, or raises a throttling error when it is over the simulated quota.
+        """
+        with self._lock:
+            self.calls += 1
+            if ((self.max_concurrency is not None and self._in_flight >= self.max_concurrency)
+                    or (self.throttle_rate and self._random.random() < self.throttle_rate)):
+                self.throttled += 1
+                raise FakeThrottlingError(operation)
+
+    def _call(self, latency, operation):
+        self._admit(operation)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            if latency:
+                time.sleep(latency)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def invoke_model(self, body, modelId, accept='application/json', contentType='application/json'):
+        self._call(self.latency, 'InvokeModel')
+        request = json.loads(body)
+        if 'texts' in request:
+            # Cohere embed: a batch of texts in, 1024 dimensions out
+            response_body = {'embeddings': [fake_embedding(text, 1024) for text in request['texts']],
+                             'texts': request['texts']}
+        else:
+            # Titan: v2 takes the output dimensions in the request
+            text = request['inputText']
+            response_body = {'embedding': fake_embedding(text, request.get('dimensions', self.dimension)),
+                             'inputTextTokenCount': len(tokenize(text))}
+        return {'body': io.BytesIO(json.dumps(response_body).encode('utf-8'))}
+
+    def _converse_response(self, messages):
+        prompt_tokens = sum(len(tokenize(block.get('text', ''))) for message in messages for block in message['content'])
+        return {
+            'output': {'message': {'role': 'assistant', 'content': [{'text': self.answer}]}},
+            'usage': {'inputTokens': prompt_tokens, 'outputTokens': len(tokenize(self.answer)),
+                      'totalTokens': prompt_tokens + len(tokenize(self.answer))},
+            'metrics': {'latencyMs': int(self.converse_latency * 1000)},
+            'stopReason': 'end_turn',
+        }
+
+    def converse(self, modelId, messages, **kwargs):
+        self._call(self.converse_latency, 'Converse')
+        return self._converse_response(messages)
+
+    def converse_stream(self, modelId, messages, **kwargs):
+        """
+        Streams the canned answer word by word, spreading the configured latency over the chunks.
+        """
+        self._admit('ConverseStream')
+        response = self._converse_response(messages)
+        words = self.answer.split(' ')
+
+        def events():
+            yield {'messageStart': {'role': 'assistant'}}
+            for position, word in enumerate(words):
+                if self.converse_latency:
+                    time.sleep(self.converse_latency / len(words))
+                text = word if position == 0 else ' ' + word
+                yield {'contentBlockDelta': {'delta': {'text': text}, 'contentBlockIndex': 0}}
+            yield {'messageStop': {'stopReason': 'end_turn'}}
+            yield {'metadata': {'usage': response['usage'], 'metrics': response['metrics']}}
+
+        return {'stream': events()}
+
+
+class FakeSqs:
+    """
+    Stand-in for the SQS client: one in-memory queue per URL, with an injectable per-call latency.
+    A received message stays in flight until it is deleted or its visibility timeout runs out (visibility_timeout
+    seconds, or the receive's or the last change_message_visibility's timeout), then it is visible again;
+    expire_in_flight runs out every timeout at once. With max_receive_count, a message that has been received that
+    many times goes to the queue's dead letters instead, like a redrive policy.
+    """
+
+    def __init__(self, latency=0.0, max_receive_count=None, visibility_timeout=30.0):
+        self.latency = latency
+        self.max_receive_count = max_receive_count
+        self.visibility_timeout = visibility_timeout
+        self.queues = {}
+        # receipt handle -> (queue url, message, time.monotonic() it becomes visible again)
+        self.in_flight = {}
+        self.dead_letters = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _queue(self, url):
+        return self.queues.setdefault(url, [])
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        return self.send_message_batch(QueueUrl, [{'Id': '0', 'MessageBody': MessageBody}])['Successful'][0]
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call()
+        successful = []
+        with self._lock:
+            for entry in Entries:
+                message = {'MessageId': str(uuid.uuid4()), 'Body': entry['MessageBody'], 'ReceiveCount': 0,
+                           'MessageAttributes': entry.get('MessageAttributes', {})}
+                self._queue(QueueUrl).append(message)
+                successful.append({'Id': entry['Id'], 'MessageId': message['MessageId']})
+        return {'Successful': successful, 'Failed': []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=None, **kwargs):
+        self._call()
+        now = time.monotonic()
+        self._release([receipt for receipt, (url, _, visible_at) in list(self.in_flight.items())
+                       if url == QueueUrl and visible_at <= now])
+        timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        with self._lock:
+            queue = self._queue(QueueUrl)
+            received, queue[:] = queue[:MaxNumberOfMessages], queue[MaxNumberOfMessages:]
+            messages = []
+            for message in received:
+                message['ReceiveCount'] += 1
+                receipt = str(uuid.uuid4())
+                self.in_flight[receipt] = (QueueUrl, message, now + timeout)
+                messages.append({'MessageId': message['MessageId'], 'ReceiptHandle': receipt, 'Body': message['Body'],
+                                 'Attributes': {'ApproximateReceiveCount': str(message['ReceiveCount'])}})
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.delete_message_batch(QueueUrl, [{'Id': '0', 'ReceiptHandle': ReceiptHandle}])
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call()
+        with self._lock:
+            for entry in Entries:
+                self.in_flight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        self.change_message_visibility_batch(QueueUrl, [
+            {'Id': '0', 'ReceiptHandle': ReceiptHandle, 'VisibilityTimeout': VisibilityTimeout}])
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        """
+        A timeout of 0 makes a message visible again right away, any other one from now on.
+        """
+        self._call()
+        now = time.monotonic()
+        successful, failed, released = [], [], []
+        with self._lock:
+            for entry in Entries:
+                receipt = entry['ReceiptHandle']
+                if receipt not in self.in_flight:
+                    failed.append({'Id': entry['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                    continue
+                url, message, _ = self.in_flight[receipt]
+                self.in_flight[receipt] = (url, message, now + entry['VisibilityTimeout'])
+                if entry['VisibilityTimeout'] == 0:
+                    released.append(receipt)
+                successful.append({'Id': entry['Id']})
+        self._release(released)
+        return {'Successful': successful, 'Failed': failed}
+
+    def _release(self, receipts):
+        with self._lock:
+            for receipt in receipts:
+                url, message, _ = self.in_flight.pop(receipt, (None, None, None))
+                if message is None:
+                    continue
+                if self.max_receive_count is not None and message['ReceiveCount'] >= self.max_receive_count:
+                    self.dead_letters.setdefault(url, []).append(message)
+                else:
+                    self._queue(url).append(message)
+
+    def expire_in_flight(self):
+        self._release(list(self.in_flight))
+
+    def approximate_count(self, QueueUrl):
+        return len(self.queues.get(QueueUrl, []))
+
+
+class FakeIndices:
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, index, body=None):
+        with self.store.lock:
+            if index in self.store.documents or index in self.store.aliases:
+                raise ValueError(f"resource_already_exists_exception: index [{index}] already exists")
+            self.store.documents[index] = {}
+            self.store.settings[index] = body or {}
+            self.store.graphs[index] = vector_graphs(body or {}) if self.store.approximate else {}
+        return {'acknowledged': True, 'index': index}
+
+    def delete(self, index):
+        with self.store.lock:
+            self.store.documents.pop(index, None)
+            self.store.settings.pop(index, None)
+            self.store.graphs.pop(index, None)
+            for targets in self.store.aliases.values():
+                targets.discard(index)
+        return {'acknowledged': True}
+
+    def exists(self, index):
+        return index in self.store.documents or bool(self.store.aliases.get(index))
+
+    def get(self, index, ignore_unavailable=False):
+        names = set()
+        for pattern in index.split(','):
+            matches = [name for name in self.store.documents if fnmatch.fnmatch(name, pattern)]
+            matches += self.store.aliases.get(pattern, [])
+            if not matches and '*' not in pattern and not ignore_unavailable:
+                raise KeyError(f"index_not_found_exception: no such index [{pattern}]")
+            names.update(matches)
+        return {name: {'settings': self.store.settings[name].get('settings', {}),
+                       'mappings': self.store.settings[name].get('mappings', {})} for name in names}
+
+    def exists_alias(self, name):
+        return bool(self.store.aliases.get(name))
+
+    def get_alias(self, name):
+        return {index: {'aliases': {name: {}}} for index in sorted(self.store.aliases.get(name, []))}
+
+    def update_aliases(self, body):
+        with self.store.lock:
+            for action in body['actions']:
+                (kind, params), = action.items()
+                if kind == 'add':
+                    if params['index'] not in self.store.documents:
+                        raise KeyError(f"index_not_found_exception: no such index [{params['index']}]")
+                    self.store.aliases.setdefault(params['alias'], set()).add(params['index'])
+                elif kind == 'remove_index':
+                    self.store.documents.pop(params['index'], None)
+                    self.store.settings.pop(params['index'], None)
+                    self.store.graphs.pop(params['index'], None)
+                else:
+                    self.store.aliases.get(params['alias'], set()).discard(params['index'])
+        return {'acknowledged': True}
+
+    def refresh(self, index=None):
+        return {'_shards': {'failed': 0}}
+
+
+def vector_graphs(body):
+    """
+    HNSW graphs for the knn_vector fields of an index mapping, with the parameters and quantization it declares.
+    :return: {field: (graph, quantization)}
+    """
+    graphs = {}
+    for field, mapping in body.get('mappings', {}).get('properties', {}).items():
+        method = mapping.get('method')
+        if mapping.get('type') != 'knn_vector' or not method:
+            continue
+        parameters = method.get('parameters', {})
+        ef_search = parameters.get('ef_search') or body.get('settings', {}).get('index', {}).get('knn.algo_param.ef_search')
+        encoder = parameters.get('encoder', {}).get('parameters', {}).get('type')
+        graph = HnswGraph(method.get('space_type', 'l2'), m=parameters.get('m', 16),
+                          ef_construction=parameters.get('ef_construction', 100), ef_search=ef_search or 100)
+        graphs[field] = (graph, encoder)
+    return graphs
+
+
+class FakeOpenSearch:
+    """
+    Stand-in for the opensearch-py client: documents are kept in dicts and kNN search is brute force.
+    With approximate=True, indices created with a kNN mapping are searched through an HNSW graph built with the
+    mapping's parameters instead, which is much slower to write to but has the recall of a real index.
+    """
+
+    def __init__(self, latency=0.0, approximate=False, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.approximate = approximate
+        # fraction of the bulk items rejected with a 429, like a collection that is scaling up its indexing capacity
+        self.throttle_rate = throttle_rate
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self.documents = {}
+        self.settings = {}
+        self.aliases = {}
+        self.graphs = {}
+        # scroll id -> (hits not handed out yet, page size)
+        self.scrolls = {}
+        self.lock = threading.Lock()
+        self.indices = FakeIndices(self)
+        self._ids = itertools.count()
+
+    def _call(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _resolve(self, index):
+        """
+        The concrete index a write goes to: the index itself or the one index behind an alias.
+        """
+        targets = self.aliases.get(index)
+        if not targets:
+            return index
+        if len(targets) > 1:
+            raise ValueError(f"illegal_argument_exception: alias [{index}] has more than one index to write to")
+        return next(iter(targets))
+
+    def _targets(self, index):
+        return sorted(self.aliases.get(index) or [index])
+
+    def _index(self, index):
+        return self.documents.setdefault(index, {})
+
+    def _store(self, index, doc_id, source):
+        self._index(index)[doc_id] = source
+        for field, (graph, quantization) in self.graphs.get(index, {}).items():
+            if field in source:
+                graph.add(doc_id, quantize(source[field], quantization))
+
+    def _remove(self, index, doc_id):
+        found = self._index(index).pop(doc_id, None) is not None
+        for graph, _ in self.graphs.get(index, {}).values():
+            if doc_id in graph.vectors:
+                graph.remove(doc_id)
+        return found
+
+    def index(self, index, body, id=None, refresh=False):
+        self._call()
+        with self.lock:
+            index = self._resolve(index)
+            doc_id = id or f"auto-{next(self._ids)}"
+            self._store(index, doc_id, body)
+        return {'_index': index, '_id': doc_id, 'result': 'created'}
+
+    def bulk(self, body, index=None, refresh=False):
+        self._call()
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()] if isinstance(body, str) else body
+        items = []
+        position = 0
+        with self.lock:
+            while position < len(lines):
+                (op_type, meta), = lines[position].items()
+                target = self._resolve(meta.get('_index', index))
+                doc_id = meta.get('_id') or f"auto-{next(self._ids)}"
+                if self.throttle_rate and self._random.random() < self.throttle_rate:
+                    self.throttled += 1
+                    items.append({op_type: {'_id': doc_id, 'status': 429, 'error': {
+                        'type': 'es_rejected_execution_exception', 'reason': 'rejected execution of bulk item'}}})
+                    position += 1 if op_type == 'delete' else 2
+                    continue
+                if op_type == 'delete':
+                    found = self._remove(target, doc_id)
+                    items.append({op_type: {'_id': doc_id, 'status': 200 if found else 404}})
+                    position += 1
+                    continue
+                self._store(target, doc_id, lines[position + 1])
+                items.append({op_type: {'_id': doc_id, 'status': 201}})
+                position += 2
+        errors = any(result['status'] >= 300 and result['status'] != 404 for item in items for result in item.values())
+        return {'took': 0, 'errors': errors, 'items': items}
+
+    def count(self, index, body=None):
+        return {'count': sum(len(self.documents.get(target, {})) for target in self._targets(index))}
+
+    def msearch(self, body, index=None):
+        self._call()
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()] if isinstance(body, str) else body
+        responses = []
+        for header, search_body in zip(lines[0::2], lines[1::2]):
+            try:
+                responses.append(self._search(search_body, header.get('index', index)))
+            except ValueError as e:
+                # like OpenSearch, a failed search is an error entry and does not fail the others
+                error_type, _, reason = str(e).partition(': ')
+                responses.append({'error': {'type': error_type, 'reason': reason}, 'status': 400})
+        return {'took': max([response.get('took', 0) for response in responses] or [0]), 'responses': responses}
+
+    def search(self, body, index, scroll=None):
+        self._call()
+        if scroll is None:
+            return self._search(body, index)
+        # a scroll takes a snapshot of every match and hands it out a page at a time
+        everything = sum(len(documents) for documents in self.documents.values())
+        hits = self._search(dict(body, size=everything), index)['hits']['hits']
+        scroll_id = f"scroll-{next(self._ids)}"
+        self.scrolls[scroll_id] = (hits, body.get('size', 10))
+        return self.scroll(scroll_id)
+
+    def scroll(self, scroll_id, scroll=None):
+        if scroll_id not in self.scrolls:
+            raise ValueError(f"search_context_missing_exception: No search context found for id [{scroll_id}]")
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return {'_scroll_id': scroll_id, 'took': 0, 'hits': {'total': {'value': len(hits), 'relation': 'eq'},
+                                                               'hits': hits[:size]}}
+
+    def clear_scroll(self, scroll_id):
+        self.scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    def _knn(self, targets, field, vector, k, filter=None):
+        """
+        The k nearest documents to the vector over the target indices, among the ones that match the filter.
+        :return: [(score, doc_id, source)], best first
+        """
+        graphs = [self.graphs.get(target, {}).get(field) for target in targets]
+        if all(graphs):
+            scored = []
+            for target, (graph, quantization) in zip(targets, graphs):
+                sources = self.documents.get(target, {})
+                keys = None if filter is None else [doc_id for doc_id, source in sources.items()
+                                                    if matches_filter(source, filter)]
+                scored += [(score, doc_id, sources[doc_id])
+                           for score, doc_id in graph.search(quantize(vector, quantization), k, keys=keys)]
+        else:
+            scored = [(cosine_similarity(vector, source.get(field, [])), doc_id, source)
+                      for target in targets for doc_id, source in self.documents.get(target, {}).items()
+                      if filter is None or matches_filter(source, filter)]
+        scored.sort(key=lambda hit: hit[0], reverse=True)
+        return scored[:k]
+
+    def _hit_source(self, targets, doc_id, source, body):
+        return source
+
+    def _search(self, body, index):
+        start = time.perf_counter()
+        targets = self._targets(index)
+        query = body.get('query', {'match_all': {}})
+        size = body.get('size', 10)
+        # a bool query filters what its must clause found, which for a knn clause is a post-filter of the k nearest
+        post_filter = None
+        if 'bool' in query:
+            post_filter = {'bool': {key: value for key, value in query['bool'].items() if key != 'must'}}
+            query = (as_list(query['bool'].get('must', [])) or [{'match_all': {}}])[0]
+        if 'knn' in query:
+            (field, params), = query['knn'].items()
+            if params.get('filter') is not None:
+                for target in targets:
+                    mapping = self.settings.get(target, {}).get('mappings', {}).get('properties', {}).get(field, {})
+                    if mapping.get('type') == 'knn_vector' and mapping.get('method', {}).get('engine',
+                                                                                            'nmslib') == 'nmslib':
+                        raise ValueError(f"illegal_argument_exception: Engine [NMSLIB] does not support filters "
+                                         f"([{target}] field [{field}])")
+            # a filter inside the knn clause narrows the candidates before the nearest ones are found
+            scored = self._knn(targets, field, params['vector'], params.get('k', size), params.get('filter'))
+        else:
+            documents = [(doc_id, source) for target in targets
+                         for doc_id, source in self.documents.get(target, {}).items()]
+            if 'ids' in query:
+                wanted = set(query['ids']['values'])
+                scored = [(1.0, doc_id, source) for doc_id, source in documents if doc_id in wanted]
+            elif 'match' in query:
+                (field, params), = query['match'].items()
+                text = params['query'] if isinstance(params, dict) else params
+                scores = bm25_scores(tokenize(text), [tokenize(source.get(field, '')) for _, source in documents])
+                scored = [(score, doc_id, source) for score, (doc_id, source) in zip(scores, documents) if score > 0]
+                scored.sort(key=lambda hit: hit[0], reverse=True)
+            else:
+                scored = [(1.0, doc_id, source) for doc_id, source in documents]
+        if post_filter is not None:
+            scored = [hit for hit in scored if matches_filter(hit[2], post_filter)]
+        hits = [{'_index': targets[0], '_id': doc_id, '_score': score,
+                 '_source': self._hit_source(targets, doc_id, source, body),
+                 'fields': {'text': [source.get('text', '')]}}
+                for score, doc_id, source in scored[:size]]
+        return {
+            'took': int((time.perf_counter() - start) * 1000),
+            'hits': {'total': {'value': len(scored), 'relation': 'eq'}, 'hits': hits},
+        }
@@ -0,0 +1,136 @@
+import json
+from collections import namedtuple
+
+# Caps for a single _bulk request. AOSS rejects request bodies above 10 MB, so stay well under that.
+DEFAULT_MAX_DOCS = 500
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+# How long a scroll is kept open between two pages
+DEFAULT_SCROLL = '10m'
+# The error type of a _bulk item OpenSearch rejected because its write queue is full, a 429 for a whole request
+REJECTED_EXECUTION_ERROR = 'es_rejected_execution_exception'
+
+# key is the caller's handle for the item (for example an SQS messageId) and is never sent to OpenSearch.
+BulkItem = namedtuple('BulkItem', ['key', 'source', 'doc_id', 'op_type'], defaults=(None, None, 'index'))
+
+
+def is_rejected(error):
+    """
+    :param error: The error of a failed _bulk item, a dict with a type or a status code
+    :return: True when OpenSearch rejected the item because it is overloaded
+    """
+    if isinstance(error, dict):
+        return error.get('type') == REJECTED_EXECUTION_ERROR
+    return error == 429
+
+
+def build_action(index_name, item):
+    """
+    Serializes one bulk item into its NDJSON lines.
+    :param index_name: The index the item is written to
+    :param item: A BulkItem
+    :return: The action line and, for index/create ops, the source line, newline terminated
+    """
+    meta = {'_index': index_name}
+    if item.doc_id is not None:
+        meta['_id'] = item.doc_id
+    lines = json.dumps({item.op_type: meta}) + '\n'
+    if item.op_type != 'delete':
+        lines += json.dumps(item.source) + '\n'
+    return lines
+
+
+def iter_batches(index_name, items, max_docs=DEFAULT_MAX_DOCS, max_bytes=DEFAULT_MAX_BYTES, limiter=None):
+    """
+    Groups bulk items into request bodies that respect both the document and the byte cap.
+    An item that is larger than max_bytes on its own is still sent, in a batch by itself.
+    :param limiter: An AimdLimiter whose current limit lowers the document cap, read as each batch is filled
+    :return: A generator of (items, body) tuples
+    """
+    def doc_cap():
+        return max_docs if limiter is None else min(max_docs, int(limiter.limit))
+
+    batch, lines, size = [], [], 0
+    for item in items:
+        payload = build_action(index_name, item)
+        payload_size = len(payload.encode('utf-8'))
+        if batch and (len(batch) >= doc_cap() or size + payload_size > max_bytes):
+            yield batch, ''.join(lines)
+            batch, lines, size = [], [], 0
+        batch.append(item)
+        lines.append(payload)
+        size += payload_size
+    if batch:
+        yield batch, ''.join(lines)
+
+
+def parse_bulk_response(response, items):
+    """
+    Matches the per-item results of a _bulk response back to the items that were sent.
+    :param response: The decoded _bulk response
+    :param items: The BulkItems in the order they were sent
+    :return: A list of (key, error) tuples for the items that failed
+    """
+    failures = []
+    results = response.get('items', [])
+    for position, item in enumerate(items):
+        if position >= len(results):
+            failures.append((item.key, 'missing from bulk response'))
+            continue
+        result = next(iter(results[position].values()))
+        status = result.get('status', 500)
+        # A delete of a document that is already gone is not a failure.
+        if status >= 300 and not (item.op_type == 'delete' and status == 404):
+            failures.append((item.key, result.get('error', status)))
+    return failures
+
+
+def bulk_index(client, index_name, items, max_docs=DEFAULT_MAX_DOCS, max_bytes=DEFAULT_MAX_BYTES, refresh=False,
+               limiter=None):
+    """
+    Writes items to OpenSearch with as few _bulk round trips as the caps allow.
+    A request that fails as a whole marks every item in it as failed, the remaining batches are still sent.
+    :param client: An OpenSearch client
+    :param index_name: The index the items are written to
+    :param items: An iterable of BulkItems
+    :param limiter: An AimdLimiter of documents per request, shared between calls so what it learns carries over:
+        a request OpenSearch rejects items of halves it, and every document written grows it by 1/limit, about one
+        document per full request
+    :return: A dict with the number of successful items and the list of (key, error) failures
+    """
+    succeeded = 0
+    failures = []
+    for batch, body in iter_batches(index_name, items, max_docs, max_bytes, limiter):
+        try:
+            response = client.bulk(body=body, refresh=refresh)
+        except Exception as e:
+            # a request rejected as a whole keeps its 429, so its items are retried as throttled
+            error = 429 if getattr(e, 'status_code', None) == 429 else str(e)
+            batch_failures = [(item.key, error) for item in batch]
+        else:
+            batch_failures = parse_bulk_response(response, batch)
+        failures.extend(batch_failures)
+        succeeded += len(batch) - len(batch_failures)
+        if limiter is not None:
+            limiter.observe(throttled=any(is_rejected(error) for _, error in batch_failures),
+                            successes=len(batch) - len(batch_failures))
+    return {'succeeded': succeeded, 'failed': failures}
+
+
+def scroll_pages(client, index, body=None, size=DEFAULT_MAX_DOCS, scroll=DEFAULT_SCROLL, scroll_id=None):
+    """
+    Pages through every document of an index with the scroll API in _doc order, which needs no sort on _id.
+    The scroll is cleared once it is exhausted; one that is abandoned expires after the scroll keep-alive.
+    :param body: The search body without size and sort, a match_all query by default
+    :param scroll_id: A scroll to continue from the page after the one it was yielded with
+    :return: Yields (hits, scroll_id) for every page
+    """
+    if scroll_id is None:
+        body = dict(body or {'query': {'match_all': {}}}, size=size, sort=['_doc'])
+        response = client.search(body=body, index=index, scroll=scroll)
+    else:
+        response = client.scroll(scroll_id=scroll_id, scroll=scroll)
+    while response['hits']['hits']:
+        scroll_id = response['_scroll_id']
+        yield response['hits']['hits'], scroll_id
+        response = client.scroll(scroll_id=scroll_id, scroll=scroll)
+    client.clear_scroll(scroll_id=response['_scroll_id'])
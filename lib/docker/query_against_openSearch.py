@@ -1,32 +1,57 @@
 import boto3
 import json
+from botocore.config import Config
 from dotenv import load_dotenv
 import os
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+from embedding_cache import build_cache_from_env
+from embedders import build_embedder_from_env
+from answer_cache import build_answer_cache_from_env, IndexVersionTracker
+from conversation_memory import (build_conversation_store_from_env, is_follow_up_question, prompt_with_summary,
+                                 summary_prompt)
+from retrieval import build_retriever_from_env
+import context_builder
+import index_profiles
+import rag_clients
+from tracing import build_tracer_from_env
 
 # loading in variables from .env file
 load_dotenv()
 
-# instantiating the Bedrock client, and passing in the CLI profile
-boto3.setup_default_session(profile_name=os.getenv('profile_name'))
-bedrock = boto3.client('bedrock-runtime', 'us-east-1', endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com')
-
-# instantiating the OpenSearch client, and passing in the CLI profile
-opensearch = boto3.client("opensearchserverless",'us-east-1')
-host = os.getenv('opensearch_host')  # cluster endpoint, for example: my-test-domain.us-east-1.aoss.amazonaws.com
-region = 'us-east-1'
-service = 'aoss'
-credentials = boto3.Session(profile_name=os.getenv('profile_name')).get_credentials()
-auth = AWSV4SignerAuth(credentials, region, service)
-
-client = OpenSearch(
-    hosts=[{'host': host, 'port': 443}],
-    http_auth=auth,
-    use_ssl=True,
-    verify_certs=True,
-    connection_class=RequestsHttpConnection,
-    pool_maxsize=20
-)
+if rag_clients.local_backend():
+    # rag_backend=local runs the query path without AWS, on the local vector store and the Bedrock stand-in
+    bedrock = rag_clients.get_bedrock_client()
+    client = rag_clients.get_opensearch_client(os.getenv('opensearch_host'))
+else:
+    # instantiating the Bedrock client, and passing in the CLI profile
+    boto3.setup_default_session(profile_name=os.getenv('profile_name'))
+    # sized for the concurrent calls of the async query engine, see async_query.py
+    bedrock = boto3.client('bedrock-runtime', 'us-east-1', endpoint_url='https://bedrock-runtime.us-east-1.amazonaws.com',
+                           config=Config(max_pool_connections=int(os.getenv('bedrock_concurrency', 16))))
+
+    # instantiating the OpenSearch client, and passing in the CLI profile
+    opensearch = boto3.client("opensearchserverless",'us-east-1')
+    host = os.getenv('opensearch_host')  # cluster endpoint, for example: my-test-domain.us-east-1.aoss.amazonaws.com
+    region = 'us-east-1'
+    service = 'aoss'
+    credentials = boto3.Session(profile_name=os.getenv('profile_name')).get_credentials()
+    auth = AWSV4SignerAuth(credentials, region, service)
+
+    client = OpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=auth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=20
+    )
+
+# caching embeddings of repeat questions, keyed by model id and the normalized question text
+embedding_cache = build_cache_from_env()
+# the embedding model and its output options, configured by the embedding_* environment variables
+embedder = build_embedder_from_env()
+# timing the stages of every question (embed, search, prompt, converse, render), see tracing.py
+tracer = build_tracer_from_env('rag-query')
 
 def get_embedding(body):
     """
@@ -34,17 +59,39 @@ def get_embedding(body):
     :param body: This is the question that is passed in to generate an embedding
     :return: A vector containing the embeddings of the passed in content
     """
-    # defining the embeddings model
-    modelId = 'amazon.titan-embed-text-v1'
-    accept = 'application/json'
-    contentType = 'application/json'
-    # invoking the embedding model
-    response = bedrock.invoke_model(body=body, modelId=modelId, accept=accept, contentType=contentType)
-    # reading in the specific embedding
-    response_body = json.loads(response.get('body').read())
-    embedding = response_body.get('embedding')
+    # returning the cached embedding if this question has been embedded before
+    inputText = json.loads(body)['inputText']
+    with tracer.span('embed') as span:
+        embedding = embedding_cache.get(embedder.query_cache_id, inputText)
+        span.set(cache_hit=embedding is not None)
+        if embedding is not None:
+            return embedding
+        # invoking the embedding model, the same one (and output options) the indexer embeds the documents with
+        embedding = embedder.embed_query(bedrock, inputText)
+    embedding_cache.put(embedder.query_cache_id, inputText, embedding)
     return embedding
 
+# the model that generates the MCQ question set, and the system prompts that set the general direction of its role
+MODEL_ID = "amazon.titan-text-premier-v1:0"
+SYSTEM_PROMPTS = [{"text": "You are a helpful assistant."}]
+# estimated tokens of retrieved context passed to the model, context_token_budget overrides the per-model default
+CONTEXT_TOKEN_BUDGET = context_builder.context_budget_from_env(MODEL_ID)
+
+# kNN or hybrid (BM25 + kNN with reciprocal rank fusion) retrieval, configured by the retrieval_* variables
+retriever = build_retriever_from_env()
+# filters go inside the knn clause on faiss and lucene indices, and around it on an nmslib index (the default
+# profile), which rejects them there; read from the mapping of the index behind the alias, again after a reindex
+retriever.efficient_filter = index_profiles.KnnFilterSupport(
+    client, os.getenv("vector_index_name"), os.getenv('vector_field_name', 'vector_field'),
+    ttl=float(os.getenv('knn_filter_check', index_profiles.DEFAULT_KNN_FILTER_CHECK_SECONDS)))
+
+# caching generated answers, dropped whenever the document count of the index changes or a reindex switches
+# the vector index alias to another index
+answer_cache = build_answer_cache_from_env()
+index_version = IndexVersionTracker(lambda: (index_profiles.alias_targets(client, os.getenv("vector_index_name")),
+                                             client.count(index=os.getenv("vector_index_name"))['count']),
+                                    interval=float(os.getenv('answer_cache_version_check', 60)))
+
 def conversation_orchestrator(bedrock, model_id, system_prompts, messages):
     """
     Orchestrates the conversation between the user and the model.
@@ -78,49 +125,98 @@ def conversation_orchestrator(bedrock, model_id, system_prompts, messages):
     return response
 
 
+def summarize_conversation(summary, turns, max_tokens):
+    """
+    Folds the oldest turns of a conversation into its running summary with the model, see conversation_memory.py.
+    """
+    with tracer.span('summarize', turns=len(turns)) as span:
+        messages = [{"role": "user", "content": [{"text": summary_prompt(summary, turns, max_tokens)}]}]
+        response = conversation_orchestrator(bedrock, MODEL_ID, SYSTEM_PROMPTS, messages)
+        span.set(**converse_attributes(response['usage'], response['metrics']))
+    return response['output']['message']['content'][0]['text']
 
-def answer_query(user_input):
-       
-    messages = []
 
-    userQuery = user_input
-    # formatting the user input
-    userQueryBody = json.dumps({"inputText": userQuery})
-    # creating an embedding of the user input to perform a KNN search with
-    userVectors = get_embedding(userQueryBody)
-    # the query parameters for the KNN search performed by Amazon OpenSearch with the generated User Vector passed in.
-    # TODO: If you wanted to add pre-filtering on the query you could by editing this query!
-    query = {
-        "size": 3,
-        "query": {
-            "knn": {
-                "vector_field": {
-                    "vector": userVectors, "k": 3
-                }
-            }
-        },
-        "_source": True,
-        "fields": ["text"],
-    }
-    # performing the search on OpenSearch passing in the query parameters constructed above
-    response = client.search(
-        body=query,
-        index=os.getenv("vector_index_name")
+# the turns of every user's conversation, passed to the model with their next question and summarized beyond
+# conversation_token_budget tokens
+conversations = build_conversation_store_from_env(summarize_conversation)
+
+
+def conversation_orchestrator_stream(bedrock, model_id, system_prompts, messages):
+    """
+    Same as conversation_orchestrator, but uses the ConverseStream API so the answer can be rendered while it is
+    being generated.
+    Returns: The ConverseStream response, its 'stream' yields the contentBlockDelta and metadata events.
+    """
+    # Set the temperature for the model inference, controlling the randomness of the responses.
+    temperature = 0.5
+    inference_config = {"temperature": temperature}
+    # Call the converse_stream method of the Bedrock client object to start streaming the response.
+    return bedrock.converse_stream(
+        modelId=model_id,
+        messages=messages,
+        inferenceConfig=inference_config,
     )
 
-    # Format Json responses into text
-    similaritysearchResponse = ""
-    # iterating through all the findings of Amazon openSearch and adding them to a single string to pass in as context
-    for i in response["hits"]["hits"]:
-        outputtext = i["fields"]["text"]
-        similaritysearchResponse = similaritysearchResponse + "Info = " + str(outputtext)
 
-        similaritysearchResponse = similaritysearchResponse
-    
-    # Configuring the Prompt for the LLM
-    # TODO: EDIT THIS PROMPT TO OPTIMIZE FOR YOUR USE CASE
-    
+def converse_attributes(usage, metrics):
+    """
+    The token counts and the model latency of a Converse response, recorded on its span.
+    """
+    return {'input_tokens': usage.get('inputTokens'), 'output_tokens': usage.get('outputTokens'),
+            'model_latency_ms': metrics.get('latencyMs')}
+
+
+def stream_answer(model_id, system_prompts, messages, userQuery, userVectors, stats, span, cache=True,
+                  conversation=None):
+    """
+    Yields the text of the model's answer as it arrives, and caches the full answer once the stream is complete.
+    The usage and metrics of the final metadata event are written to stats.
+    :param span: The converse span, ended when the stream is
+    :param cache: Put the answer in the answer cache
+    :param conversation: The conversation the answer is added to as a turn
+    """
+    with span:
+        response = conversation_orchestrator_stream(bedrock, model_id, system_prompts, messages)
+        answer = ""
+        for event in response['stream']:
+            if 'contentBlockDelta' in event:
+                text = event['contentBlockDelta']['delta'].get('text', '')
+                if not answer:
+                    span.set(first_token_ms=round(span.elapsed_ms(), 3))
+                answer += text
+                yield text
+            elif 'metadata' in event:
+                stats['usage'] = event['metadata'].get('usage', {})
+                stats['metrics'] = event['metadata'].get('metrics', {})
+                span.set(**converse_attributes(stats['usage'], stats['metrics']))
+                print(f"usage: {stats['usage']}")
+                print(f"latencyMs: {stats['metrics']}")
+    messages.append({"role": "assistant", "content": [{"text": answer}]})
+    if cache:
+        answer_cache.put(userQuery, userVectors, answer)
+    if conversation is not None:
+        conversations.add_turn(conversation, userQuery, answer)
+
+
+def build_context(response, span=None):
+    """
+    Formats the hits of the similarity search into the context passed to the LLM: overlapping chunks and chunks
+    of the same page are merged, and the passages are packed within the context token budget of the model.
+    :param span: The span the context size is recorded on, defaults to the current one
+    """
+    context = context_builder.build_context(response["hits"]["hits"], token_budget=CONTEXT_TOKEN_BUDGET)
+    print(f"context: {context.passages} passages, ~{context.tokens} tokens, ~{context.saved_tokens} prompt tokens saved")
+    span = span or tracer.current()
+    if span is not None:
+        span.set(passages=context.passages, context_tokens=context.tokens, saved_tokens=context.saved_tokens)
+    return context.text
 
+
+def build_prompt(userQuery, similaritysearchResponse):
+    """
+    Configures the Prompt for the LLM from the user's topic and the retrieved context.
+    """
+    # TODO: EDIT THIS PROMPT TO OPTIMIZE FOR YOUR USE CASE
     prompt_data = f"""
 
     The following is text from a Topic  "{userQuery}" :
@@ -149,13 +245,127 @@ def answer_query(user_input):
     Explanation:
     
     """
+    return prompt_data
+
+
+def build_follow_up_prompt(userQuery, similaritysearchResponse):
+    """
+    Configures the Prompt for a follow-up on the previous answers, such as a question about one of the generated
+    questions, from the context that was retrieved for the topic.
+    """
+    return f"""
+
+    The following is text the earlier questions of this conversation were based on:
+
+    {similaritysearchResponse}
+
+    {userQuery}
+
+    Answer based on our conversation so far and the context provided. If you are unable to answer accurately,
+    please say so. Please mention the sources of your answer by referring to page numbers, specific books and chapters!
+    """
+
+
+def cached_answer(answer, stream):
+    # a cached answer is delivered as a single chunk when the caller asked for a stream
+    return iter([answer]) if stream else answer
+
+
+def search(user_input, filters=None):
+    """
+    Semantic search without generating an answer: the chunks nearest to the question, optionally narrowed by
+    metadata filters that are applied inside the kNN query, see retrieval.search_filter.
+    :param user_input: The question or topic to search for
+    :param filters: e.g. {"source": "wellarchitected-machine-learning-lens.pdf", "page": {"gte": 10, "lte": 20}}
+    :return: The OpenSearch search response
+    """
+    with tracer.span('search_query', filtered=bool(filters)):
+        userVectors = get_embedding(json.dumps({"inputText": user_input}))
+        return search_index(user_input, userVectors, filters)
+
+
+def search_index(userQuery, userVectors, filters=None):
+    with tracer.span('search', filtered=bool(filters)) as span:
+        response = retriever.search(client, os.getenv("vector_index_name"), userQuery, userVectors, filters)
+        span.set(hits=len(response['hits']['hits']), took_ms=response.get('took'))
+    return response
+
+
+def answer_query(user_input, stream=False, stats=None, filters=None, conversation_id=None):
+    """
+    Answers the user's question with the RAG chain: embed, kNN search, then converse.
+    Each stage is timed as a span of the question's trace, see tracing.py.
+    :param user_input: The question or topic the user asked about
+    :param stream: Return a generator that yields the answer text as the model produces it, instead of the full text
+    :param stats: Optional dict that receives the usage and metrics of a streamed answer
+    :param filters: Optional metadata filters the search is narrowed to, see search
+    :param conversation_id: Passes the earlier turns of this conversation to the model and adds the answer to
+        them, see conversation_memory.conversation_id; every question stands on its own without one
+    :return: The answer text, or a generator of text chunks when stream is True
+    """
+    with tracer.span('answer_query', stream=stream, conversation=bool(conversation_id)):
+        return traced_answer_query(user_input, stream, stats, filters, conversation_id)
+
+
+def traced_answer_query(user_input, stream, stats, filters=None, conversation_id=None):
+    userQuery = user_input
+    # the earlier turns of the conversation, within its token budget and summarized beyond it
+    conversation = conversations.get(conversation_id) if conversation_id else None
+    summary, messages = conversation.history() if conversation is not None else ('', [])
+    # the answer cache is keyed by the question alone, so answers from a filtered search, or to a question that
+    # follows earlier turns, bypass it
+    cache = not filters and not messages
+    # returning the cached answer when the same question was answered against the current index
+    answer_cache.check_index_version(index_version.current())
+    cachedAnswer = answer_cache.get(userQuery) if cache else None
+    if cachedAnswer is not None:
+        tracer.current().set(answer_cache='exact')
+        if conversation is not None:
+            conversations.add_turn(conversation, userQuery, cachedAnswer)
+        return cached_answer(cachedAnswer, stream)
+    # a follow-up on the previous answers reuses the context retrieved for them, rather than embedding and searching
+    similaritysearchResponse = conversation.reusable_context(userQuery, filters) if messages else None
+    userVectors = None
+    if similaritysearchResponse is None:
+        # formatting the user input
+        userQueryBody = json.dumps({"inputText": userQuery})
+        # creating an embedding of the user input to perform a KNN search with
+        userVectors = get_embedding(userQueryBody)
+        # returning the answer of a near-duplicate question, if semantic hits are enabled
+        cachedAnswer = answer_cache.get_similar(userVectors) if cache else None
+        if cachedAnswer is not None:
+            tracer.current().set(answer_cache='semantic')
+            if conversation is not None:
+                conversations.add_turn(conversation, userQuery, cachedAnswer)
+            return cached_answer(cachedAnswer, stream)
+        # a question about the same topic as the last search also reuses its context
+        similaritysearchResponse = conversation.reusable_context(userQuery, filters, userVectors) if messages else None
+    if similaritysearchResponse is None:
+        # performing the search on OpenSearch with the generated User Vector, and the question itself in hybrid mode
+        response = search_index(userQuery, userVectors, filters)
+    with tracer.span('prompt', history_messages=len(messages)) as span:
+        if similaritysearchResponse is None:
+            # merging the findings of Amazon openSearch into the context passed to the LLM, within its token budget
+            similaritysearchResponse = build_context(response)
+            if conversation is not None:
+                conversation.remember_context(userQuery, userVectors, filters, similaritysearchResponse)
+        else:
+            span.set(reused_context=True)
+            conversations.count_follow_up()
+        # Configuring the Prompt for the LLM, a follow-up is answered rather than turned into a new question set
+        if messages and is_follow_up_question(userQuery):
+            prompt_data = build_follow_up_prompt(userQuery, similaritysearchResponse)
+        else:
+            prompt_data = build_prompt(userQuery, similaritysearchResponse)
+        # the turns that no longer fit in the conversation's token budget are passed as their summary
+        prompt_data = prompt_with_summary(summary, prompt_data)
 
     print(prompt_data)
     
-    model_id = "amazon.titan-text-premier-v1:0"
+    model_id = MODEL_ID
 
     # Define the system prompts to guide the model's behavior, and set the general direction of the models role.
-    system_prompts = [{"text": "You are a helpful assistant."}]
+    system_prompts = SYSTEM_PROMPTS
     
     # Format the user's message as a dictionary with role and content
     message = {
@@ -163,11 +373,20 @@ def answer_query(user_input):
         "content": [{"text": prompt_data}]
     }
     
-    # Append the formatted user message to the list of messages.
+    # Append the formatted user message to the list of messages, after the earlier turns of the conversation.
     messages.append(message)
 
+    if stream:
+        # Stream the model's response, the caller renders the text as it arrives.
+        # the converse span stays open after answer_query returns, until the stream is drained
+        return stream_answer(model_id, system_prompts, messages, userQuery, userVectors,
+                             stats if stats is not None else {}, tracer.start_span('converse', stream=True), cache,
+                             conversation)
+
    # Invoke the conversation orchestrator to get the model's response.
-    response = conversation_orchestrator(bedrock,model_id, system_prompts, messages)
+    with tracer.span('converse') as span:
+        response = conversation_orchestrator(bedrock,model_id, system_prompts, messages)
+        span.set(**converse_attributes(response['usage'], response['metrics']))
     
     # Extract the output message from the response.
     output_message = response['output']['message']
@@ -176,5 +395,10 @@ def answer_query(user_input):
     print(f"latencyMs: {response['metrics']}")
 
     messages.append(output_message)
-    
-    return output_message['content'][0]['text']
\ No newline at end of file
+
+    answer = output_message['content'][0]['text']
+    if cache:
+        answer_cache.put(userQuery, userVectors, answer)
+    if conversation is not None:
+        conversations.add_turn(conversation, userQuery, answer)
+    return answer
\ No newline at end of file
@@ -0,0 +1,86 @@
+import functools
+import os
+
+# The clients below are created on first use and cached for the life of the process, so a Lambda
+# container pays for the imports and the client setup once and reuses the clients on warm invocations.
+# With rag_backend=local they are replaced by in-process stand-ins that need no AWS account: the local vector
+# store (persisted in vector_store_path, or in memory) and the Bedrock stand-in, which embeds deterministically.
+
+BEDROCK_REGION = 'us-east-1'
+
+
+def local_backend():
+    """
+    :return: True when rag_backend=local selects the local stand-ins instead of Bedrock and OpenSearch
+    """
+    return os.getenv('rag_backend', 'aws') == 'local'
+
+
+@functools.lru_cache(maxsize=None)
+def get_bedrock_client(region=BEDROCK_REGION, max_pool_connections=10):
+    """
+    Returns the Amazon Bedrock Runtime client for the region, creating it on first use.
+    :param max_pool_connections: Size of the HTTP connection pool, match it to the embedding concurrency
+    """
+    if local_backend():
+        from local_standins import FakeBedrockRuntime
+
+        return FakeBedrockRuntime(latency=float(os.getenv('local_bedrock_latency_ms', 0)) / 1000)
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        'bedrock-runtime',
+        region,
+        endpoint_url=f'https://bedrock-runtime.{region}.amazonaws.com',
+        config=Config(max_pool_connections=max_pool_connections)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_opensearch_client(host, region=BEDROCK_REGION, service='aoss', pool_maxsize=50, verify_certs=False):
+    """
+    Returns a SigV4 signed OpenSearch client for the endpoint, creating it on first use.
+    :param host: The collection endpoint, for example: my-test-domain.us-east-1.aoss.amazonaws.com
+    :param service: 'aoss' for OpenSearch Serverless, 'es' for a managed domain
+    """
+    if local_backend():
+        return get_local_vector_store(os.getenv('vector_store_path') or None)
+    import boto3
+    from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+
+    auth = AWSV4SignerAuth(boto3.Session().get_credentials(), region, service)
+    return OpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=auth,
+        use_ssl=True,
+        verify_certs=verify_certs,
+        ssl_show_warn=False,
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=pool_maxsize
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_sqs_client(region=None):
+    """
+    Returns the SQS client for the region (the function's own by default), creating it on first use.
+    """
+    if local_backend():
+        from local_standins import FakeSqs
+
+        return FakeSqs()
+    import boto3
+
+    return boto3.client('sqs', region)
+
+
+@functools.lru_cache(maxsize=None)
+def get_local_vector_store(path=None, approximate=False):
+    """
+    Returns the local vector store kept in the path, or in memory without one, opening it on first use.
+    :param approximate: Search through HNSW graphs instead of exactly, see vector_store.py
+    """
+    from vector_store import LocalVectorStore
+
+    return LocalVectorStore(path, approximate=approximate)
@@ -0,0 +1,370 @@
+"""
+Zero-downtime reindex. Searches keep going to the index behind the vector index alias while a new versioned
+index is built next to it; once its document count is validated the alias is switched over in one atomic request.
+
+The new index is filled in one of two ways:
+  --copy      copies the documents, vectors included, from the index the alias points to. Use it when only the
+              ANN settings change. Pages through the source with a scroll in _doc order.
+  --source    re-ingests PDFs through the direct ingest path: split in a process pool, embed, bulk write.
+              Use it when the chunking or the embedding model changes.
+
+Progress is checkpointed to a JSON file after every bulk write, so an interrupted or failed run picks up where
+it stopped when it is started again with the same arguments. An index from before the alias existed (a concrete
+index holding the alias' name) is replaced by the alias in the same atomic request.
+
+The indexer Lambda writes through the alias, so what it wrote during the backfill would land in the old index
+and be lost with the switch. Ingest is therefore blocked for the duration: the event source mapping of the
+indexer (--indexer-function) is disabled until the alias has been switched, the messages sent meanwhile wait
+in the queue and are indexed into the new index afterwards. It is enabled again when the reindex fails too.
+
+Usage:
+    python reindex.py --copy --profile balanced
+    python reindex.py --source ./pdfs --model-id amazon.titan-embed-text-v2:0 --dimensions 512
+    python reindex.py --source ./pdfs --local --bedrock-latency-ms 150
+"""
+import argparse
+import contextlib
+import functools
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import index_profiles
+import rag_clients
+from chunking import iter_ranges
+from direct_ingest import Progress, plan_tasks, split_pages
+from embedders import build_embedder, document_embed_fn
+from embedding_cache import build_cache_from_env
+from embedding_executor import EmbeddingExecutor, DEFAULT_CONCURRENCY
+from indexing import embed_items
+from ingest_pipeline import list_pdfs
+from opensearch_bulk import BulkItem, bulk_index, scroll_pages, DEFAULT_MAX_DOCS
+
+DEFAULT_CHECKPOINT_PATH = '.reindex_checkpoint.json'
+# The indexer Lambda of the CDK stack
+DEFAULT_INDEXER_FUNCTION = 'docs-indexer'
+
+
+class ReindexCheckpoint:
+    """
+    Progress of a reindex into one target index: the page ranges ingested (with their document counts), or the
+    scroll of the copy and the ids of the page fetched from it that is not written yet. A checkpoint for another
+    target index is ignored.
+    """
+
+    def __init__(self, path, target_index):
+        self.path = path
+        self.state = {'target_index': target_index, 'done_tasks': {}, 'scroll_id': None, 'pending': [], 'copied': 0}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('target_index') == target_index:
+                self.state.update(state)
+                print(f"Resuming the reindex into {target_index} from {path}")
+            else:
+                print(f"Ignoring {path}, it is for a reindex into {state.get('target_index')}")
+
+    def save(self):
+        if not self.path:
+            return
+        # write then rename, so an interrupted run never leaves a truncated checkpoint behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def task_key(task):
+    path, start, stop = task
+    return f"{path}:{start}:{stop}"
+
+
+def copy_documents(client, source_index, target_index, checkpoint, batch_size=DEFAULT_MAX_DOCS):
+    """
+    Copies every document of source_index into target_index, a scroll page of batch_size at a time. The ids of a
+    page are checkpointed before it is written: the scroll has moved past it by then, so a resumed run fetches
+    them again by id before it continues the scroll. When the scroll has expired, the copy starts over and
+    overwrites the documents copied before.
+    :return: The number of documents the target should hold, the source's count
+    """
+    progress = Progress()
+    state = checkpoint.state
+
+    def write(hits):
+        items = [BulkItem(hit['_id'], hit['_source'], doc_id=hit['_id']) for hit in hits]
+        result = bulk_index(client, target_index, items, max_docs=batch_size)
+        progress.add(chunks=len(hits), indexed=result['succeeded'], failed=len(result['failed']))
+        if result['failed']:
+            key, error = result['failed'][0]
+            raise RuntimeError(f"{len(result['failed'])} documents failed to copy ({key}: {error}), rerun to resume")
+        state['copied'] += len(hits)
+        state['pending'] = []
+        checkpoint.save()
+
+    if state['pending']:
+        write(client.search(body={'size': len(state['pending']), 'query': {'ids': {'values': state['pending']}}},
+                            index=source_index)['hits']['hits'])
+    pages = scroll_pages(client, source_index, size=batch_size, scroll_id=state['scroll_id'])
+    try:
+        first = next(pages, None)
+    except Exception as e:
+        print(f"Could not continue the scroll of the checkpoint, copying from the start: {e}")
+        state.update(scroll_id=None, copied=0)
+        pages = scroll_pages(client, source_index, size=batch_size)
+        first = next(pages, None)
+    for hits, scroll_id in itertools.chain([first] if first else [], pages):
+        state.update(scroll_id=scroll_id, pending=[hit['_id'] for hit in hits])
+        checkpoint.save()
+        write(hits)
+    print(json.dumps(progress.summary()))
+    return client.count(index=source_index)['count']
+
+
+def ingest_sources(files, bedrock, client, target_index, vector_field, checkpoint, embedder, workers=4,
+                   pages_per_task=10, embed_concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_MAX_DOCS,
+                   embedding_cache=None, root=None):
+    """
+    Ingests the page ranges of the files that the checkpoint does not have yet. A page range is recorded only
+    once all of its chunks are written, so a failed one is retried by the next run. The chunks at the start of
+    the first range a resumed run ingests in a file have no section, the range before it is not parsed again.
+    :param root: The file or directory the files were listed from, see fingerprints.source_name
+    :return: The number of documents the target should hold
+    """
+    executor = EmbeddingExecutor(document_embed_fn(embedder, bedrock, embedding_cache), concurrency=embed_concurrency)
+    done = checkpoint.state['done_tasks']
+    tasks = [task for task in plan_tasks(files, pages_per_task) if task_key(task) not in done]
+    progress = Progress()
+    failed_tasks = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for task, result in iter_ranges(pool, tasks, functools.partial(split_pages, root=root)):
+            chunks = result.chunks
+            items, failures = embed_items(executor, [(doc_id, text, doc_id, metadata)
+                                                     for doc_id, text, metadata in chunks],
+                                          vector_field, batch_size=embedder.batch_size)
+            result = bulk_index(client, target_index, items, max_docs=batch_size)
+            progress.add(chunks=len(chunks), embedded=len(items), indexed=result['succeeded'],
+                         failed=len(failures) + len(result['failed']))
+            if failures or result['failed']:
+                failed_tasks += 1
+                continue
+            # chunks with the same id on a page are the same document
+            done[task_key(task)] = len({doc_id for doc_id, _, _ in chunks})
+            checkpoint.save()
+    print(json.dumps(progress.summary()))
+    if failed_tasks:
+        raise RuntimeError(f"{failed_tasks} page ranges failed to index, rerun to resume")
+    return sum(done.values())
+
+
+def wait_for_count(client, index_name, expected, timeout=300, tolerance=0, interval=5):
+    """
+    Polls the document count of the index until it is within tolerance of expected. Counts lag writes by the
+    refresh interval, so a backfill that just finished needs a little time to show all of its documents.
+    :return: The last count read
+    """
+    deadline = time.time() + timeout
+    while True:
+        count = client.count(index=index_name)['count']
+        if abs(count - expected) <= tolerance or time.time() >= deadline:
+            return count
+        time.sleep(interval)
+
+
+class IndexerPause:
+    """
+    Disables the SQS event source mappings of the indexer Lambda on enter and enables them again on exit, so
+    nothing is written through the alias in between. A batch the indexer received just before can still be
+    writing for up to the function timeout, which enter waits out.
+    """
+
+    def __init__(self, lambda_client, function_name, poll_interval=5):
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+        self.poll_interval = poll_interval
+        self.paused = []
+
+    def __enter__(self):
+        mappings = self.lambda_client.list_event_source_mappings(FunctionName=self.function_name)
+        for mapping in mappings['EventSourceMappings']:
+            if mapping['State'] != 'Disabled':
+                self.lambda_client.update_event_source_mapping(UUID=mapping['UUID'], Enabled=False)
+                self.paused.append(mapping['UUID'])
+        for uuid in self.paused:
+            while self.lambda_client.get_event_source_mapping(UUID=uuid)['State'] != 'Disabled':
+                time.sleep(self.poll_interval)
+        if self.paused:
+            timeout = self.lambda_client.get_function_configuration(FunctionName=self.function_name)['Timeout']
+            print(f"Paused {self.function_name}, waiting {timeout}s for the batches it is still indexing")
+            time.sleep(timeout)
+        return self
+
+    def __exit__(self, *exc_info):
+        for uuid in self.paused:
+            self.lambda_client.update_event_source_mapping(UUID=uuid, Enabled=True)
+        if self.paused:
+            print(f"Resumed {self.function_name}")
+
+
+def reindex(client, alias, body, backfill, checkpoint_path=DEFAULT_CHECKPOINT_PATH, validate_timeout=300,
+            tolerance=0, swap=True, delete_previous=False, source_count=None):
+    """
+    Builds the versioned index for body next to the live one, backfills it, validates its count and switches
+    the alias over. What is left to do is decided by the target's document count, not by where the alias points:
+    the alias may already point to an index that is still empty.
+    :param backfill: Called with (target_index, checkpoint), fills the target and returns the expected count
+    :param source_count: The number of documents the target should hold when it is known up front (--copy),
+        the backfill is skipped when the target already holds them
+    :return: The target index name
+    """
+    target_index = index_profiles.versioned_index_name(alias, body)
+    if index_profiles.ensure_index(client, target_index, body):
+        print(f"Created {target_index}")
+
+    checkpoint = ReindexCheckpoint(checkpoint_path, target_index)
+    count = client.count(index=target_index)['count']
+    if source_count is not None and abs(count - source_count) <= tolerance:
+        print(f"{target_index} already holds the {count} documents of the source")
+        expected = source_count
+    else:
+        expected = backfill(target_index, checkpoint)
+    count = wait_for_count(client, target_index, expected, timeout=validate_timeout, tolerance=tolerance)
+    if abs(count - expected) > tolerance:
+        if checkpoint.state['scroll_id']:
+            # documents the source gained or lost since the copy started are picked up by a fresh pass
+            checkpoint.state.update(scroll_id=None, pending=[], copied=0)
+            checkpoint.save()
+        raise RuntimeError(f"{target_index} has {count} documents, expected {expected}; {alias} was not switched. "
+                           f"Rerun to catch up")
+    print(f"{target_index} holds the expected {count} documents")
+
+    if not swap:
+        print(f"Not switching {alias}, it still points to {index_profiles.alias_targets(client, alias)}")
+        return target_index
+    previous = index_profiles.swap_alias(client, alias, target_index)
+    print(f"Switched {alias} from {previous} to {target_index}")
+    checkpoint.clear()
+    if delete_previous:
+        for name in previous:
+            if name not in (alias, target_index) and client.indices.exists(index=name):
+                client.indices.delete(index=name)
+                print(f"Deleted {name}")
+    return target_index
+
+
+def source_index_of(client, alias, target_index):
+    """
+    The index to copy the documents from: the one the alias' searches go to (the alias' single index, or a
+    concrete index with its name). When the alias already points to the target, it was switched before the
+    target was backfilled, and the source is the index it pointed to before: the other index of the alias with
+    the most documents.
+    """
+    targets = index_profiles.alias_targets(client, alias)
+    if targets == [target_index]:
+        indices = client.indices.get(index=f"{alias}-*", ignore_unavailable=True)
+        counts = {name: client.count(index=name)['count'] for name in indices if name != target_index}
+        if not any(counts.values()):
+            raise ValueError(f"Can't copy into {target_index}, {alias} has no other index with documents")
+        return max(counts, key=counts.get)
+    if len(targets) == 1:
+        return targets[0]
+    if not targets and client.indices.exists(index=alias):
+        return alias
+    raise ValueError(f"Can't copy from {alias}, it points to {targets or 'no index'}")
+
+
+def index_embedder(client, index_name, vector_field):
+    """
+    :return: The embedder recorded in the index's mapping (None for an index from before it was recorded),
+        and the dimension of its vector field
+    """
+    mappings = client.indices.get(index=index_name)[index_name].get('mappings', {})
+    dimension = mappings.get('properties', {}).get(vector_field, {}).get('dimension')
+    return mappings.get('_meta', {}).get('embedder'), dimension
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--copy', action='store_true', help='Copy the documents of the index the alias points to')
+    source.add_argument('--source', help='Re-ingest a PDF or a directory of PDFs')
+    parser.add_argument('--alias', default=os.getenv('vector_index_name', 'rag-vector-index'))
+    parser.add_argument('--profile', default='default',
+                        help='Index profile name, or a JSON object of profile keys, see index_profiles.py')
+    parser.add_argument('--model-id', default=os.getenv('embedding_model_id') or None, help='The embedding model')
+    parser.add_argument('--dimensions', type=int, default=int(os.getenv('embedding_dimensions') or 0) or None,
+                        help='Output dimensions of the embedding model, for Titan v2')
+    parser.add_argument('--vector-field', default=os.getenv('vector_field_name', 'vector_field'))
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_MAX_DOCS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--pages-per-task', type=int, default=10)
+    parser.add_argument('--embed-concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--validate-timeout', type=float, default=300, help='Seconds to wait for the counts to match')
+    parser.add_argument('--tolerance', type=int, default=0, help='Accepted difference between the document counts')
+    parser.add_argument('--no-swap', action='store_true', help='Build and validate the index without switching the alias')
+    parser.add_argument('--delete-previous', action='store_true', help='Delete the previous index after switching')
+    parser.add_argument('--indexer-function', default=os.getenv('indexer_function_name', DEFAULT_INDEXER_FUNCTION),
+                        help='The indexer Lambda, whose queue is not consumed while the new index is backfilled')
+    parser.add_argument('--no-pause', action='store_true',
+                        help='Keep the indexer running; what it writes during the backfill is lost with the switch')
+    parser.add_argument('--local', action='store_true', help='Use the Bedrock stand-in and the local vector store')
+    parser.add_argument('--bedrock-latency-ms', type=float, default=0.0, help='Simulated Bedrock latency with --local')
+    parser.add_argument('--store', help='With --local, keep the local vector store in this directory instead of in memory')
+    args = parser.parse_args()
+
+    profile = json.loads(args.profile) if args.profile.strip().startswith('{') else args.profile
+    embedder = build_embedder(args.model_id, args.dimensions)
+    body = index_profiles.build_index_body(profile, embedder, args.vector_field)
+    if args.local:
+        from local_standins import FakeBedrockRuntime
+        from vector_store import LocalVectorStore
+
+        bedrock = FakeBedrockRuntime(dimension=embedder.dimension, latency=args.bedrock_latency_ms / 1000)
+        client = LocalVectorStore(args.store)
+    else:
+        bedrock = rag_clients.get_bedrock_client(max_pool_connections=args.embed_concurrency)
+        client = rag_clients.get_opensearch_client(os.getenv('opensearch_host'))
+
+    if args.copy:
+        source_index = source_index_of(client, args.alias, index_profiles.versioned_index_name(args.alias, body))
+        # copied vectors are only valid in the new index when the same embedder produced them
+        source_embedder, source_dimension = index_embedder(client, source_index, args.vector_field)
+        if source_embedder not in (None, embedder.cache_id) or source_dimension not in (None, embedder.dimension):
+            parser.error(f"{source_index} holds vectors of {source_embedder or source_dimension}, the new index "
+                         f"takes {embedder.cache_id}; re-embed with --source instead of --copy")
+        backfill = lambda target, checkpoint: copy_documents(client, source_index, target, checkpoint, args.batch_size)
+    else:
+        files = list_pdfs(args.source)
+        backfill = lambda target, checkpoint: ingest_sources(
+            files, bedrock, client, target, args.vector_field, checkpoint, embedder, workers=args.workers,
+            pages_per_task=args.pages_per_task, embed_concurrency=args.embed_concurrency,
+            batch_size=args.batch_size, embedding_cache=build_cache_from_env(), root=args.source,
+        )
+
+    if args.local or args.no_pause:
+        pause = contextlib.nullcontext()
+    else:
+        import boto3
+
+        pause = IndexerPause(boto3.client('lambda'), args.indexer_function)
+    with pause:
+        # counted once the indexer is paused, the source does not change after that
+        source_count = client.count(index=source_index)['count'] if args.copy else None
+        try:
+            reindex(client, args.alias, body, backfill, checkpoint_path=args.checkpoint,
+                    validate_timeout=args.validate_timeout, tolerance=args.tolerance, swap=not args.no_swap,
+                    delete_previous=args.delete_previous, source_count=source_count)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
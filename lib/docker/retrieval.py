@@ -0,0 +1,266 @@
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CANDIDATES = 20
+DEFAULT_SIZE = 3
+# k in the reciprocal rank fusion score 1 / (k + rank), 60 is the value from the original RRF paper
+DEFAULT_RANK_CONSTANT = 60
+# Nearest neighbours fetched per wanted hit when the engine can only filter them after the search (nmslib),
+# so that enough of them are left once the filter has dropped the ones from other documents
+POST_FILTER_K_FACTOR = 10
+# The largest k the k-NN plugin accepts
+MAX_K = 10000
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+# Metadata fields the indexer stores with every chunk, that searches can be narrowed to
+FILTER_FIELDS = ('source', 'section', 'page')
+
+
+def search_filter(filters):
+    """
+    Turns filters into an OpenSearch filter clause.
+    :param filters: {field: value} for the fields in FILTER_FIELDS; a value matches exactly, a list matches any
+        of its values, and a dict is a range, e.g. {"source": "wellarchitected-machine-learning-lens.pdf",
+        "page": {"gte": 10, "lte": 20}}. Pages are numbered from 0, like the PDF loader numbers them
+    :return: The clause, or None without filters
+    """
+    if not filters:
+        return None
+    unknown = set(filters) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields {sorted(unknown)}, expected some of {list(FILTER_FIELDS)}")
+    clauses = []
+    for field, value in filters.items():
+        if isinstance(value, dict):
+            clauses.append({"range": {field: value}})
+        elif isinstance(value, (list, tuple, set)):
+            clauses.append({"terms": {field: list(value)}})
+        else:
+            clauses.append({"term": {field: value}})
+    return {"bool": {"filter": clauses}}
+
+
+def knn_query(vectors, size, k=None, vector_field='vector_field', filters=None, efficient_filter=True):
+    """
+    The KNN search performed by Amazon OpenSearch with the generated User Vector passed in.
+    With efficient_filter (faiss and lucene indices), filters are applied inside the knn clause, so the engine
+    finds the k nearest among the matching documents, instead of filtering the k nearest of the whole index
+    afterwards. nmslib indices reject that, the filters go into a bool query around the knn clause instead, which
+    filters POST_FILTER_K_FACTOR times as many nearest neighbours.
+    """
+    knn = {"vector": vectors, "k": k or size}
+    query = {"knn": {vector_field: knn}}
+    if filters and efficient_filter:
+        knn["filter"] = search_filter(filters)
+    elif filters:
+        knn["k"] = min(knn["k"] * POST_FILTER_K_FACTOR, MAX_K)
+        query = {"bool": {"must": [query], "filter": search_filter(filters)["bool"]["filter"]}}
+    return {
+        "size": size,
+        "query": query,
+        # the vectors are not needed in the response, leaving them out keeps the hits small
+        "_source": {"excludes": [vector_field]},
+        "fields": ["text"],
+    }
+
+
+def bm25_query(text, size, vector_field='vector_field', filters=None):
+    """
+    Lexical (BM25) search over the text field of the chunks.
+    """
+    query = {
+        "match": {
+            "text": {"query": text}
+        }
+    }
+    if filters:
+        query = {"bool": {"must": [query], "filter": search_filter(filters)["bool"]["filter"]}}
+    return {
+        "size": size,
+        "query": query,
+        "_source": {"excludes": [vector_field]},
+        "fields": ["text"],
+    }
+
+
+def reciprocal_rank_fusion(hit_lists, size, rank_constant=DEFAULT_RANK_CONSTANT, weights=None):
+    """
+    Merges ranked hit lists by summing weight / (rank_constant + rank) per document id.
+    Only ranks are used, so the incomparable BM25 and kNN scores never have to be normalized.
+    :return: The fused hits, best first, with the fused score as _score
+    """
+    weights = weights or [1.0] * len(hit_lists)
+    scores = {}
+    hits_by_id = {}
+    for hits, weight in zip(hit_lists, weights):
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + weight / (rank_constant + rank)
+            hits_by_id.setdefault(hit['_id'], hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+    return [dict(hits_by_id[doc_id], _score=scores[doc_id]) for doc_id in ranked]
+
+
+def hit_text(hit):
+    return ' '.join(hit.get('fields', {}).get('text', [])) or hit.get('_source', {}).get('text', '')
+
+
+def bm25_scores(query_terms, documents, k1=1.2, b=0.75):
+    """
+    BM25 score of every tokenized document for the query terms, the same formula OpenSearch uses.
+    """
+    if not documents:
+        return []
+    average_length = sum(len(document) for document in documents) / len(documents) or 1
+    frequencies = [{} for _ in documents]
+    for counts, document in zip(frequencies, documents):
+        for token in document:
+            counts[token] = counts.get(token, 0) + 1
+    scores = [0.0] * len(documents)
+    for term in set(query_terms):
+        containing = sum(1 for counts in frequencies if term in counts)
+        if not containing:
+            continue
+        idf = math.log(1 + (len(documents) - containing + 0.5) / (containing + 0.5))
+        for position, counts in enumerate(frequencies):
+            frequency = counts.get(term, 0)
+            if frequency:
+                norm = k1 * (1 - b + b * len(documents[position]) / average_length)
+                scores[position] += idf * frequency * (k1 + 1) / (frequency + norm)
+    return scores
+
+
+def lexical_rerank(question, hits):
+    """
+    Local reranker without a model: scores each candidate by BM25 over the candidate set itself,
+    so a chunk that covers more of the question's terms moves up.
+    """
+    query_terms = TOKEN_PATTERN.findall(question.lower())
+    scores = bm25_scores(query_terms, [TOKEN_PATTERN.findall(hit_text(hit).lower()) for hit in hits])
+    order = sorted(range(len(hits)), key=lambda position: scores[position], reverse=True)
+    return [hits[position] for position in order]
+
+
+def cross_encoder_reranker(model_name):
+    """
+    Reranks with a local cross-encoder model. Needs the optional sentence-transformers package.
+    """
+    from sentence_transformers import CrossEncoder
+
+    model = CrossEncoder(model_name)
+
+    def rerank(question, hits):
+        scores = model.predict([(question, hit_text(hit)) for hit in hits])
+        order = sorted(range(len(hits)), key=lambda position: scores[position], reverse=True)
+        return [hits[position] for position in order]
+    return rerank
+
+
+class Retriever:
+    """
+    Builds the searches for a question and combines their responses.
+    In "knn" mode this is the single kNN query; in "hybrid" mode a BM25 match query and the kNN query each
+    fetch `candidates` hits, the two lists are fused with reciprocal rank fusion, optionally reranked, and
+    the top `size` are returned.
+    """
+
+    def __init__(self, mode='knn', candidates=DEFAULT_CANDIDATES, size=DEFAULT_SIZE, vector_field='vector_field',
+                 rank_constant=DEFAULT_RANK_CONSTANT, rerank=None, efficient_filter=False):
+        """
+        :param efficient_filter: Whether the index filters inside the knn clause, see knn_query: a bool, or a
+            function returning it, for an alias that can be switched to an index with another engine
+        """
+        self.mode = mode
+        self.candidates = candidates
+        self.size = size
+        self.vector_field = vector_field
+        self.rank_constant = rank_constant
+        self.rerank = rerank
+        self.efficient_filter = efficient_filter
+
+    def knn_filter_supported(self):
+        supported = self.efficient_filter() if callable(self.efficient_filter) else self.efficient_filter
+        return bool(supported)
+
+    def requests(self, question, vectors, filters=None):
+        """
+        :param filters: Metadata filters both searches are narrowed to, see search_filter
+        :return: The search bodies to send, in one msearch when there is more than one
+        """
+        efficient_filter = self.knn_filter_supported() if filters else False
+        if self.mode != 'hybrid':
+            return [knn_query(vectors, self.size, vector_field=self.vector_field, filters=filters,
+                              efficient_filter=efficient_filter)]
+        return [
+            knn_query(vectors, self.candidates, vector_field=self.vector_field, filters=filters,
+                      efficient_filter=efficient_filter),
+            bm25_query(question, self.candidates, vector_field=self.vector_field, filters=filters),
+        ]
+
+    def combine(self, question, responses):
+        """
+        :return: A search response shaped like OpenSearch's, holding the final hits
+        """
+        if self.mode != 'hybrid':
+            return responses[0]
+        # an msearch entry that failed on its own holds an error instead of hits, the other searches still count
+        for response in responses:
+            if 'error' in response:
+                logger.warning(f"A hybrid search part failed, fusing the others: {response['error']}")
+        responses = [response for response in responses if 'error' not in response]
+        if not responses:
+            raise RuntimeError('every search of the hybrid query failed')
+        hits = reciprocal_rank_fusion([response['hits']['hits'] for response in responses],
+                                      size=self.candidates, rank_constant=self.rank_constant)
+        if self.rerank is not None:
+            hits = self.rerank(question, hits)
+        took = max(response.get('took', 0) for response in responses)
+        return {'took': took, 'hits': {'hits': hits[:self.size]}}
+
+    def search(self, client, index_name, question, vectors, filters=None):
+        bodies = self.requests(question, vectors, filters)
+        if len(bodies) == 1:
+            return self.combine(question, [client.search(body=bodies[0], index=index_name)])
+        return self.combine(question, msearch(client, index_name, bodies))
+
+
+def msearch_body(bodies):
+    lines = []
+    for body in bodies:
+        lines.extend([{}, body])
+    return lines
+
+
+def msearch(client, index_name, bodies):
+    """
+    Runs several searches in one round trip.
+    :return: The list of responses, in the order of bodies
+    """
+    response = client.msearch(body=msearch_body(bodies), index=index_name)
+    return response['responses']
+
+
+def build_retriever_from_env():
+    """
+    Builds the retriever configured by the environment: retrieval_mode (knn or hybrid), retrieval_candidates,
+    retrieval_size and retrieval_rerank (lexical, or cross-encoder:<model name>).
+    """
+    rerank = os.getenv('retrieval_rerank')
+    if rerank == 'lexical':
+        rerank = lexical_rerank
+    elif rerank and rerank.startswith('cross-encoder:'):
+        rerank = cross_encoder_reranker(rerank.split(':', 1)[1])
+    else:
+        rerank = None
+    return Retriever(
+        mode=os.getenv('retrieval_mode', 'knn'),
+        candidates=int(os.getenv('retrieval_candidates', DEFAULT_CANDIDATES)),
+        size=int(os.getenv('retrieval_size', DEFAULT_SIZE)),
+        vector_field=os.getenv('vector_field_name', 'vector_field'),
+        rerank=rerank,
+    )
@@ -0,0 +1,152 @@
+"""
+Helpers for the SQS consumer side of the indexer: how a failed record goes back to the queue, and what makes a
+record a poison message. The queue's visibility timeout is several times the function timeout, so the records of
+a batch stay invisible for as long as the handler can work on them.
+
+The event source mapping deletes the records the handler doesn't report as failures and leaves the reported ones
+in flight until their visibility timeout runs out, so the handler decides when a failed record is retried by
+setting its visibility: a record that failed because Bedrock or OpenSearch throttled waits an exponentially
+growing, jittered delay before it is received again, instead of coming back into the same overloaded downstream.
+After maxReceiveCount receives the queue's redrive policy moves it to the dead-letter queue. A poison message,
+one that fails the same way however often it is retried, is sent to the dead-letter queue right away.
+"""
+import random
+import time
+
+from embedding_executor import is_throttling_error
+from opensearch_bulk import is_rejected
+
+DEFAULT_RETRY_BASE_SECONDS = 5
+DEFAULT_RETRY_MAX_SECONDS = 300
+# The largest visibility timeout SQS accepts
+MAX_VISIBILITY_SECONDS = 12 * 60 * 60
+SQS_BATCH_SIZE = 10
+
+# Bedrock errors for a request that is invalid in itself, such as a text that is too long for the model
+NON_RETRYABLE_ERROR_CODES = ('ValidationException', 'AccessDeniedException')
+# _bulk item errors for a document the index will never accept
+NON_RETRYABLE_BULK_ERRORS = ('mapper_parsing_exception', 'document_parsing_exception', 'illegal_argument_exception',
+                             'strict_dynamic_mapping_exception')
+
+
+class PoisonMessage(Exception):
+    """
+    A record that can't be processed however often it is retried.
+    """
+
+
+def queue_url_from_arn(arn):
+    """
+    :param arn: A queue ARN, like the eventSourceARN of an SQS record: arn:aws:sqs:<region>:<account>:<name>
+    :return: The queue URL
+    """
+    _, partition, _, region, account, name = arn.split(':', 5)
+    domain = 'amazonaws.com.cn' if partition == 'aws-cn' else 'amazonaws.com'
+    return f'https://sqs.{region}.{domain}/{account}/{name}'
+
+
+def is_retryable(error):
+    """
+    :param error: An exception, or the error of a failed _bulk item (a dict with a type, or a status code)
+    :return: False for a poison message, True for an error that can go away on a retry (throttling, timeouts, 5xx)
+    """
+    if isinstance(error, PoisonMessage):
+        return False
+    if isinstance(error, dict):
+        return error.get('type') not in NON_RETRYABLE_BULK_ERRORS
+    if isinstance(error, int):
+        return error == 429 or error >= 500
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return is_throttling_error(error) or code not in NON_RETRYABLE_ERROR_CODES
+
+
+def is_throttled(error):
+    """
+    :return: True for a Bedrock throttling error or a _bulk item OpenSearch rejected because it is overloaded
+    """
+    return is_rejected(error) or is_throttling_error(error)
+
+
+def retry_delay(receive_count, base=DEFAULT_RETRY_BASE_SECONDS, maximum=DEFAULT_RETRY_MAX_SECONDS):
+    """
+    The visibility timeout of a record that failed on its receive_count-th receive: at least base seconds, and up
+    to base * 2^(receive_count - 1) seconds, so the retries of one throttled burst are spread out.
+    """
+    ceiling = min(maximum, base * 2 ** max(0, receive_count - 1))
+    return int(random.uniform(base, max(base, ceiling)))
+
+
+def receive_count(record):
+    return int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+
+
+def change_visibility(sqs, queue_url, receipts):
+    """
+    Sets the visibility timeout of in-flight messages, SQS_BATCH_SIZE at a time.
+    :param receipts: (receipt handle, timeout seconds) tuples
+    :return: The number of messages whose visibility could not be changed
+    """
+    failed = 0
+    for start in range(0, len(receipts), SQS_BATCH_SIZE):
+        entries = [
+            {'Id': str(position), 'ReceiptHandle': receipt, 'VisibilityTimeout': min(timeout, MAX_VISIBILITY_SECONDS)}
+            for position, (receipt, timeout) in enumerate(receipts[start:start + SQS_BATCH_SIZE])
+        ]
+        try:
+            failed += len(sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=entries).get('Failed', []))
+        except Exception as e:
+            print(f"Failed to change the visibility of {len(entries)} messages: {e}")
+            failed += len(entries)
+    return failed
+
+
+def release_for_retry(sqs, queue_url, records, base=DEFAULT_RETRY_BASE_SECONDS, maximum=DEFAULT_RETRY_MAX_SECONDS):
+    """
+    Hides failed records for their retry delay. A record whose visibility can't be changed is still retried,
+    after the queue's visibility timeout.
+    """
+    return change_visibility(sqs, queue_url, [
+        (record['receiptHandle'], retry_delay(receive_count(record), base, maximum)) for record in records
+    ])
+
+
+def send_to_dead_letter(sqs, dead_letter_url, records, errors):
+    """
+    Sends poison records to the dead-letter queue with the error as a message attribute.
+    :param errors: The error of every record, by message id
+    :return: The message ids of the records that could not be sent, they have to be reported as failures instead
+    """
+    unsent = []
+    for start in range(0, len(records), SQS_BATCH_SIZE):
+        chunk = records[start:start + SQS_BATCH_SIZE]
+        entries = [{
+            'Id': str(position),
+            'MessageBody': record['body'],
+            'MessageAttributes': {
+                'error': {'DataType': 'String', 'StringValue': str(errors[record['messageId']])[:1024] or 'unknown'},
+                'source_message_id': {'DataType': 'String', 'StringValue': record['messageId']},
+            },
+        } for position, record in enumerate(chunk)]
+        try:
+            failed = sqs.send_message_batch(QueueUrl=dead_letter_url, Entries=entries).get('Failed', [])
+            unsent.extend(chunk[int(failure['Id'])]['messageId'] for failure in failed)
+        except Exception as e:
+            print(f"Failed to send {len(chunk)} messages to the dead-letter queue: {e}")
+            unsent.extend(record['messageId'] for record in chunk)
+    return unsent
+
+
+class Deadline:
+    """
+    The time the handler has to stop starting work by, a margin before the Lambda function times out, so the
+    records it couldn't finish are reported as failures rather than lost with a timed out invocation.
+    """
+
+    def __init__(self, context=None, margin=5.0):
+        """
+        :param context: The Lambda context, None (no deadline) outside of Lambda
+        :param margin: Seconds kept back for the bulk write and returning the failures
+        """
+        remaining = context.get_remaining_time_in_millis() / 1000 if context is not None else None
+        self.at = time.monotonic() + remaining - margin if remaining is not None else None
+
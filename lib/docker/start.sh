@@ -1,12 +1,11 @@
 #!/bin/bash
 
-FLAG_FILE="/usr/src/app/.initialized"
-
-if [ ! -f $FLAG_FILE ]; then
-  # Run the script to index documents to OpenSearch
-  python docs_to_openSearch.py
-  touch $FLAG_FILE
-fi
+# Run the script to index documents to OpenSearch. Chunks get deterministic ids and the ones already
+# sent are recorded in the ingest manifest, so a re-run only sends new, changed and removed chunks.
+# The container's file system does not outlive the task, so a new task rebuilds the manifest from the
+# source field and _id of the documents in the index before it compares.
+export ingest_manifest_path="${ingest_manifest_path:-/usr/src/app/.ingest_manifest.json}"
+python docs_to_openSearch.py
 
 # Start Streamlit
 streamlit run app.py
\ No newline at end of file
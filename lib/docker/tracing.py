@@ -0,0 +1,275 @@
+"""
+Per-stage timing spans for the query path and the indexer.
+
+A trace is a tree of spans: the root is one request (a question, or one SQS batch for the indexer) and its
+children are the stages (embed, search, prompt, converse, render, bulk). A trace is exported once its root and
+every span started under it have ended, so the stages of a streamed answer that outlive answer_query are
+still part of its trace. The exporter is chosen with the tracing_exporter environment variable:
+  * emf:     one CloudWatch Embedded Metric Format log line per trace, with a <stage>_ms metric per stage;
+             printed from Lambda, CloudWatch Logs turns them into metrics without any API call. The query
+             containers' stdout goes through log drivers that don't extract EMF, there they are only log lines
+  * otel:    OpenTelemetry spans, through the tracer provider the process configured (needs opentelemetry-api)
+  * memory:  kept in process, for tests and benchmarks
+  * none:    not exported
+"""
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+DEFAULT_NAMESPACE = 'RagApp'
+# CloudWatch takes at most 100 metrics per EMF document and 100 values per metric
+EMF_MAX_METRICS = 100
+EMF_MAX_VALUES = 100
+
+# The span the code running in this thread or asyncio task is in
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    One timed stage. Attributes describe what the stage worked on (hits, tokens, cache hits...).
+    A span can be used as a context manager, which ends it and records the error that escaped it.
+    """
+
+    def __init__(self, tracer, name, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.start_ns = time.time_ns()
+        self.duration_ms = None
+        self._started = time.perf_counter()
+        if parent is None:
+            self._open = 0
+            self._exported = False
+            self._lock = threading.Lock()
+        with self.root._lock:
+            self.root._open += 1
+            if parent is not None:
+                parent.children.append(self)
+
+    @property
+    def end_ns(self):
+        return self.start_ns + int((self.duration_ms or 0) * 1e6)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._started) * 1000
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def end(self, **attributes):
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = self.elapsed_ms()
+        self.attributes.update(attributes)
+        with self.root._lock:
+            self.root._open -= 1
+            export = self.root._open == 0 and self.root.duration_ms is not None and not self.root._exported
+            if export:
+                self.root._exported = True
+        if export:
+            self.tracer.export(self.root)
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is not None:
+            self.set(error=error_type.__name__)
+        self.end()
+        return False
+
+
+class Tracer:
+    """
+    Creates spans for a service and hands finished traces to an exporter.
+    """
+
+    def __init__(self, service, exporter=None):
+        self.service = service
+        self.exporter = exporter
+
+    def current(self):
+        return _current_span.get()
+
+    def start_span(self, name, parent=None, **attributes):
+        """
+        Starts a span under parent, or under the current span, or as the root of a new trace. The span does not
+        become the current one, so it can be ended from another thread or task; end it with end() or a with block.
+        """
+        return Span(self, name, parent if parent is not None else self.current(), attributes)
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attributes):
+        """
+        Times the with block as a span that is the current span inside it.
+        """
+        span = self.start_span(name, parent, **attributes)
+        token = _current_span.set(span)
+        try:
+            with span:
+                yield span
+        finally:
+            _current_span.reset(token)
+
+    def timed(self, name, fn, parent=None):
+        """
+        Wraps fn so every call is timed as a span under parent, for calls made from worker threads.
+        """
+        def timed_fn(*args, **kwargs):
+            with self.start_span(name, parent):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    def export(self, root):
+        if self.exporter is not None:
+            try:
+                self.exporter.export(self.service, root)
+            except Exception as e:
+                # tracing must never fail the request it measures
+                print(f"Failed to export trace {root.trace_id}: {e}")
+
+
+def stage_durations(root):
+    """
+    :return: {span name: [durations in ms]} for the spans of a trace, in the order they started
+    """
+    durations = {}
+    for span in root.walk():
+        if span.duration_ms is not None:
+            durations.setdefault(span.name, []).append(round(span.duration_ms, 3))
+    return durations
+
+
+def json_value(value):
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+
+class EmfExporter:
+    """
+    Prints one CloudWatch Embedded Metric Format document per trace. Every stage becomes a <stage>_ms metric
+    under the Service and Operation (root span name) dimensions, a stage that ran several times (one embedding
+    call per record) reports all of its durations, and the span attributes become searchable properties.
+    """
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+
+    def document(self, service, root):
+        durations = stage_durations(root)
+        metrics = list(durations.items())[:EMF_MAX_METRICS]
+        document = {
+            '_aws': {
+                'Timestamp': root.start_ns // 1000000,
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Service', 'Operation']],
+                    'Metrics': [{'Name': f"{name}_ms", 'Unit': 'Milliseconds'} for name, _ in metrics],
+                }],
+            },
+            'Service': service,
+            'Operation': root.name,
+            'trace_id': root.trace_id,
+        }
+        for name, values in metrics:
+            document[f"{name}_ms"] = values[0] if len(values) == 1 else values[:EMF_MAX_VALUES]
+        for span in root.walk():
+            prefix = '' if span is root else f"{span.name}."
+            for key, value in span.attributes.items():
+                document.setdefault(f"{prefix}{key}", json_value(value))
+        return document
+
+    def export(self, service, root):
+        print(json.dumps(self.document(service, root)), file=self.stream or sys.stdout, flush=True)
+
+
+class OtelExporter:
+    """
+    Replays each finished trace as OpenTelemetry spans, with their original start and end times.
+    """
+
+    def __init__(self, service):
+        from opentelemetry import trace
+
+        self._trace = trace
+        self._tracer = trace.get_tracer(service)
+
+    def _replay(self, span, context):
+        otel_span = self._tracer.start_span(span.name, context=context, start_time=span.start_ns,
+                                            attributes={key: json_value(value) for key, value in span.attributes.items()
+                                                        if value is not None})
+        for child in span.children:
+            self._replay(child, self._trace.set_span_in_context(otel_span))
+        otel_span.end(end_time=span.end_ns)
+
+    def export(self, service, root):
+        self._replay(root, None)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class MemoryExporter:
+    """
+    Keeps the finished traces, for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self.traces = []
+        self._lock = threading.Lock()
+
+    def export(self, service, root):
+        with self._lock:
+            self.traces.append(root)
+
+    def summary(self):
+        """
+        :return: {stage: {'count', 'p50_ms', 'p95_ms', 'p99_ms'}} over every trace
+        """
+        durations = {}
+        with self._lock:
+            for root in self.traces:
+                for name, values in stage_durations(root).items():
+                    durations.setdefault(name, []).extend(values)
+        return {name: {'count': len(values),
+                       'p50_ms': round(percentile(values, 0.50), 3),
+                       'p95_ms': round(percentile(values, 0.95), 3),
+                       'p99_ms': round(percentile(values, 0.99), 3)}
+                for name, values in durations.items()}
+
+
+def build_tracer_from_env(service):
+    """
+    Builds the tracer configured by the environment: tracing_exporter (emf, otel, memory or none) and
+    tracing_namespace, the CloudWatch namespace of the EMF metrics.
+    """
+    kind = os.getenv('tracing_exporter', 'emf')
+    if kind == 'emf':
+        exporter = EmfExporter(os.getenv('tracing_namespace', DEFAULT_NAMESPACE))
+    elif kind == 'otel':
+        exporter = OtelExporter(service)
+    elif kind == 'memory':
+        exporter = MemoryExporter()
+    elif kind == 'none':
+        exporter = None
+    else:
+        raise ValueError(f"Unknown tracing_exporter {kind!r}, expected emf, otel, memory or none")
+    return Tracer(service, exporter)
@@ -0,0 +1,375 @@
+"""
+A local vector store behind the same client interface as OpenSearch, so the indexer and the query path can run
+without AWS (rag_backend=local, see rag_clients.py) and be benchmarked on a laptop or in CI.
+
+It implements the subset of the opensearch-py client that this project calls (index, bulk, search, msearch, count
+and the indices and alias APIs) on top of the local OpenSearch stand-in. The vectors of each knn_vector field are
+float32 rows of a NumPy matrix searched by brute force; with a directory, the rows are appended to a file that is
+memory mapped for searching, and the documents to a JSON lines log, so the store survives restarts and a large
+index is paged in by the OS instead of being loaded up front. With approximate=True, searches go through the HNSW
+emulation of local_ann instead, with the parameters of the index mapping.
+
+One process writes to a store directory at a time.
+"""
+import itertools
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+from local_ann import SPACES, quantize
+from local_standins import FakeIndices, FakeOpenSearch, matches_filter, vector_graphs
+
+STATE_FILE = 'store.json'
+DOCUMENTS_FILE = 'documents.jsonl'
+
+
+def vector_fields(body):
+    """
+    :return: {field: (dimension, space type)} for the knn_vector fields of an index mapping
+    """
+    fields = {}
+    for field, mapping in body.get('mappings', {}).get('properties', {}).items():
+        if mapping.get('type') == 'knn_vector':
+            # l2 is what OpenSearch uses when the mapping leaves the space type out
+            fields[field] = (mapping['dimension'], mapping.get('method', {}).get('space_type', 'l2'))
+    return fields
+
+
+def is_vector(value):
+    return isinstance(value, list) and len(value) > 1 and all(isinstance(x, (int, float)) for x in value[:8])
+
+
+class VectorColumn:
+    """
+    The vectors of one knn_vector field of an index. Rows are only appended: a document that is rewritten gets a
+    new row and its previous row, like the row of a deleted document, is masked out of searches.
+    """
+
+    def __init__(self, path, dimension, space_type='l2'):
+        self.path = path
+        self.dimension = dimension
+        self.space_type = space_type
+        self.to_score = SPACES[space_type][1]
+        rows = os.path.getsize(path) // (4 * dimension) if path and os.path.exists(path) else 0
+        # the document id of every row, None for the rows that are no longer searched
+        self.ids = [None] * rows
+        self._live = bytearray(rows)
+        self._file = open(path, 'ab') if path else None
+        self._buffer = []
+        self._matrix = self._map(rows) if path else np.zeros((0, dimension), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def _map(self, rows):
+        if not rows:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode='r', shape=(rows, self.dimension))
+
+    def append(self, doc_id, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != (self.dimension,):
+            raise ValueError(f"mapper_parsing_exception: vector of {vector.size} dimensions, "
+                             f"the field takes {self.dimension}")
+        with self._lock:
+            row = len(self.ids)
+            if self._file:
+                self._file.write(vector.tobytes())
+            else:
+                self._buffer.append(vector)
+            self.ids.append(doc_id)
+            self._live.append(1)
+        return row
+
+    def restore(self, row, doc_id):
+        self.ids[row] = doc_id
+        self._live[row] = 1
+
+    def kill(self, row):
+        self.ids[row] = None
+        self._live[row] = 0
+
+    def flush(self):
+        if self._file:
+            self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+    def _sync(self):
+        """
+        Brings the matrix and the squared row norms up to the appended rows.
+        :return: (matrix, squared norms, live mask)
+        """
+        with self._lock:
+            rows = len(self.ids)
+            if self._matrix.shape[0] < rows:
+                if self._file:
+                    self._file.flush()
+                    self._matrix = self._map(rows)
+                else:
+                    self._matrix = np.vstack([self._matrix, np.stack(self._buffer)])
+                    self._buffer = []
+            if self._norms.shape[0] < rows:
+                added = self._matrix[self._norms.shape[0]:rows]
+                self._norms = np.concatenate([self._norms, np.einsum('ij,ij->i', added, added)])
+            return self._matrix[:rows], self._norms[:rows], np.frombuffer(bytes(self._live[:rows]), dtype=bool)
+
+    def vector(self, row):
+        matrix, _, _ = self._sync()
+        return matrix[row].tolist()
+
+    def search(self, vector, k, rows=None):
+        """
+        Exact k nearest rows, scored the way OpenSearch scores the space type.
+        :param rows: Only search these rows, the ones of the documents that match a filter
+        :return: [(score, doc_id)], best first
+        """
+        matrix, norms, live = self._sync()
+        if rows is not None:
+            allowed = np.zeros(len(live), dtype=bool)
+            allowed[np.asarray(rows, dtype=np.int64)] = True
+            live = live & allowed
+        k = min(k, int(live.sum()))
+        if k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        products = matrix @ query
+        if self.space_type == 'l2':
+            distances = norms - 2 * products + query @ query
+        elif self.space_type == 'innerproduct':
+            distances = -products
+        else:
+            lengths = np.sqrt(norms) * np.linalg.norm(query)
+            distances = 1 - products / np.where(lengths == 0, 1, lengths)
+        distances = np.where(live, distances, np.inf)
+        top = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        top = top[np.argsort(distances[top])]
+        return [(self.to_score(float(distances[row])), self.ids[row]) for row in top]
+
+
+class LocalIndices(FakeIndices):
+    """
+    The indices API of the local store, persisting index and alias changes to the store directory.
+    """
+
+    def create(self, index, body=None):
+        response = super().create(index, body)
+        with self.store.lock:
+            self.store.open_index(index)
+            self.store.save_state()
+        return response
+
+    def delete(self, index):
+        response = super().delete(index)
+        with self.store.lock:
+            self.store.drop_index(index)
+            self.store.save_state()
+        return response
+
+    def update_aliases(self, body):
+        response = super().update_aliases(body)
+        with self.store.lock:
+            for name in set(self.store.columns) - set(self.store.documents):
+                self.store.drop_index(name)
+            self.store.save_state()
+        return response
+
+
+class LocalVectorStore(FakeOpenSearch):
+    """
+    OpenSearch-compatible local vector store, kept in memory or persisted in a directory.
+    :param path: The store directory, created when missing; None keeps everything in memory
+    :param approximate: Search through HNSW graphs built with each index's mapping instead of exactly
+    """
+
+    def __init__(self, path=None, latency=0.0, approximate=False, throttle_rate=0.0):
+        super().__init__(latency=latency, approximate=approximate, throttle_rate=throttle_rate)
+        self.path = path
+        self.indices = LocalIndices(self)
+        # {index: {field: VectorColumn}} and {index: {doc_id: {field: row}}}
+        self.columns = {}
+        self.rows = {}
+        self._logs = {}
+        # automatic ids stay unique across restarts
+        self._ids = (uuid.uuid4().hex for _ in itertools.count())
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    def _index_path(self, index, name=None):
+        return os.path.join(self.path, index, name) if name else os.path.join(self.path, index)
+
+    def _load(self):
+        state_path = os.path.join(self.path, STATE_FILE)
+        if not os.path.exists(state_path):
+            return
+        with open(state_path) as f:
+            state = json.load(f)
+        self.aliases = {alias: set(targets) for alias, targets in state['aliases'].items()}
+        for index, body in state['indices'].items():
+            self.documents[index] = {}
+            self.settings[index] = body
+            self.graphs[index] = vector_graphs(body) if self.approximate else {}
+            self.open_index(index)
+            self._replay(index)
+
+    def _replay(self, index):
+        log_path = self._index_path(index, DOCUMENTS_FILE)
+        if not os.path.exists(log_path):
+            return
+        columns = self.columns[index]
+        with open(log_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a log that was being written when the process stopped
+                    continue
+                self._forget(index, entry['_id'])
+                if entry.get('deleted'):
+                    self.documents[index].pop(entry['_id'], None)
+                    continue
+                self.documents[index][entry['_id']] = entry['_source']
+                self.rows[index][entry['_id']] = entry['rows']
+                for field, row in entry['rows'].items():
+                    columns[field].restore(row, entry['_id'])
+        for field, (graph, quantization) in self.graphs[index].items():
+            for doc_id, rows in self.rows[index].items():
+                if field in rows:
+                    graph.add(doc_id, quantize(columns[field].vector(rows[field]), quantization))
+
+    def save_state(self):
+        if not self.path:
+            return
+        state = {'indices': self.settings, 'aliases': {alias: sorted(targets) for alias, targets in self.aliases.items()}}
+        state_path = os.path.join(self.path, STATE_FILE)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def open_index(self, index):
+        """
+        Sets up the vector columns and the document log of an index that is in the settings.
+        """
+        self.rows.setdefault(index, {})
+        columns = self.columns.setdefault(index, {})
+        if self.path:
+            os.makedirs(self._index_path(index), exist_ok=True)
+            self._logs.setdefault(index, open(self._index_path(index, DOCUMENTS_FILE), 'a'))
+        for field, (dimension, space_type) in vector_fields(self.settings[index]).items():
+            if field not in columns:
+                columns[field] = VectorColumn(self._index_path(index, f"{field}.f32") if self.path else None,
+                                              dimension, space_type)
+
+    def drop_index(self, index):
+        for column in self.columns.pop(index, {}).values():
+            column.close()
+        self.rows.pop(index, None)
+        log = self._logs.pop(index, None)
+        if log:
+            log.close()
+        if self.path:
+            shutil.rmtree(self._index_path(index), ignore_errors=True)
+
+    def _columns(self, index, source):
+        """
+        The vector columns of an index, creating the index on its first write the way OpenSearch does, with a
+        knn_vector mapping for the vector fields of the document.
+        """
+        if index not in self.settings:
+            self.settings[index] = {}
+            self.open_index(index)
+            self.save_state()
+        new_fields = {field: value for field, value in source.items()
+                      if field not in self.columns[index] and is_vector(value)}
+        if new_fields:
+            properties = self.settings[index].setdefault('mappings', {}).setdefault('properties', {})
+            for field, value in new_fields.items():
+                properties[field] = {'type': 'knn_vector', 'dimension': len(value)}
+            self.open_index(index)
+            self.save_state()
+        return self.columns[index]
+
+    def _forget(self, index, doc_id):
+        rows = self.rows[index].pop(doc_id, None)
+        for field, row in (rows or {}).items():
+            self.columns[index][field].kill(row)
+        return rows is not None
+
+    def _log(self, index, entry):
+        if index in self._logs:
+            self._logs[index].write(json.dumps(entry) + '\n')
+
+    def _store(self, index, doc_id, source):
+        columns = self._columns(index, source)
+        self._forget(index, doc_id)
+        rows = {field: column.append(doc_id, source[field]) for field, column in columns.items() if field in source}
+        stored = {key: value for key, value in source.items() if key not in rows}
+        self._index(index)[doc_id] = stored
+        self.rows[index][doc_id] = rows
+        self._log(index, {'_id': doc_id, '_source': stored, 'rows': rows})
+        for field, (graph, quantization) in self.graphs.get(index, {}).items():
+            if field in source:
+                graph.add(doc_id, quantize(source[field], quantization))
+
+    def _remove(self, index, doc_id):
+        self._index(index).pop(doc_id, None)
+        found = index in self.rows and self._forget(index, doc_id)
+        if found:
+            self._log(index, {'_id': doc_id, 'deleted': True})
+        for graph, _ in self.graphs.get(index, {}).values():
+            if doc_id in graph.vectors:
+                graph.remove(doc_id)
+        return found
+
+    def flush(self):
+        """
+        Writes the appended vectors and then the document logs to disk.
+        """
+        for columns in self.columns.values():
+            for column in columns.values():
+                column.flush()
+        for log in self._logs.values():
+            log.flush()
+
+    def index(self, index, body, id=None, refresh=False):
+        response = super().index(index, body, id=id, refresh=refresh)
+        self.flush()
+        return response
+
+    def bulk(self, body, index=None, refresh=False):
+        response = super().bulk(body, index=index, refresh=refresh)
+        self.flush()
+        return response
+
+    def _knn(self, targets, field, vector, k, filter=None):
+        if self.approximate and all(self.graphs.get(target, {}).get(field) for target in targets):
+            return super()._knn(targets, field, vector, k, filter)
+        scored = []
+        for target in targets:
+            column = self.columns.get(target, {}).get(field)
+            if column is None:
+                continue
+            sources = self.documents[target]
+            rows = None
+            if filter is not None:
+                rows = [self.rows[target][doc_id][field] for doc_id, source in sources.items()
+                        if matches_filter(source, filter) and field in self.rows[target].get(doc_id, {})]
+            scored += [(score, doc_id, sources[doc_id]) for score, doc_id in column.search(vector, k, rows)]
+        scored.sort(key=lambda hit: hit[0], reverse=True)
+        return scored[:k]
+
+    def _hit_source(self, targets, doc_id, source, body):
+        excludes = body.get('_source', {}).get('excludes', []) if isinstance(body.get('_source'), dict) else []
+        for target in targets:
+            rows = self.rows.get(target, {}).get(doc_id)
+            if rows is not None:
+                vectors = {field: self.columns[target][field].vector(row)
+                           for field, row in rows.items() if field not in excludes}
+                return dict(source, **vectors) if vectors else source
+        return source
@@ -12,6 +12,8 @@ interface ClusterProps extends cdk.StackProps {
   OpenSearchEndpoint: string,
   VectorIndexName: string,
   VectorFieldName: string,
+  EmbeddingModelId: string,
+  EmbeddingDimensions: string,
   domainName: string,
   sqs_queue_url: string,
   sqs_queue_arn: string,
@@ -70,6 +72,8 @@ export class EcsFargateCdkStack extends cdk.Stack {
           'opensearch_host': props.OpenSearchEndpoint,
           'vector_index_name': props.VectorIndexName,
           'vector_field_name': props.VectorFieldName,
+          'embedding_model_id': props.EmbeddingModelId,
+          'embedding_dimensions': props.EmbeddingDimensions,
           'sqs_queue_url': props.sqs_queue_url,
         },
       },
@@ -12,6 +12,8 @@ interface ClusterProps extends cdk.StackProps {
   OpenSearchEndpoint: string;
   VectorIndexName: string;
   VectorFieldName: string;
+  EmbeddingModelId: string;
+  EmbeddingDimensions: string;
   domainName: string,
   sqs_queue_url: string,
   sqs_queue_arn: string,
@@ -69,7 +71,7 @@ export class EksClusterStack extends cdk.Stack {
         hostedZoneResources: [GlobalResources.HostedZone]
       }),
       new StreamlitAppManifests(appImageAsset.imageUri, props.OpenSearchEndpoint, props.VectorIndexName, props.VectorFieldName,
-        props.sqs_queue_url, props.userPool.userPoolArn, props.userPoolClient.userPoolClientId, props.domainName, props.userPoolDomain.domainName, props.acmCertificate.certificateArn
+        props.EmbeddingModelId, props.EmbeddingDimensions, props.sqs_queue_url, props.userPool.userPoolArn, props.userPoolClient.userPoolClientId, props.domainName, props.userPoolDomain.domainName, props.acmCertificate.certificateArn
       )
     ];
 
@@ -154,6 +156,8 @@ class StreamlitAppManifests implements blueprints.ClusterAddOn {
   private readonly opensearchHost: string;
   private readonly vectorIndexName: string;
   private readonly vectorFieldName: string;
+  private readonly embeddingModelId: string;
+  private readonly embeddingDimensions: string;
   private readonly sqs_queue_url: string;
   private readonly userPoolArn: string;
   private readonly userPoolClientId: string;
@@ -162,12 +166,14 @@ class StreamlitAppManifests implements blueprints.ClusterAddOn {
   private readonly domainName: string;
 
   constructor(imageUri: string, opensearchHost: string, vectorIndexName: string, vectorFieldName: string,
-    sqs_queue_url: string, userPoolArn: string, userPoolClientId: string, domainName: string, userPoolDomain: string, acmCertificate: string
+    embeddingModelId: string, embeddingDimensions: string, sqs_queue_url: string, userPoolArn: string, userPoolClientId: string, domainName: string, userPoolDomain: string, acmCertificate: string
   ) {
     this.imageUri = imageUri;
     this.opensearchHost = opensearchHost;
     this.vectorIndexName = vectorIndexName;
     this.vectorFieldName = vectorFieldName;
+    this.embeddingModelId = embeddingModelId;
+    this.embeddingDimensions = embeddingDimensions;
     this.sqs_queue_url = sqs_queue_url
     this.userPoolArn = userPoolArn;
     this.userPoolClientId = userPoolClientId;
@@ -205,6 +211,10 @@ class StreamlitAppManifests implements blueprints.ClusterAddOn {
               value: ${this.vectorIndexName}
             - name: vector_field_name
               value: ${this.vectorFieldName}
+            - name: embedding_model_id
+              value: "${this.embeddingModelId}"
+            - name: embedding_dimensions
+              value: "${this.embeddingDimensions}"
             - name: sqs_queue_url
               value: ${this.sqs_queue_url}
             ports:
@@ -9,10 +9,35 @@ import * as fs from 'fs';
 import * as sqs from 'aws-cdk-lib/aws-sqs';
 import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
 
+// Python helpers shared by the Streamlit app and the Lambda functions live in lib/docker.
+// They are copied into the Lambda asset at synth time so both sides run the same code.
+const sharedPythonDir = path.join(__dirname, 'docker');
+
+// Builds a Python Lambda asset with its requirements.txt vendored in at synth time,
+// so cold starts don't have to pip install anything.
+function pythonLambdaCode(assetPath: string, sharedModules: string[]): lambda.Code {
+  const copyShared = sharedModules.map((module) => `cp /shared/${module} /asset-output/`);
+  return lambda.Code.fromAsset(assetPath, {
+    // Hash the bundled output, otherwise edits to the shared modules would not trigger a redeploy
+    assetHashType: cdk.AssetHashType.OUTPUT,
+    bundling: {
+      image: lambda.Runtime.PYTHON_3_9.bundlingImage,
+      volumes: [{ hostPath: sharedPythonDir, containerPath: '/shared' }],
+      command: ['bash', '-c', [
+        'pip install --no-cache-dir -q -r requirements.txt -t /asset-output',
+        'cp -au . /asset-output',
+        ...copyShared,
+      ].join(' && ')],
+    },
+  });
+}
+
 export class OpensearchBedrockRagCdkStack extends cdk.Stack {
   OpenSearchEndpoint: string
   VectorIndexName: string
   VectorFieldName: string
+  EmbeddingModelId: string
+  EmbeddingDimensions: string
   sqs_queue_url: string
   sqs_queue_arn: string
   bedrockPolicy: iam.Policy
@@ -118,7 +143,7 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
       }),
       handler: 'index.handler',
       runtime: lambda.Runtime.PYTHON_3_9,
-      code: lambda.Code.fromAsset('lambda/aoss'), // Path to your Lambda function code
+      code: pythonLambdaCode('lambda/aoss', ['rag_clients.py', 'index_profiles.py', 'embedders.py']), // Path to your Lambda function code
       timeout: cdk.Duration.minutes(5),
     });
 
@@ -169,37 +194,49 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
 
     const Endpoint = `${collection.attrId}.${cdk.Stack.of(this).region}.aoss.amazonaws.com`;
 
+    // The ANN index profile (engine, HNSW parameters, quantization), see lib/docker/index_profiles.py. Set it with
+    // `cdk deploy -c vectorIndexProfile=balanced` or a JSON object such as '{"base": "balanced", "m": 24}';
+    // changing it builds a new index next to the live one, which lib/docker/reindex.py backfills and switches the
+    // vector index alias over to (the alias only moves on deploy while the live index is still empty).
+    const vectorIndexProfileContext = this.node.tryGetContext('vectorIndexProfile') ?? 'default'
+    const vectorIndexProfile = typeof vectorIndexProfileContext === 'string' && vectorIndexProfileContext.trim().startsWith('{')
+      ? JSON.parse(vectorIndexProfileContext) : vectorIndexProfileContext
+    // The embedding model, and its output size for Titan v2 (256, 512 or 1024; empty for the model's default),
+    // see lib/docker/embedders.py. The index mapping, the indexer and the query side all use it.
+    const embeddingModelId = this.node.tryGetContext('embeddingModelId') ?? 'amazon.titan-embed-text-v1'
+    const embeddingDimensions = String(this.node.tryGetContext('embeddingDimensions') ?? '')
+    const vector_field_name= 'vector_field'
+
+    const indexRequest = (requestType: string) => ({
+      service: 'Lambda',
+      action: 'invoke',
+      parameters: {
+        FunctionName: createIndexLambda.functionName,
+        InvocationType: 'RequestResponse',
+        Payload: JSON.stringify({
+          RequestType: requestType,
+          CollectionName: collection.name,
+          IndexName: vectorIndexName,
+          Endpoint: Endpoint,
+          IndexProfile: vectorIndexProfile,
+          EmbeddingModelId: embeddingModelId,
+          EmbeddingDimensions: embeddingDimensions || undefined,
+          VectorFieldName: vector_field_name,
+        }),
+      },
+    })
+
     const vectorIndex = new cr.AwsCustomResource(this, 'vectorIndexResource', {
       installLatestAwsSdk: true,
       onCreate: {
-        service: 'Lambda',
-        action: 'invoke',
-        parameters: {
-          FunctionName: createIndexLambda.functionName,
-          InvocationType: 'RequestResponse',
-          Payload: JSON.stringify({
-            RequestType: 'Create',
-            CollectionName: collection.name,
-            IndexName: vectorIndexName,
-            Endpoint: Endpoint,
-          }),
-        },
+        ...indexRequest('Create'),
         physicalResourceId: cr.PhysicalResourceId.of('vectorIndex'),
       },
-      onDelete: {
-        service: 'Lambda',
-        action: 'invoke',
-        parameters: {
-          FunctionName: createIndexLambda.functionName,
-          InvocationType: 'RequestResponse',
-          Payload: JSON.stringify({
-            RequestType: 'Delete',
-            CollectionName: collection.name,
-            IndexName: vectorIndexName,
-            Endpoint: Endpoint,
-          }),
-        },
+      onUpdate: {
+        ...indexRequest('Update'),
+        physicalResourceId: cr.PhysicalResourceId.of('vectorIndex'),
       },
+      onDelete: indexRequest('Delete'),
       policy: cr.AwsCustomResourcePolicy.fromStatements([
         new iam.PolicyStatement({
           actions: ['lambda:InvokeFunction'],
@@ -212,13 +249,34 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
     // Ensure vectorIndex depends on collection
     vectorIndex.node.addDependency(collection);
     vectorIndex.node.addDependency(createIndexLambda);
-    const vector_field_name= 'vector_field'
+
+      // The indexer's SQS consumer settings, see lib/docker/sqs_consumer.py. Set them with, for example,
+      // `cdk deploy -c indexerBatchSize=50 -c indexerBatchingWindowSeconds=5 -c indexerMaxConcurrency=10`.
+      const indexerTimeoutSeconds = Number(this.node.tryGetContext('indexerTimeoutSeconds') ?? 120)
+      const indexerBatchSize = Number(this.node.tryGetContext('indexerBatchSize') ?? 10)
+      // A batch of more than 10 records needs a batching window
+      const indexerBatchingWindowSeconds = Number(this.node.tryGetContext('indexerBatchingWindowSeconds') ?? (indexerBatchSize > 10 ? 1 : 0))
+      const indexerMaxConcurrency = this.node.tryGetContext('indexerMaxConcurrency')
+      const indexerMaxReceiveCount = Number(this.node.tryGetContext('indexerMaxReceiveCount') ?? 5)
+
+      // Messages that failed indexerMaxReceiveCount times, and the ones the indexer can never process
+      const deadLetterQueue = new sqs.Queue(this, 'MyDeadLetterQueue', {
+        queueName: 'docs-queue-dlq',
+        retentionPeriod: cdk.Duration.days(14),
+        removalPolicy: cdk.RemovalPolicy.DESTROY,
+      });
 
       // Create an SQS queue
+      // The visibility timeout is six times the function timeout plus the batching window, so a batch whose
+      // invocation is throttled and retried by the event source mapping doesn't become visible again meanwhile
       const queue = new sqs.Queue(this, 'MyQueue', {
         queueName: 'docs-queue',
         retentionPeriod: cdk.Duration.days(1),
-        visibilityTimeout: cdk.Duration.seconds(30),
+        visibilityTimeout: cdk.Duration.seconds(6 * indexerTimeoutSeconds + indexerBatchingWindowSeconds),
+        deadLetterQueue: {
+          queue: deadLetterQueue,
+          maxReceiveCount: indexerMaxReceiveCount,
+        },
         removalPolicy: cdk.RemovalPolicy.DESTROY,
       });
 
@@ -231,6 +289,7 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
             ],
             resources: [
               "arn:aws:bedrock:us-east-1::foundation-model/amazon*",
+              "arn:aws:bedrock:us-east-1::foundation-model/cohere.embed*",
             ],
             effect: iam.Effect.ALLOW,
           }),
@@ -266,31 +325,46 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
     // Create a Lambda function
     const lambdaFunction = new lambda.Function(this, 'MyLambdaFunction', {
       functionName: 'docs-indexer',
-      timeout: cdk.Duration.seconds(20),
+      timeout: cdk.Duration.seconds(indexerTimeoutSeconds),
       runtime: lambda.Runtime.PYTHON_3_9,
       handler: 'index.handler',
-      code: lambda.Code.fromAsset('lambda/indexer'),
+      code: pythonLambdaCode('lambda/indexer', ['rag_clients.py', 'opensearch_bulk.py', 'embedding_executor.py', 'embedding_cache.py', 'indexing.py', 'embedders.py', 'tracing.py', 'sqs_consumer.py']),
       environment: {
         'opensearch_host': Endpoint,
         'vector_index_name': vectorIndexName,
         'vector_field_name': vector_field_name,
+        'embedding_model_id': embeddingModelId,
+        'embedding_dimensions': embeddingDimensions,
+        'dead_letter_queue_url': deadLetterQueue.queueUrl,
       },
     });
 
     lambdaFunction.role?.attachInlinePolicy(bedrockPolicy)
     lambdaFunction.role?.attachInlinePolicy(openSearchPolicy)
     lambdaFunction.addToRolePolicy(new iam.PolicyStatement({
-      actions: ['sqs:ReceiveMessage', 'sqs:DeleteMessage', 'sqs:GetQueueAttributes'],
+      actions: ['sqs:ReceiveMessage', 'sqs:DeleteMessage', 'sqs:GetQueueAttributes', 'sqs:ChangeMessageVisibility'],
       resources: [queue.queueArn],
       effect: iam.Effect.ALLOW,
     }));
+    // Poison messages are sent to the dead-letter queue by the handler
+    deadLetterQueue.grantSendMessages(lambdaFunction)
 
     // Configure the SQS queue as an event source for the Lambda function
-    lambdaFunction.addEventSource(new SqsEventSource(queue));
+    // The handler returns batchItemFailures so only the failed messages are redelivered, after the backoff delay
+    // it sets as their visibility timeout. maxConcurrency caps the concurrent invocations, and with them the load
+    // on Bedrock and OpenSearch, without the throttled invocations the function's reserved concurrency would cause.
+    lambdaFunction.addEventSource(new SqsEventSource(queue, {
+      batchSize: indexerBatchSize,
+      maxBatchingWindow: indexerBatchingWindowSeconds ? cdk.Duration.seconds(indexerBatchingWindowSeconds) : undefined,
+      maxConcurrency: indexerMaxConcurrency ? Number(indexerMaxConcurrency) : undefined,
+      reportBatchItemFailures: true,
+    }));
 
     this.OpenSearchEndpoint = Endpoint
     this.VectorIndexName = vectorIndexName
     this.VectorFieldName = vector_field_name
+    this.EmbeddingModelId = embeddingModelId
+    this.EmbeddingDimensions = embeddingDimensions
     this.sqs_queue_url = queue.queueUrl
     this.sqs_queue_arn = queue.queueArn
     this.bedrockPolicy = bedrockPolicy
@@ -298,12 +372,16 @@ export class OpensearchBedrockRagCdkStack extends cdk.Stack {
     
 
     new cdk.CfnOutput(this, 'aoss_env', {
-      value: `export opensearch_host=${Endpoint}\nexport vector_index_name=${vectorIndexName}\nexport vector_field_name=vector_field`
+      value: `export opensearch_host=${Endpoint}\nexport vector_index_name=${vectorIndexName}\nexport vector_field_name=vector_field\nexport embedding_model_id=${embeddingModelId}\nexport embedding_dimensions=${embeddingDimensions}`
     });
 
     new cdk.CfnOutput(this, 'sqs_queue_url', {
       value: queue.queueUrl
     });
 
+    new cdk.CfnOutput(this, 'sqs_dead_letter_queue_url', {
+      value: deadLetterQueue.queueUrl
+    });
+
   }
 }
@@ -0,0 +1,73 @@
+"""
+The Python modules are deployed as flat directories (the indexer Lambda, the query container), so the tests put
+those directories on the path the same way the benchmarks do, and run against the stand-ins in local_standins.py.
+"""
+import importlib.util
+import json
+import os
+import sys
+import types
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SHARED_DIR = os.path.join(REPO_ROOT, 'lib', 'docker')
+INDEXER_DIR = os.path.join(REPO_ROOT, 'lambda', 'indexer')
+sys.path[:0] = [SHARED_DIR, INDEXER_DIR]
+
+os.environ.setdefault('vector_index_name', 'rag-vector-index')
+os.environ.setdefault('vector_field_name', 'vector_field')
+os.environ.setdefault('tracing_exporter', 'memory')
+
+QUEUE_ARN = 'arn:aws:sqs:us-east-1:000000000000:docs-queue'
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/docs-queue'
+DEAD_LETTER_URL = 'https://sqs.us-east-1.amazonaws.com/000000000000/docs-queue-dlq'
+
+
+def load_indexer(bedrock, store, sqs):
+    """
+    A fresh copy of the indexer Lambda module, as a new container would load it, with the stand-ins as its clients.
+    """
+    spec = importlib.util.spec_from_file_location('indexer_under_test', os.path.join(INDEXER_DIR, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.rag_clients = types.SimpleNamespace(get_bedrock_client=lambda **kwargs: bedrock,
+                                               get_opensearch_client=lambda *args, **kwargs: store,
+                                               get_sqs_client=lambda **kwargs: sqs)
+    return module
+
+
+def send_messages(sqs, *bodies):
+    """
+    Queues messages on the stand-in queue, dicts as their JSON and strings as they are.
+    """
+    sqs.send_message_batch(QueueUrl=QUEUE_URL, Entries=[
+        {'Id': str(position), 'MessageBody': body if isinstance(body, str) else json.dumps(body)}
+        for position, body in enumerate(bodies)])
+
+
+def receive_event(sqs, count):
+    """
+    Receives up to count messages from the stand-in queue and shapes them like the SQS event of a Lambda.
+    """
+    messages = sqs.receive_message(QueueUrl=QUEUE_URL, MaxNumberOfMessages=count).get('Messages', [])
+    return {'Records': [{
+        'messageId': message['MessageId'],
+        'receiptHandle': message['ReceiptHandle'],
+        'body': message['Body'],
+        'attributes': message['Attributes'],
+        'eventSourceARN': QUEUE_ARN,
+    } for message in messages]}
+
+
+@pytest.fixture
+def indexer_env(monkeypatch):
+    monkeypatch.setenv('dead_letter_queue_url', DEAD_LETTER_URL)
+    monkeypatch.setenv('retry_base_seconds', '30')
+
+
+def failed_message_ids(response):
+    """
+    The message ids a handler response reports as batch item failures.
+    """
+    return [failure['itemIdentifier'] for failure in response['batchItemFailures']]
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache, IndexVersionTracker, normalize_question
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(answer_cache, 'time', SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def test_questions_match_regardless_of_case_spacing_and_trailing_punctuation():
+    assert normalize_question('  What is  SageMaker Clarify?? ') == normalize_question('what is sagemaker clarify')
+
+
+def test_exact_hits_expire_after_the_ttl(clock):
+    cache = AnswerCache(ttl_seconds=60)
+    cache.put('What is Clarify?', [1.0, 0.0], 'an answer')
+    assert cache.get('what is clarify') == 'an answer'
+    clock.value += 61
+    assert cache.get('what is clarify') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_the_least_recently_used_answer_is_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.put('a', [1.0], 'answer a')
+    cache.put('b', [1.0], 'answer b')
+    cache.get('a')
+    cache.put('c', [1.0], 'answer c')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'answer a' and cache.get('c') == 'answer c'
+
+
+def test_a_similar_question_is_served_only_above_the_threshold():
+    cache = AnswerCache(similarity_threshold=0.95)
+    cache.put('What does Clarify do?', [1.0, 0.0], 'clarify answer')
+    cache.put('What does Model Monitor do?', [0.0, 1.0], 'monitor answer')
+    assert cache.get_similar([0.99, 0.05]) == 'clarify answer'
+    assert cache.get_similar([0.7, 0.7]) is None
+    assert cache.stats() == {'entries': 2, 'exact_hits': 0, 'semantic_hits': 1, 'misses': 1}
+
+
+def test_semantic_hits_are_off_without_a_threshold():
+    cache = AnswerCache()
+    cache.put('What does Clarify do?', [1.0, 0.0], 'clarify answer')
+    assert cache.get_similar([1.0, 0.0]) is None
+
+
+def test_a_new_index_version_drops_every_answer():
+    cache = AnswerCache()
+    cache.check_index_version(10)
+    cache.put('a', [1.0], 'answer a')
+    cache.check_index_version(10)
+    assert cache.get('a') == 'answer a'
+    cache.check_index_version(11)
+    assert cache.get('a') is None
+
+
+def test_the_index_version_is_polled_at_most_once_per_interval(clock):
+    versions = iter([1, 2])
+    tracker = IndexVersionTracker(lambda: next(versions), interval=60)
+    assert tracker.current() == 1
+    clock.value += 30
+    assert tracker.current() == 1
+    clock.value += 30
+    assert tracker.current() == 2
+
+
+def test_a_failed_poll_keeps_the_last_version(clock):
+    def fetch():
+        raise ConnectionError('connection reset')
+
+    tracker = IndexVersionTracker(lambda: 1, interval=60)
+    assert tracker.current() == 1
+    tracker.fetch_version = fetch
+    clock.value += 60
+    assert tracker.current() == 1
@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+# the query module builds its clients at import, the local backend needs no AWS account
+os.environ.setdefault('rag_backend', 'local')
+
+from answer_cache import AnswerCache  # noqa: E402
+from async_query import AsyncQueryService  # noqa: E402
+from local_standins import FakeBedrockRuntime, FakeOpenSearch, fake_embedding  # noqa: E402
+from retrieval import Retriever  # noqa: E402
+
+INDEX = 'rag-vector-index'
+
+
+def search_client():
+    client = FakeOpenSearch()
+    for n, (text, source) in enumerate([('Clarify reports bias metrics', 'clarify.pdf'),
+                                        ('Model Monitor detects data drift', 'monitor.pdf')]):
+        client.index(INDEX, {'vector_field': fake_embedding(text), 'text': text, 'source': source}, id=str(n))
+    return client
+
+
+class RecordingSearch(FakeOpenSearch):
+    def __init__(self):
+        super().__init__()
+        self.bodies = []
+
+    def search(self, body, index, scroll=None):
+        self.bodies.append(body)
+        return super().search(body, index, scroll=scroll)
+
+
+def service(bedrock, client=None, **kwargs):
+    return AsyncQueryService(bedrock, client or search_client(), INDEX, retriever=Retriever(), **kwargs)
+
+
+def test_an_answer_is_cached_and_served_again_without_the_model():
+    bedrock = FakeBedrockRuntime(answer='Question 1) What does Clarify report?')
+    query_service = service(bedrock, answer_cache=AnswerCache())
+
+    assert asyncio.run(query_service.answer('What does Clarify report?')) == 'Question 1) What does Clarify report?'
+    calls = bedrock.calls
+    assert asyncio.run(query_service.answer('what does clarify report')) == 'Question 1) What does Clarify report?'
+    assert bedrock.calls == calls
+    assert query_service.answer_cache.stats()['exact_hits'] == 1
+
+
+def test_filtered_questions_bypass_the_answer_cache_and_narrow_the_search():
+    client = RecordingSearch()
+    client.index(INDEX, {'vector_field': fake_embedding('drift'), 'text': 'drift', 'source': 'monitor.pdf'}, id='1')
+    query_service = service(FakeBedrockRuntime(), client, answer_cache=AnswerCache())
+
+    asyncio.run(query_service.answer('What is drift?', filters={'source': 'monitor.pdf'}))
+    assert query_service.answer_cache.stats()['entries'] == 0
+    assert client.bodies[-1]['query']['bool']['filter'] == [{'term': {'source': 'monitor.pdf'}}]
+
+
+def test_concurrent_questions_stay_within_the_bedrock_limit():
+    bedrock = FakeBedrockRuntime(latency=0.01, converse_latency=0.02, max_concurrency=2)
+    query_service = service(bedrock, bedrock_concurrency=2)
+
+    async def ask_all():
+        return await asyncio.gather(*[query_service.answer(f"question {n}") for n in range(8)])
+
+    answers = asyncio.run(ask_all())
+    assert len(answers) == 8 and bedrock.throttled == 0
+
+
+def test_a_streamed_answer_is_the_model_text_in_pieces():
+    bedrock = FakeBedrockRuntime(answer='Question 1) Which service reports bias?')
+    query_service = service(bedrock)
+    stats = {}
+
+    async def collect():
+        return [text async for text in query_service.answer_stream('Which service reports bias?', stats)]
+
+    pieces = asyncio.run(collect())
+    assert len(pieces) > 1 and ''.join(pieces) == 'Question 1) Which service reports bias?'
+    assert stats['usage']['outputTokens'] > 0
+
@@ -0,0 +1,107 @@
+from concurrent.futures import Future
+
+from langchain.schema import Document
+
+import chunking
+from chunking import RangeChunks, StructuredTextSplitter, iter_ranges, parse_blocks, split_page_range
+
+PAGE = """1.2 Data preparation
+SageMaker Data Wrangler imports, cleans and transforms data.
+It exports the flow to a processing job.
+• Import from S3 and Athena
+• Balance the classes
+MODEL MONITOR
+Model Monitor detects drift in production data."""
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_a_page_is_parsed_into_headings_list_items_and_paragraphs():
+    assert [block.kind for block in parse_blocks(PAGE)] == [
+        'heading', 'paragraph', 'paragraph', 'list_item', 'list_item', 'heading', 'paragraph']
+    assert parse_blocks('The flow is trans-\nformed.')[0].text == 'The flow is transformed.'
+
+
+def test_chunks_start_at_headings_and_carry_their_section():
+    splitter = StructuredTextSplitter(chunk_tokens=40, min_tokens=0, count_tokens=count_words)
+    chunks = splitter.split_text(PAGE)
+    assert [section for _, section, _ in chunks] == ['1.2 Data preparation', 'MODEL MONITOR']
+    assert chunks[1][0] == 'MODEL MONITOR\nModel Monitor detects drift in production data.'
+    # the open section carries over to the next page
+    assert splitter.split_text('It alerts through CloudWatch.')[0][1] == 'MODEL MONITOR'
+
+
+def test_a_block_larger_than_a_chunk_is_split_at_sentences():
+    splitter = StructuredTextSplitter(chunk_tokens=6, min_tokens=0, count_tokens=count_words)
+    chunks = splitter.split_text('One two three four. Five six seven eight. Nine ten.')
+    assert [text for text, _, _ in chunks] == ['One two three four.', 'Five six seven eight. Nine ten.']
+    assert all(tokens <= 6 for _, _, tokens in chunks)
+
+
+def test_a_small_last_chunk_is_merged_into_the_chunk_before_it():
+    splitter = StructuredTextSplitter(chunk_tokens=6, min_tokens=3, count_tokens=count_words)
+    chunks = splitter.split_text('One two three four five.\nSix.')
+    assert [(text, tokens) for text, _, tokens in chunks] == [('One two three four five.\nSix.', 6)]
+
+
+def pages(path, start, stop):
+    for page_number in range(start, stop):
+        yield Document(page_content=PAGE, metadata={'source': path, 'page': page_number})
+
+
+def test_split_page_range_uses_the_chunker_it_is_given(monkeypatch):
+    monkeypatch.setattr(chunking, 'iter_page_range', pages)
+    monkeypatch.setenv('chunker', 'structured')
+    structured = split_page_range('guide.pdf', 0, 2)
+    assert structured.pages == 2 and structured.chars == 2 * len(PAGE)
+    assert structured.section == 'MODEL MONITOR'
+    assert all('section' in metadata for _, metadata in structured.chunks)
+
+    recursive = split_page_range('guide.pdf', 0, 2, chunker='recursive')
+    assert recursive.section is None
+    assert recursive.chunks and all('section' not in metadata for _, metadata in recursive.chunks)
+
+
+class SynchronousPool:
+    """
+    Runs every task when it is submitted and records how many were submitted but not yet consumed.
+    """
+
+    def __init__(self):
+        self.submitted = 0
+        self.consumed = 0
+        self.most_in_flight = 0
+
+    def submit(self, fn, *args):
+        self.submitted += 1
+        self.most_in_flight = max(self.most_in_flight, self.submitted - self.consumed)
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def test_only_max_in_flight_ranges_are_submitted_ahead():
+    pool = SynchronousPool()
+    tasks = [('guide.pdf', start, start + 1) for start in range(10)]
+    results = []
+    for task, result in iter_ranges(pool, tasks, split=lambda path, start, stop: RangeChunks([], None, 1, 0),
+                                    max_in_flight=3):
+        pool.consumed += 1
+        results.append(task)
+    assert results == tasks
+    # the range being consumed and the three submitted ahead of it
+    assert pool.most_in_flight == 4
+
+
+def test_chunks_before_the_first_heading_of_a_range_get_the_section_of_the_range_before():
+    def split(path, start, stop):
+        if start == 0:
+            return RangeChunks([('intro', {'section': 'Clarify'})], 'Clarify', 1, 5)
+        return RangeChunks([('more', {'section': None})], None, 1, 4)
+
+    tasks = [('a.pdf', 0, 1), ('a.pdf', 1, 2), ('b.pdf', 0, 1), ('b.pdf', 1, 2)]
+    sections = [(task[0], result.chunks[0][-1]['section'])
+                for task, result in iter_ranges(SynchronousPool(), tasks, split=split)]
+    assert sections == [('a.pdf', 'Clarify'), ('a.pdf', 'Clarify'), ('b.pdf', 'Clarify'), ('b.pdf', 'Clarify')]
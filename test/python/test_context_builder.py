@@ -0,0 +1,56 @@
+from context_builder import (CHARS_PER_TOKEN, DEFAULT_CONTEXT_BUDGET, build_context, context_budget_from_env,
+                             deduplicate, Passage)
+
+
+def hit(doc_id, text='', source='a.pdf', page=None):
+    return {'_id': doc_id, '_score': 1.0, '_source': {'source': source, 'page': page}, 'fields': {'text': [text]}}
+
+
+def test_overlapping_and_repeated_chunks_are_merged():
+    overlap = 'shared text between two neighbouring chunks'
+    passages = deduplicate([
+        Passage('The first chunk ends with ' + overlap, 'a.pdf', 1),
+        Passage(overlap + ' and the second one goes on.', 'a.pdf', 2),
+        Passage('The first chunk ends with', 'a.pdf', 1),
+        Passage('Unrelated text on another page.', 'b.pdf', 5),
+    ])
+    assert [passage.text for passage in passages] == [
+        'The first chunk ends with ' + overlap + ' and the second one goes on.',
+        'Unrelated text on another page.',
+    ]
+
+
+def test_chunks_of_the_same_page_are_joined():
+    passages = deduplicate([Passage('First paragraph.', 'a.pdf', 3), Passage('Second paragraph.', 'a.pdf', 3)])
+    assert passages == [Passage('First paragraph.\nSecond paragraph.', 'a.pdf', 3)]
+
+
+def test_context_is_packed_within_the_token_budget():
+    hits = [hit('1', 'x' * 400, page=0), hit('2', 'y' * 400, page=1), hit('3', 'z' * 40, page=2)]
+    context = build_context(hits, token_budget=150)
+    # the second passage does not fit, the smaller third one after it still does
+    assert context.passages == 2
+    assert 'y' not in context.text and 'z' * 40 in context.text
+    assert context.tokens <= 150
+
+
+def test_a_first_passage_larger_than_the_budget_is_cut():
+    context = build_context([hit('1', 'x' * 1000, page=0)], token_budget=50)
+    assert context.passages == 1
+    assert len(context.text) == 50 * CHARS_PER_TOKEN
+
+
+def test_the_saved_tokens_are_measured_against_the_raw_hits():
+    overlap = 'shared text between two neighbouring chunks'
+    hits = [hit('1', 'The first chunk ends with ' + overlap, page=1), hit('2', overlap + ' and goes on.', page=2),
+            hit('3', 'The first chunk ends with ' + overlap, page=1)]
+    context = build_context(hits)
+    assert context.passages == 1
+    assert context.saved_tokens == context.naive_tokens - context.tokens > 0
+
+
+def test_the_budget_comes_from_the_environment_or_the_model(monkeypatch):
+    monkeypatch.delenv('context_token_budget', raising=False)
+    assert context_budget_from_env('unknown-model') == DEFAULT_CONTEXT_BUDGET
+    monkeypatch.setenv('context_token_budget', '1200')
+    assert context_budget_from_env('amazon.titan-text-premier-v1:0') == 1200
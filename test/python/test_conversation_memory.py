@@ -0,0 +1,146 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import conversation_memory
+from conversation_memory import (Conversation, ConversationStore, Turn, fallback_summary, is_follow_up_question,
+                                 prompt_with_summary)
+
+
+@pytest.mark.parametrize('question', [
+    'Explain the bias metrics that SageMaker Clarify reports',
+    'How does SageMaker Model Monitor detect data drift and what does it alert on?',
+    'Answer a few questions about feature engineering',
+])
+def test_new_topics_are_not_follow_ups(question):
+    assert not is_follow_up_question(question)
+
+
+@pytest.mark.parametrize('question', [
+    'Why is option B wrong in question 3?',
+    'Give me 5 more about this',
+    'That one is confusing, explain it',
+    'Explain the previous answer',
+])
+def test_explicit_back_references_are_follow_ups(question):
+    assert is_follow_up_question(question)
+
+
+def test_context_is_reused_for_follow_ups_and_similar_questions_only():
+    conversation = Conversation(follow_up_similarity=0.9)
+    conversation.remember_context('What is SageMaker Clarify?', [1.0, 0.0], None, 'clarify context')
+    assert conversation.reusable_context('Give me 5 more about this') == 'clarify context'
+    assert conversation.reusable_context('Explain the bias metrics that SageMaker Clarify reports',
+                                         vectors=[0.0, 1.0]) is None
+    assert conversation.reusable_context('What does SageMaker Clarify do?', vectors=[0.99, 0.1]) == 'clarify context'
+    assert conversation.reusable_context('Give me 5 more about this', filters={'page': 3}) is None
+
+
+class RecordingSummarizer:
+    """
+    Summarizes into a fixed text and records the turns it was given; with a gate it waits until the gate is set.
+    """
+
+    def __init__(self, text='topics: clarify, drift', gate=None):
+        self.text = text
+        self.gate = gate
+        self.calls = []
+
+    def __call__(self, summary, turns, max_tokens):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.calls.append((summary, [turn.question for turn in turns], max_tokens))
+        return self.text
+
+
+def add_turns(conversation, count, summarize=None, executor=None):
+    # 5 + 15 estimated tokens a turn
+    for n in range(count):
+        conversation.add_turn(f"question {n}".ljust(20), 'a' * 60, summarize, executor)
+
+
+def test_turns_within_the_budget_are_kept_verbatim():
+    conversation = Conversation(token_budget=50, summary_tokens=10)
+    add_turns(conversation, 2, RecordingSummarizer())
+    summary, messages = conversation.history()
+    assert summary == '' and len(conversation.turns) == 2
+    assert [message['role'] for message in messages] == ['user', 'assistant', 'user', 'assistant']
+    assert messages[0]['content'][0]['text'].strip() == 'question 0'
+
+
+def test_turns_past_the_budget_are_folded_into_the_summary_oldest_first():
+    summarize = RecordingSummarizer()
+    conversation = Conversation(token_budget=50, summary_tokens=10)
+    add_turns(conversation, 3, summarize)
+
+    assert [(summary, [question.strip() for question in questions], tokens)
+            for summary, questions, tokens in summarize.calls] == [('', ['question 0', 'question 1'], 10)]
+    summary, messages = conversation.history()
+    assert summary == 'topics: clarify, drift'
+    assert [message['content'][0]['text'].strip() for message in messages] == ['question 2', 'a' * 60]
+
+
+def test_a_failed_summarization_falls_back_to_the_questions_asked():
+    def summarize(summary, turns, max_tokens):
+        raise RuntimeError('model unavailable')
+
+    conversation = Conversation(token_budget=50, summary_tokens=20)
+    add_turns(conversation, 3, summarize)
+    assert [line.strip() for line in conversation.summary.splitlines()] == [
+        '- The user asked: question 0', '- The user asked: question 1']
+    assert len(conversation.turns) == 1
+
+
+def test_the_fallback_summary_keeps_the_newest_topics_within_its_tokens():
+    turns = [Turn('What is Clarify?', 'answer', 5), Turn('What is drift?', 'answer', 5)]
+    assert fallback_summary('earlier topics', turns, 100) == (
+        'earlier topics\n- The user asked: What is Clarify?\n- The user asked: What is drift?')
+    assert fallback_summary('earlier topics', turns, 8) == '- The user asked: What is drift?'
+
+
+def test_the_newest_answer_is_cut_to_the_budget_when_it_does_not_fit_alone():
+    conversation = Conversation(token_budget=20)
+    conversation.add_turn('What is drift?', 'x' * 400)
+    _, messages = conversation.history()
+    assert messages[1]['content'][0]['text'].endswith(' ...') and len(messages[1]['content'][0]['text']) < 100
+
+
+def test_summaries_run_in_the_background_and_history_waits_for_them():
+    gate = threading.Event()
+    summarize = RecordingSummarizer(gate=gate)
+    store = ConversationStore(token_budget=50, summary_tokens=10, summarize=summarize)
+    conversation = store.get('user:session')
+    for n in range(3):
+        store.add_turn(conversation, f"question {n}".ljust(20), 'a' * 60)
+    # the answer is delivered without waiting for the summary
+    assert summarize.calls == [] and len(conversation.turns) == 3
+    # a compaction already running is not started again
+    store.add_turn(conversation, 'question 3'.ljust(20), 'a' * 60)
+
+    gate.set()
+    summary, messages = conversation.history()
+    assert summary == 'topics: clarify, drift' and len(summarize.calls) == 1
+    # the worker may have picked the turns to fold before or after the fourth was added
+    folded = [question.strip() for question in summarize.calls[0][1]]
+    kept = [message['content'][0]['text'].strip() for message in messages[::2]]
+    assert folded + kept == ['question 0', 'question 1', 'question 2', 'question 3'] and kept[-1] == 'question 3'
+
+
+def test_the_summary_goes_in_front_of_the_prompt():
+    assert prompt_with_summary('', 'the prompt') == 'the prompt'
+    assert prompt_with_summary('topics: clarify', 'the prompt') == (
+        'Summary of our conversation so far:\ntopics: clarify\n\nthe prompt')
+
+
+def test_conversations_expire_and_the_least_recently_used_is_evicted(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(conversation_memory, 'time', SimpleNamespace(time=lambda: now.value))
+    store = ConversationStore(max_conversations=2, ttl_seconds=60, summarize_workers=0)
+    first = store.get('a')
+    store.get('b')
+    assert store.get('a') is first
+    store.get('c')
+    assert store.stats()['evicted'] == 1 and store.get('a') is first
+    now.value += 61
+    assert store.get('a') is not first
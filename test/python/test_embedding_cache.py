@@ -0,0 +1,87 @@
+import itertools
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache, LruTier, SqliteTier, cache_key, build_cache_from_env
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    ticks = itertools.count(1)
+    monkeypatch.setattr(embedding_cache, 'time', SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def test_keys_ignore_whitespace_and_unicode_form_but_not_the_model():
+    assert cache_key('model', 'café  menu\n') == cache_key('model', 'café menu')
+    assert cache_key('model', 'text') != cache_key('other-model', 'text')
+
+
+def test_lru_tier_evicts_the_least_recently_used_entry():
+    tier = LruTier(max_entries=2)
+    tier.put('a', [1.0])
+    tier.put('b', [2.0])
+    tier.get('a')
+    tier.put('c', [3.0])
+    assert tier.get('b') is None
+    assert tier.get('a') == [1.0] and tier.get('c') == [3.0]
+
+
+def test_sqlite_hits_do_not_write_until_the_next_put(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    tier = SqliteTier(path, max_entries=2)
+    tier.put('a', [1.0, 2.0])
+    tier.put('b', [3.0])
+    (written,) = sqlite3.connect(path).execute("SELECT last_used FROM embeddings WHERE key = 'a'").fetchone()
+
+    assert tier.get('a') == [1.0, 2.0]
+    assert sqlite3.connect(path).execute("SELECT last_used FROM embeddings WHERE key = 'a'").fetchone() == (written,)
+    # the pending hit on a is written before c evicts the least recently used row
+    tier.put('c', [4.0])
+    assert tier.get('b') is None
+    assert tier.get('a') == [1.0, 2.0] and len(tier) == 2
+
+
+def test_sqlite_hits_are_written_once_a_batch_is_pending(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    tier = SqliteTier(path, touch_batch=2)
+    tier.put('a', [1.0])
+    tier.put('b', [2.0])
+    before = dict(sqlite3.connect(path).execute('SELECT key, last_used FROM embeddings'))
+    tier.get('a')
+    tier.get('b')
+    after = dict(sqlite3.connect(path).execute('SELECT key, last_used FROM embeddings'))
+    assert after['a'] > before['a'] and after['b'] > before['b']
+
+
+def test_a_persistent_hit_is_copied_into_the_lru_tier(tmp_path):
+    persistent = SqliteTier(str(tmp_path / 'cache.db'))
+    persistent.put(cache_key('model', 'text'), [0.5])
+    cache = EmbeddingCache([LruTier(), persistent])
+    assert cache.get('model', 'text') == [0.5]
+    assert cache.get('model', 'text') == [0.5]
+    assert cache.get('model', 'other') is None
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'tier_hits': [1, 1], 'tier_sizes': [1, 1]}
+
+
+def test_wrap_batch_only_embeds_the_misses():
+    calls = []
+
+    def embed_batch(texts):
+        calls.append(texts)
+        return [[float(len(text))] for text in texts]
+
+    cached = EmbeddingCache([LruTier()]).wrap_batch(embed_batch, 'model')
+    assert cached(['a', 'bb']) == [[1.0], [2.0]]
+    assert cached(['bb', 'ccc', 'a']) == [[2.0], [3.0], [1.0]]
+    assert calls == [['a', 'bb'], ['ccc']]
+
+
+def test_the_environment_adds_a_bounded_sqlite_tier(tmp_path, monkeypatch):
+    monkeypatch.setenv('embedding_cache_size', '8')
+    monkeypatch.setenv('embedding_cache_path', str(tmp_path / 'cache.db'))
+    monkeypatch.setenv('embedding_cache_persistent_size', '16')
+    lru, persistent = build_cache_from_env().tiers
+    assert lru.max_entries == 8 and persistent.max_entries == 16
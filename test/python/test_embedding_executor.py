@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+from embedding_executor import AimdLimiter, EmbeddingExecutor
+from indexing import embed_items
+from local_standins import FakeThrottlingError
+
+
+def test_throttling_halves_the_limit_down_to_the_minimum():
+    limiter = AimdLimiter(16, minimum=2)
+    for expected in (8, 4, 2, 2):
+        limiter.acquire()
+        limiter.release(throttled=True)
+        assert limiter.limit == expected
+    assert limiter.throttled == 4
+
+
+def test_successes_grow_the_limit_by_about_one_per_round_up_to_the_maximum():
+    limiter = AimdLimiter(4, initial=2)
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release()
+    # 2 + 1/2 + 1/2.5
+    assert limiter.limit == pytest.approx(2.9)
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 4
+
+
+def test_observed_outcomes_adjust_the_limit_without_taking_a_slot():
+    limiter = AimdLimiter(8, initial=2)
+    limiter.observe(successes=2)
+    assert limiter.limit == pytest.approx(2.9) and limiter.in_flight == 0
+    limiter.observe(throttled=True, successes=5)
+    assert limiter.limit == pytest.approx(1.45) and limiter.throttled == 1
+
+
+def test_acquire_waits_while_the_limit_is_in_flight():
+    limiter = AimdLimiter(2)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(1)
+    waiter.join()
+
+
+def test_throttled_calls_are_retried_with_a_smaller_limit():
+    calls = []
+
+    def embed(texts):
+        calls.append(texts)
+        if len(calls) <= 3:
+            raise FakeThrottlingError('InvokeModel')
+        return [[float(len(text))] for text in texts]
+
+    limiter = AimdLimiter(8)
+    executor = EmbeddingExecutor(embed, concurrency=8, base_delay=0.001, max_delay=0.01, limiter=limiter)
+    assert executor.embed_all([['a'], ['bb', 'ccc']]) == [[[1.0]], [[2.0], [3.0]]]
+    assert limiter.throttled == 3
+    assert limiter.limit < 8
+
+
+def test_embed_items_calls_embed_fn_once_per_batch_and_keeps_the_order():
+    calls = []
+
+    def embed(texts):
+        calls.append(texts)
+        if 'bad' in texts:
+            raise ValueError('ValidationException')
+        return [[float(len(text))] for text in texts]
+
+    chunks = [(key, text, f'doc-{key}') for key, text in enumerate(['a', 'bb', 'bad', 'dddd', 'eeeee'])]
+    items, failures = embed_items(EmbeddingExecutor(embed, concurrency=2), chunks, batch_size=2)
+    assert sorted(calls) == [['a', 'bb'], ['bad', 'dddd'], ['eeeee']]
+    # a failed call fails every chunk of its batch, the others keep their own vectors
+    assert [(item.key, item.source['vector_field']) for item in items] == [(0, [1.0]), (1, [2.0]), (4, [5.0])]
+    assert [key for key, _ in failures] == [2, 3]
+
+
+def test_no_call_starts_after_the_deadline():
+    executor = EmbeddingExecutor(lambda texts: [[0.0]] * len(texts), deadline=0)
+    results = executor.embed_all([['a']], return_exceptions=True)
+    assert isinstance(results[0], TimeoutError)
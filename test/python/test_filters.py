@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+
+import pytest
+
+import index_profiles
+from local_standins import FakeOpenSearch
+from opensearch_bulk import BulkItem, bulk_index
+from retrieval import POST_FILTER_K_FACTOR, Retriever, bm25_query, knn_query, search_filter
+
+
+def test_filter_values_become_term_terms_and_range_clauses():
+    assert search_filter({'source': 'a.pdf', 'section': ['Clarify', 'Model Monitor'], 'page': {'gte': 10}}) == {
+        'bool': {'filter': [{'term': {'source': 'a.pdf'}},
+                            {'terms': {'section': ['Clarify', 'Model Monitor']}},
+                            {'range': {'page': {'gte': 10}}}]}}
+    assert search_filter({}) is None and search_filter(None) is None
+
+
+def test_an_unknown_filter_field_is_rejected():
+    with pytest.raises(ValueError, match='author'):
+        search_filter({'author': 'someone'})
+
+
+def test_filters_go_inside_the_knn_clause_only_with_efficient_filtering():
+    efficient = knn_query([0.1], 3, filters={'source': 'a.pdf'})
+    assert efficient['query']['knn']['vector_field']['filter'] == {'bool': {'filter': [{'term': {'source': 'a.pdf'}}]}}
+
+    post = knn_query([0.1], 3, filters={'source': 'a.pdf'}, efficient_filter=False)
+    assert post['query']['bool']['filter'] == [{'term': {'source': 'a.pdf'}}]
+    knn = post['query']['bool']['must'][0]['knn']['vector_field']
+    assert 'filter' not in knn and knn['k'] == 3 * POST_FILTER_K_FACTOR
+
+
+def test_filtered_search_on_the_default_nmslib_profile():
+    client = FakeOpenSearch()
+    index_profiles.build_index(client, 'rag', 'default', vector_field='vector_field')
+    bulk_index(client, 'rag', [BulkItem(str(n), {'vector_field': [1.0, float(n)], 'text': str(n),
+                                                'source': 'b.pdf' if n % 4 == 0 else 'a.pdf'}, doc_id=str(n))
+                               for n in range(20)])
+    retriever = Retriever(efficient_filter=lambda: index_profiles.supports_knn_filter(client, 'rag'))
+    response = retriever.search(client, 'rag', 'question', [1.0, 0.0], filters={'source': 'b.pdf'})
+    hits = response['hits']['hits']
+    assert len(hits) == 3 and {found['_source']['source'] for found in hits} == {'b.pdf'}
+
+
+def test_knn_filter_support_is_read_again_once_its_ttl_is_over(monkeypatch):
+    client = FakeOpenSearch()
+    index_profiles.build_index(client, 'rag', 'default')
+    support = index_profiles.KnnFilterSupport(client, 'rag', ttl=60)
+    assert support() is False
+
+    new = index_profiles.versioned_index_name('rag', index_profiles.build_index_body('balanced'))
+    index_profiles.ensure_index(client, new, index_profiles.build_index_body('balanced'))
+    index_profiles.swap_alias(client, 'rag', new)
+    assert support() is False
+    monkeypatch.setattr(index_profiles, 'time', SimpleNamespace(monotonic=lambda: support._expires))
+    assert support() is True
+
+
+def test_the_bm25_search_is_narrowed_by_the_same_filters():
+    body = bm25_query('drift', 5, filters={'page': {'lte': 3}})
+    assert body['query']['bool']['filter'] == [{'range': {'page': {'lte': 3}}}]
+
+
+def test_a_page_range_filter_on_an_efficient_filtering_index():
+    client = FakeOpenSearch()
+    index_profiles.build_index(client, 'rag', 'balanced', vector_field='vector_field')
+    bulk_index(client, 'rag', [BulkItem(str(n), {'vector_field': [1.0, float(n)], 'text': str(n), 'source': 'a.pdf',
+                                                'page': n}, doc_id=str(n)) for n in range(10)])
+    retriever = Retriever(efficient_filter=index_profiles.KnnFilterSupport(client, 'rag'))
+    response = retriever.search(client, 'rag', 'question', [1.0, 9.0], filters={'page': {'gte': 2, 'lte': 4}})
+    assert sorted(found['_source']['page'] for found in response['hits']['hits']) == [2, 3, 4]
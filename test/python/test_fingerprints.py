@@ -0,0 +1,69 @@
+import os
+
+from fingerprints import IngestManifest, document_id, source_name
+from local_standins import FakeOpenSearch
+from opensearch_bulk import BulkItem, bulk_index, scroll_pages
+
+
+def test_files_are_named_by_their_path_under_the_ingested_directory(tmp_path):
+    (tmp_path / 'a').mkdir()
+    path = str(tmp_path / 'a' / 'guide.pdf')
+    assert source_name(path, str(tmp_path)) == 'a/guide.pdf'
+    assert source_name(path) == 'guide.pdf'
+    assert source_name(path, path) == 'guide.pdf'
+
+
+def test_document_ids_are_stable_and_keyed_on_the_source_path():
+    assert document_id('a/guide.pdf', 3, 'Some  text') == document_id('a/guide.pdf', 3, 'Some text')
+    assert document_id('a/guide.pdf', 3, 'Some text') != document_id('b/guide.pdf', 3, 'Some text')
+    assert document_id('a/guide.pdf', 3, 'Some text') != document_id('a/guide.pdf', 4, 'Some text')
+
+
+def test_the_manifest_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    manifest = IngestManifest(path)
+    manifest.update('a.pdf', 'hash-a', {'2', '1'})
+    manifest.save()
+
+    loaded = IngestManifest(path)
+    assert loaded.is_unchanged('a.pdf', 'hash-a') and not loaded.is_unchanged('a.pdf', 'hash-b')
+    assert loaded.document_ids('a.pdf') == {'1', '2'}
+    assert not os.path.exists(path + '.tmp')
+
+
+def indexed(client, chunks):
+    bulk_index(client, 'rag', [BulkItem(doc_id, {'text': doc_id, 'source': source}, doc_id=doc_id)
+                               for doc_id, source in chunks])
+
+
+def test_scroll_pages_visits_every_document_once():
+    client = FakeOpenSearch()
+    indexed(client, [(str(n), 'a.pdf') for n in range(7)])
+    pages = [[hit['_id'] for hit in hits] for hits, _ in scroll_pages(client, 'rag', size=3)]
+    assert pages == [['0', '1', '2'], ['3', '4', '5'], ['6']]
+    assert client.scrolls == {}
+
+
+def test_a_scroll_continues_after_the_page_it_was_yielded_with():
+    client = FakeOpenSearch()
+    indexed(client, [(str(n), 'a.pdf') for n in range(5)])
+    _, scroll_id = next(scroll_pages(client, 'rag', size=2))
+    assert [[hit['_id'] for hit in hits] for hits, _ in scroll_pages(client, 'rag', size=2, scroll_id=scroll_id)] == [
+        ['2', '3'], ['4']]
+
+
+def test_a_missing_manifest_is_rebuilt_from_the_index(tmp_path):
+    client = FakeOpenSearch()
+    indexed(client, [('1', 'a/guide.pdf'), ('2', 'a/guide.pdf'), ('3', 'b/guide.pdf'), ('4', None)])
+    manifest = IngestManifest(str(tmp_path / 'manifest.json'))
+    manifest.rebuild(client, 'rag')
+    assert manifest.sources == {'a/guide.pdf': {'file_hash': None, 'ids': ['1', '2']},
+                                'b/guide.pdf': {'file_hash': None, 'ids': ['3']}}
+    # without the file hashes every file is split again, and only the chunks missing from the index are sent
+    assert not manifest.is_unchanged('a/guide.pdf', 'hash-a')
+
+
+def test_rebuilding_before_the_index_exists_gives_an_empty_manifest(tmp_path):
+    manifest = IngestManifest(str(tmp_path / 'manifest.json'))
+    manifest.rebuild(FakeOpenSearch(), 'rag')
+    assert manifest.sources == {}
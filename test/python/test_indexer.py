@@ -0,0 +1,40 @@
+from conftest import failed_message_ids, load_indexer, receive_event, send_messages
+from local_standins import FakeBedrockRuntime, FakeOpenSearch, FakeSqs
+
+
+def chunk(text, doc_id):
+    return {'content': text, 'id': doc_id, 'source': 'a.pdf', 'page': 3, 'section': 'Clarify'}
+
+
+def test_chunks_are_indexed_with_their_metadata(indexer_env):
+    sqs, store = FakeSqs(), FakeOpenSearch()
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, chunk('first chunk', '1'), chunk('second chunk', '2'))
+
+    assert failed_message_ids(indexer.handler(receive_event(sqs, 10), None)) == []
+    document = store.documents['rag-vector-index']['1']
+    assert (document['text'], document['source'], document['page'], document['section']) == (
+        'first chunk', 'a.pdf', 3, 'Clarify')
+    assert len(document['vector_field']) == 1536
+    trace = indexer.tracer.exporter.traces[-1]
+    assert trace.attributes['indexed'] == 2 and trace.attributes['bulk_throttled'] == 0
+
+
+def test_bulk_rejections_shrink_the_bulk_requests_of_later_invocations(indexer_env, monkeypatch):
+    monkeypatch.setenv('bulk_max_docs', '8')
+    sqs, store = FakeSqs(), FakeOpenSearch(throttle_rate=1.0)
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, *[chunk(f'chunk {n}', str(n)) for n in range(10)])
+    event = receive_event(sqs, 10)
+
+    assert sorted(failed_message_ids(indexer.handler(event, None))) == sorted(
+        record['messageId'] for record in event['Records'])
+    # 8 rejected documents, then 2 within the halved limit
+    assert indexer.bulk_limiter.limit == 2 and indexer.bulk_limiter.throttled == 2
+    assert indexer.tracer.exporter.traces[-1].attributes['bulk_throttled'] == 2
+
+    # the limit lives as long as the container and grows back while OpenSearch keeps up
+    store.throttle_rate = 0.0
+    send_messages(sqs, *[chunk(f'chunk {n}', str(n)) for n in range(10, 20)])
+    assert failed_message_ids(indexer.handler(receive_event(sqs, 10), None)) == []
+    assert 2 < indexer.bulk_limiter.limit < 8
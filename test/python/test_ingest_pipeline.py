@@ -0,0 +1,84 @@
+import json
+
+from conftest import QUEUE_URL
+from ingest_pipeline import SqsBatchSender
+from local_standins import FakeSqs
+
+
+class FlakySqs(FakeSqs):
+    """
+    Answers the first calls with the scripted outcomes: an exception to raise, or a function that picks the
+    entries to fail as {'Id', 'SenderFault', 'Message'} dicts.
+    """
+
+    def __init__(self, *outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if isinstance(outcome, Exception):
+            self._call()
+            raise outcome
+        failed = outcome(Entries) if outcome else []
+        failed_ids = {failure['Id'] for failure in failed}
+        response = super().send_message_batch(QueueUrl, [entry for entry in Entries if entry['Id'] not in failed_ids])
+        response['Failed'] = failed
+        return response
+
+
+def queued(sqs):
+    return [json.loads(message['Body'])['n'] for message in sqs.queues.get(QUEUE_URL, [])]
+
+
+def sender(sqs, **kwargs):
+    return SqsBatchSender(sqs, QUEUE_URL, base_delay=0, **kwargs)
+
+
+def test_messages_are_sent_in_batches_of_at_most_ten():
+    sqs = FakeSqs()
+    with sender(sqs) as batch_sender:
+        for n in range(25):
+            batch_sender.send({'n': n})
+    assert (batch_sender.sent, batch_sender.batches, batch_sender.failed) == (25, 3, [])
+    assert queued(sqs) == list(range(25))
+
+
+def test_a_batch_is_sent_before_it_would_pass_the_byte_limit():
+    sqs = FakeSqs()
+    with sender(sqs, max_bytes=40) as batch_sender:
+        for n in range(3):
+            batch_sender.send({'n': n, 'text': 'x' * 10})
+    assert batch_sender.batches == 3
+
+
+def test_a_failed_call_is_retried_with_the_buffered_batch():
+    sqs = FlakySqs(ConnectionError('connection reset'), ConnectionError('connection reset'))
+    with sender(sqs) as batch_sender:
+        for n in range(3):
+            batch_sender.send({'n': n})
+    assert (batch_sender.sent, batch_sender.failed) == (3, [])
+    assert sqs.calls == 3 and queued(sqs) == [0, 1, 2]
+
+
+def test_only_entries_failed_on_the_sqs_side_are_retried():
+    def fail_first_two(entries):
+        return [{'Id': entries[0]['Id'], 'SenderFault': True, 'Message': 'message too long'},
+                {'Id': entries[1]['Id'], 'SenderFault': False, 'Message': 'internal error'}]
+
+    sqs = FlakySqs(fail_first_two)
+    with sender(sqs) as batch_sender:
+        for n in range(3):
+            batch_sender.send({'n': n})
+    assert sorted(queued(sqs)) == [1, 2]
+    assert [(json.loads(body)['n'], error) for body, error in batch_sender.failed] == [(0, 'message too long')]
+
+
+def test_entries_still_failing_after_the_last_attempt_are_recorded():
+    sqs = FlakySqs(*[ConnectionError('connection reset')] * 3)
+    with sender(sqs, max_attempts=3) as batch_sender:
+        batch_sender.send({'n': 0})
+        batch_sender.send({'n': 1})
+    assert batch_sender.sent == 0 and queued(sqs) == []
+    assert [(json.loads(body)['n'], error) for body, error in batch_sender.failed] == [
+        (0, 'connection reset'), (1, 'connection reset')]
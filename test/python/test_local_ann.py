@@ -0,0 +1,47 @@
+import random
+
+import index_profiles
+from local_ann import HnswGraph, l2_squared, quantize
+from local_standins import vector_graphs
+
+
+def test_fp16_keeps_about_three_significant_digits():
+    assert quantize([0.1, 1.0, 1000.123]) == [0.1, 1.0, 1000.123]
+    assert quantize([0.1, 1.0, 1000.123], 'fp16') == [0.0999755859375, 1.0, 1000.0]
+
+
+def test_graphs_take_the_quantization_of_the_profile():
+    (graph, quantization), = vector_graphs(index_profiles.build_index_body('compact-fp16')).values()
+    assert quantization == 'fp16' and graph.m == 16
+    (_, quantization), = vector_graphs(index_profiles.build_index_body('balanced')).values()
+    assert quantization is None
+
+
+def random_vectors(count, dimension=8, seed=1):
+    generator = random.Random(seed)
+    return {str(n): [generator.gauss(0, 1) for _ in range(dimension)] for n in range(count)}
+
+
+def exact_neighbours(vectors, query, k):
+    return sorted(vectors, key=lambda key: l2_squared(query, vectors[key]))[:k]
+
+
+def test_the_graph_finds_almost_all_exact_neighbours():
+    vectors = random_vectors(300)
+    graph = HnswGraph(m=8, ef_construction=64, ef_search=64)
+    for key, vector in vectors.items():
+        graph.add(key, vector)
+    queries = list(random_vectors(20, seed=2).values())
+    found = sum(len({key for _, key in graph.search(query, 10)} & set(exact_neighbours(vectors, query, 10)))
+                for query in queries)
+    assert found / (10 * len(queries)) >= 0.9
+
+
+def test_removed_vectors_are_not_found_and_keys_are_searched_exactly():
+    vectors = random_vectors(50)
+    graph = HnswGraph()
+    for key, vector in vectors.items():
+        graph.add(key, vector)
+    graph.remove('0')
+    assert '0' not in [key for _, key in graph.search(vectors['0'], 5)] and len(graph) == 49
+    assert [key for _, key in graph.search(vectors['7'], 2, keys=['3', '7', '0'])] == ['7', '3']
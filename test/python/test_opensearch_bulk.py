@@ -0,0 +1,140 @@
+from conftest import load_indexer, receive_event, send_messages
+from embedding_executor import AimdLimiter
+from local_standins import FakeBedrockRuntime, FakeOpenSearch, FakeSqs
+from opensearch_bulk import BulkItem, bulk_index, is_rejected, iter_batches, parse_bulk_response
+
+
+def items():
+    return [BulkItem('a', {'text': 'a'}, doc_id='1'), BulkItem('b', {'text': 'b'}, doc_id='2'),
+            BulkItem('c', doc_id='3', op_type='delete')]
+
+
+def test_failed_items_are_mapped_back_by_position():
+    response = {'errors': True, 'items': [
+        {'index': {'_id': '1', 'status': 201}},
+        {'index': {'_id': '2', 'status': 400, 'error': {'type': 'mapper_parsing_exception', 'reason': 'bad'}}},
+        {'delete': {'_id': '3', 'status': 429}},
+    ]}
+    assert parse_bulk_response(response, items()) == [
+        ('b', {'type': 'mapper_parsing_exception', 'reason': 'bad'}),
+        ('c', 429),
+    ]
+
+
+def test_delete_of_a_missing_document_is_not_a_failure():
+    response = {'errors': False, 'items': [
+        {'index': {'_id': '1', 'status': 200}},
+        {'index': {'_id': '2', 'status': 201}},
+        {'delete': {'_id': '3', 'status': 404}},
+    ]}
+    assert parse_bulk_response(response, items()) == []
+
+
+def test_items_missing_from_the_response_fail():
+    response = {'errors': False, 'items': [{'index': {'_id': '1', 'status': 201}}]}
+    assert parse_bulk_response(response, items()) == [('b', 'missing from bulk response'),
+                                                       ('c', 'missing from bulk response')]
+
+
+def test_bulk_index_reports_rejected_items():
+    client = FakeOpenSearch(throttle_rate=1.0)
+    result = bulk_index(client, 'index', items()[:2])
+    assert result['succeeded'] == 0
+    assert [key for key, _ in result['failed']] == ['a', 'b']
+    assert all(error['type'] == 'es_rejected_execution_exception' for _, error in result['failed'])
+
+
+def test_bulk_index_fails_every_item_of_a_failed_request():
+    class BrokenClient:
+        def bulk(self, body, refresh=False):
+            raise ConnectionError('connection reset')
+
+    result = bulk_index(BrokenClient(), 'index', items(), max_docs=2)
+    assert result == {'succeeded': 0, 'failed': [('a', 'connection reset'), ('b', 'connection reset'),
+                                                 ('c', 'connection reset')]}
+
+
+def test_a_request_rejected_with_a_429_keeps_the_status():
+    class OverloadedClient:
+        def bulk(self, body, refresh=False):
+            error = Exception('TransportError(429, rejected execution)')
+            error.status_code = 429
+            raise error
+
+    result = bulk_index(OverloadedClient(), 'index', items()[:2])
+    assert result['failed'] == [('a', 429), ('b', 429)] and all(is_rejected(error) for _, error in result['failed'])
+
+
+class RejectingFirstRequests(FakeOpenSearch):
+    """
+    Rejects every item of the first requests with a 429 item error, and records the size of every request.
+    """
+
+    def __init__(self, rejected_requests):
+        super().__init__()
+        self.rejected_requests = rejected_requests
+        self.sizes = []
+
+    def bulk(self, body, index=None, refresh=False):
+        self.sizes.append(sum(1 for line in body.splitlines() if '"index"' in line))
+        self.throttle_rate = 1.0 if len(self.sizes) <= self.rejected_requests else 0.0
+        return super().bulk(body, index=index, refresh=refresh)
+
+
+def test_rejected_requests_shrink_the_next_batches_and_successes_grow_them_back():
+    client = RejectingFirstRequests(rejected_requests=2)
+    limiter = AimdLimiter(8)
+    result = bulk_index(client, 'index', [BulkItem(str(n), {'text': str(n)}, doc_id=str(n)) for n in range(20)],
+                        max_docs=8, limiter=limiter)
+    assert client.sizes[:4] == [8, 4, 2, 2]
+    assert result['succeeded'] == 8 and limiter.throttled == 2
+    assert limiter.limit > 2
+    # the limit never raises the cap the caller set
+    assert all(size <= 8 for size in client.sizes)
+
+
+def test_bulk_index_splits_batches_and_counts_successes():
+    client = FakeOpenSearch()
+    result = bulk_index(client, 'index', [BulkItem(str(n), {'text': str(n)}, doc_id=str(n)) for n in range(5)],
+                        max_docs=2)
+    assert result == {'succeeded': 5, 'failed': []}
+    assert client.count(index='index')['count'] == 5
+
+
+def test_batches_respect_the_byte_cap_and_keep_an_oversized_item():
+    small = [BulkItem(str(n), {'text': 'x' * 10}, doc_id=str(n)) for n in range(3)]
+    large = BulkItem('large', {'text': 'y' * 500}, doc_id='large')
+    batches = [[item.key for item in batch] for batch, _ in iter_batches('index', small + [large], max_bytes=150)]
+    assert batches == [['0', '1'], ['2'], ['large']]
+
+
+class CountingOpenSearch(FakeOpenSearch):
+    def __init__(self):
+        super().__init__()
+        self.bulk_requests = 0
+
+    def bulk(self, body, index=None, refresh=False):
+        self.bulk_requests += 1
+        return super().bulk(body, index=index, refresh=refresh)
+
+
+def test_the_indexer_writes_a_batch_with_one_bulk_request():
+    sqs, store = FakeSqs(), CountingOpenSearch()
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, *[{'content': f'chunk {n}', 'id': f'doc-{n}'} for n in range(3)])
+
+    assert indexer.handler(receive_event(sqs, 10), None) == {'batchItemFailures': []}
+    assert store.bulk_requests == 1
+    assert sorted(store.documents['rag-vector-index']) == ['doc-0', 'doc-1', 'doc-2']
+
+
+def test_redelivered_chunks_overwrite_and_deletes_remove_documents():
+    sqs, store = FakeSqs(), FakeOpenSearch()
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, {'content': 'chunk', 'id': 'doc-1'}, {'content': 'other', 'id': 'doc-2'})
+    indexer.handler(receive_event(sqs, 10), None)
+    send_messages(sqs, {'content': 'chunk', 'id': 'doc-1'}, {'action': 'delete', 'id': 'doc-2'},
+         {'action': 'delete', 'id': 'never-indexed'})
+
+    assert indexer.handler(receive_event(sqs, 10), None) == {'batchItemFailures': []}
+    assert list(store.documents['rag-vector-index']) == ['doc-1']
@@ -0,0 +1,159 @@
+import pytest
+
+import index_profiles
+import reindex
+from local_standins import FakeOpenSearch
+from opensearch_bulk import BulkItem, bulk_index
+
+ALIAS = 'rag-vector-index'
+
+
+def populated_store(profile='default', documents=5):
+    client = FakeOpenSearch()
+    index_name, _, swapped = index_profiles.build_index(client, ALIAS, profile)
+    assert swapped
+    bulk_index(client, ALIAS, [BulkItem(str(n), {'vector_field': [0.1, float(n)], 'text': f'chunk {n}'},
+                                        doc_id=str(n)) for n in range(documents)])
+    return client, index_name
+
+
+def copy_into(client, body, checkpoint_path, batch_size=500, **kwargs):
+    target = index_profiles.versioned_index_name(ALIAS, body)
+    source = reindex.source_index_of(client, ALIAS, target)
+    return reindex.reindex(client, ALIAS, body,
+                           lambda target, checkpoint: reindex.copy_documents(client, source, target, checkpoint,
+                                                                             batch_size),
+                           checkpoint_path=checkpoint_path, validate_timeout=0,
+                           source_count=client.count(index=source)['count'], **kwargs)
+
+
+def test_a_profile_change_does_not_switch_searches_to_an_empty_index():
+    client, live = populated_store()
+    new, previous, swapped = index_profiles.build_index(client, ALIAS, 'balanced')
+    assert not swapped and previous == [live]
+    assert index_profiles.alias_targets(client, ALIAS) == [live]
+    assert client.count(index=ALIAS)['count'] == 5
+    assert client.indices.exists(index=new)
+
+
+def test_a_profile_change_before_anything_was_ingested_switches_right_away():
+    client = FakeOpenSearch()
+    index_profiles.build_index(client, ALIAS, 'default')
+    new, _, swapped = index_profiles.build_index(client, ALIAS, 'balanced')
+    assert swapped and index_profiles.alias_targets(client, ALIAS) == [new]
+
+
+def test_reindex_backfills_and_switches_after_a_profile_change(tmp_path):
+    client, live = populated_store()
+    index_profiles.build_index(client, ALIAS, 'balanced')
+    body = index_profiles.build_index_body('balanced')
+
+    target = copy_into(client, body, str(tmp_path / 'checkpoint.json'), delete_previous=True)
+    assert index_profiles.alias_targets(client, ALIAS) == [target]
+    assert client.count(index=ALIAS)['count'] == 5
+    assert not client.indices.exists(index=live)
+    assert not (tmp_path / 'checkpoint.json').exists()
+
+
+def test_reindex_backfills_a_target_the_alias_already_points_to(tmp_path):
+    client, live = populated_store()
+    # the alias switched to the new, empty index before it was backfilled
+    body = index_profiles.build_index_body('balanced')
+    target = index_profiles.versioned_index_name(ALIAS, body)
+    index_profiles.ensure_index(client, target, body)
+    index_profiles.swap_alias(client, ALIAS, target)
+    assert client.count(index=ALIAS)['count'] == 0
+
+    assert reindex.source_index_of(client, ALIAS, target) == live
+    copy_into(client, body, str(tmp_path / 'checkpoint.json'))
+    assert index_profiles.alias_targets(client, ALIAS) == [target]
+    assert client.count(index=ALIAS)['count'] == 5
+
+
+def test_a_reindex_with_a_count_mismatch_does_not_switch(tmp_path):
+    client, live = populated_store()
+    body = index_profiles.build_index_body('balanced')
+    with pytest.raises(RuntimeError, match='was not switched'):
+        reindex.reindex(client, ALIAS, body, lambda target, checkpoint: 6,
+                        checkpoint_path=str(tmp_path / 'checkpoint.json'), validate_timeout=0)
+    assert index_profiles.alias_targets(client, ALIAS) == [live]
+
+
+class InterruptedBulk:
+    """
+    Counts the documents every bulk request writes; the request after the first `succeeding` ones fails.
+    """
+
+    def __init__(self, client, succeeding=None):
+        self.bulk = client.bulk
+        self.succeeding = succeeding
+        self.written = []
+        client.bulk = self
+
+    def __call__(self, body, index=None, refresh=False):
+        if self.succeeding is not None and len(self.written) >= self.succeeding:
+            raise ConnectionError('connection reset')
+        self.written.append(body.count('"index"'))
+        return self.bulk(body, index=index, refresh=refresh)
+
+
+def test_reindex_resumes_with_the_page_it_did_not_write(tmp_path):
+    client, live = populated_store()
+    body = index_profiles.build_index_body('balanced')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    interrupted = InterruptedBulk(client, succeeding=1)
+    with pytest.raises(RuntimeError, match='failed to copy'):
+        copy_into(client, body, checkpoint_path, batch_size=2)
+    client.bulk = interrupted.bulk
+
+    # the scroll has moved past the failed page, its documents are fetched again by id
+    resumed = InterruptedBulk(client)
+    target = copy_into(client, body, checkpoint_path, batch_size=2)
+    assert resumed.written == [2, 1]
+    assert index_profiles.alias_targets(client, ALIAS) == [target]
+    assert client.count(index=ALIAS)['count'] == 5
+
+
+def test_a_copy_whose_scroll_expired_starts_over(tmp_path):
+    client, live = populated_store()
+    body = index_profiles.build_index_body('balanced')
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    interrupted = InterruptedBulk(client, succeeding=1)
+    with pytest.raises(RuntimeError, match='failed to copy'):
+        copy_into(client, body, checkpoint_path, batch_size=2)
+    client.bulk = interrupted.bulk
+    client.scrolls.clear()
+
+    resumed = InterruptedBulk(client)
+    copy_into(client, body, checkpoint_path, batch_size=2)
+    assert resumed.written == [2, 2, 2, 1]
+    assert client.count(index=ALIAS)['count'] == 5
+
+
+class FakeLambda:
+    def __init__(self, states):
+        self.mappings = dict(states)
+        self.updates = []
+
+    def list_event_source_mappings(self, FunctionName):
+        return {'EventSourceMappings': [{'UUID': uuid, 'State': state} for uuid, state in self.mappings.items()]}
+
+    def update_event_source_mapping(self, UUID, Enabled):
+        self.updates.append((UUID, Enabled))
+        self.mappings[UUID] = 'Enabled' if Enabled else 'Disabled'
+
+    def get_event_source_mapping(self, UUID):
+        return {'UUID': UUID, 'State': self.mappings[UUID]}
+
+    def get_function_configuration(self, FunctionName):
+        return {'Timeout': 0}
+
+
+def test_the_indexer_is_paused_during_the_reindex_even_when_it_fails():
+    lambda_client = FakeLambda({'queue': 'Enabled', 'old-queue': 'Disabled'})
+    with pytest.raises(RuntimeError):
+        with reindex.IndexerPause(lambda_client, 'docs-indexer'):
+            assert lambda_client.mappings == {'queue': 'Disabled', 'old-queue': 'Disabled'}
+            raise RuntimeError('count mismatch')
+    assert lambda_client.updates == [('queue', False), ('queue', True)]
+    assert lambda_client.mappings == {'queue': 'Enabled', 'old-queue': 'Disabled'}
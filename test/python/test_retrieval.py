@@ -0,0 +1,40 @@
+import pytest
+
+import index_profiles
+from local_standins import FakeOpenSearch
+from opensearch_bulk import BulkItem, bulk_index
+from retrieval import Retriever, reciprocal_rank_fusion
+
+
+def hit(doc_id, text='', source='a.pdf', page=None):
+    return {'_id': doc_id, '_score': 1.0, '_source': {'source': source, 'page': page}, 'fields': {'text': [text]}}
+
+
+def test_rrf_ranks_documents_found_by_both_searches_first():
+    knn = [hit('a'), hit('b'), hit('c')]
+    bm25 = [hit('c'), hit('d'), hit('b')]
+    fused = reciprocal_rank_fusion([knn, bm25], size=4, rank_constant=60)
+    assert [fused_hit['_id'] for fused_hit in fused] == ['c', 'b', 'a', 'd']
+    assert fused[0]['_score'] == 1 / 63 + 1 / 61
+
+
+def test_rrf_weights_and_size():
+    fused = reciprocal_rank_fusion([[hit('a')], [hit('b')]], size=1, weights=[1.0, 2.0])
+    assert [fused_hit['_id'] for fused_hit in fused] == ['b']
+
+
+def test_a_failed_hybrid_search_part_leaves_the_other_hits():
+    client = FakeOpenSearch()
+    index_profiles.build_index(client, 'rag', 'default')
+    bulk_index(client, 'rag', [BulkItem(str(n), {'vector_field': [1.0, float(n)], 'text': f'drift chunk {n}',
+                                                'source': 'a.pdf'}, doc_id=str(n)) for n in range(5)])
+    # the knn part puts the filter where an nmslib index rejects it, the BM25 part still succeeds
+    retriever = Retriever(mode='hybrid', size=2, efficient_filter=True)
+    response = retriever.search(client, 'rag', 'drift', [1.0, 0.0], filters={'source': 'a.pdf'})
+    assert len(response['hits']['hits']) == 2
+
+
+def test_a_hybrid_search_with_every_part_failed_raises():
+    failed = {'error': {'type': 'search_phase_execution_exception'}, 'status': 500}
+    with pytest.raises(RuntimeError, match='every search'):
+        Retriever(mode='hybrid').combine('question', [failed, failed])
@@ -0,0 +1,138 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import DEAD_LETTER_URL, QUEUE_URL, failed_message_ids, load_indexer, receive_event, send_messages
+from local_standins import FakeBedrockRuntime, FakeOpenSearch, FakeSqs, FakeThrottlingError
+from sqs_consumer import (Deadline, PoisonMessage, is_retryable, is_throttled, queue_url_from_arn, retry_delay,
+                          send_to_dead_letter)
+
+
+class RejectingOpenSearch(FakeOpenSearch):
+    """
+    Rejects the documents whose text is "reject" the way a mapping rejects them, and indexes the others.
+    """
+
+    def bulk(self, body, index=None, refresh=False):
+        response = super().bulk(body, index=index, refresh=refresh)
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        sources = [line for line in lines if 'index' not in line and 'delete' not in line]
+        for item, source in zip(response['items'], sources):
+            if source.get('text') == 'reject':
+                item['index'].update(status=400, error={'type': 'mapper_parsing_exception', 'reason': 'bad'})
+        response['errors'] = True
+        return response
+
+
+class UnreachableDeadLetterSqs(FakeSqs):
+    def send_message_batch(self, QueueUrl, Entries):
+        if QueueUrl == DEAD_LETTER_URL:
+            raise ConnectionError('connection reset')
+        return super().send_message_batch(QueueUrl, Entries)
+
+
+def chunk(text, doc_id):
+    return {'content': text, 'id': doc_id, 'source': 'a.pdf', 'page': 0, 'section': None}
+
+
+def test_unparseable_messages_are_dead_lettered(indexer_env):
+    sqs, store = FakeSqs(), FakeOpenSearch()
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, chunk('first chunk', '1'), 'not json')
+    event = receive_event(sqs, 10)
+
+    assert failed_message_ids(indexer.handler(event, None)) == []
+    assert store.count(index='rag-vector-index')['count'] == 1
+    dead_letters = sqs.queues[DEAD_LETTER_URL]
+    assert [message['Body'] for message in dead_letters] == ['not json']
+    assert 'unparseable message' in dead_letters[0]['MessageAttributes']['error']['StringValue']
+
+
+def test_documents_the_index_rejects_are_dead_lettered(indexer_env):
+    sqs = FakeSqs()
+    indexer = load_indexer(FakeBedrockRuntime(), RejectingOpenSearch(), sqs)
+    send_messages(sqs, chunk('kept', '1'), chunk('reject', '2'))
+
+    assert failed_message_ids(indexer.handler(receive_event(sqs, 10), None)) == []
+    assert [json.loads(message['Body'])['id'] for message in sqs.queues[DEAD_LETTER_URL]] == ['2']
+
+
+def test_poison_messages_are_reported_without_a_dead_letter_queue(indexer_env, monkeypatch):
+    monkeypatch.delenv('dead_letter_queue_url')
+    sqs = FakeSqs()
+    indexer = load_indexer(FakeBedrockRuntime(), FakeOpenSearch(), sqs)
+    send_messages(sqs, 'not json')
+    event = receive_event(sqs, 10)
+
+    assert failed_message_ids(indexer.handler(event, None)) == [event['Records'][0]['messageId']]
+
+
+def test_poison_messages_the_dead_letter_queue_did_not_take_are_reported(indexer_env):
+    sqs = UnreachableDeadLetterSqs()
+    send_messages(sqs, 'not json', 'not json either')
+    event = receive_event(sqs, 10)
+    errors = {record['messageId']: PoisonMessage('unparseable message') for record in event['Records']}
+
+    assert send_to_dead_letter(sqs, DEAD_LETTER_URL, event['Records'], errors) == list(errors)
+
+
+def test_throttled_records_are_returned_with_a_backoff(indexer_env):
+    sqs, store = FakeSqs(), FakeOpenSearch(throttle_rate=1.0)
+    indexer = load_indexer(FakeBedrockRuntime(), store, sqs)
+    send_messages(sqs, chunk('first chunk', '1'), chunk('second chunk', '2'))
+    event = receive_event(sqs, 10)
+
+    started = time.monotonic()
+    response = indexer.handler(event, None)
+    assert sorted(failed_message_ids(response)) == sorted(record['messageId'] for record in event['Records'])
+    assert DEAD_LETTER_URL not in sqs.queues
+    # hidden for retry_base_seconds on the first receive, instead of the queue's visibility timeout
+    for _, _, visible_at in sqs.in_flight.values():
+        assert visible_at - started == pytest.approx(30, abs=1)
+
+
+@pytest.mark.parametrize('error, retryable', [
+    (PoisonMessage('unparseable message'), False),
+    ({'type': 'mapper_parsing_exception'}, False),
+    ({'type': 'es_rejected_execution_exception'}, True),
+    (429, True),
+    (503, True),
+    (400, False),
+    (FakeThrottlingError('InvokeModel'), True),
+    (TimeoutError('read timed out'), True),
+])
+def test_retryable_errors(error, retryable):
+    assert is_retryable(error) is retryable
+
+
+@pytest.mark.parametrize('error, throttled', [
+    ({'type': 'es_rejected_execution_exception'}, True),
+    (429, True),
+    (FakeThrottlingError('InvokeModel'), True),
+    ({'type': 'mapper_parsing_exception'}, False),
+    (503, False),
+    ('connection reset', False),
+])
+def test_throttled_errors(error, throttled):
+    assert is_throttled(error) is throttled
+
+
+def test_retry_delay_grows_with_the_receive_count_up_to_the_maximum():
+    assert retry_delay(1, base=5, maximum=300) == 5
+    assert all(5 <= retry_delay(4, base=5, maximum=300) <= 40 for _ in range(50))
+    assert all(retry_delay(20, base=5, maximum=300) <= 300 for _ in range(50))
+
+
+def test_queue_urls_are_derived_from_the_event_source_arn():
+    assert queue_url_from_arn('arn:aws:sqs:us-east-1:000000000000:docs-queue') == QUEUE_URL
+    assert queue_url_from_arn('arn:aws-cn:sqs:cn-north-1:000000000000:docs-queue') == (
+        'https://sqs.cn-north-1.amazonaws.com.cn/000000000000/docs-queue')
+
+
+def test_the_deadline_keeps_a_margin_before_the_function_timeout():
+    context = SimpleNamespace(get_remaining_time_in_millis=lambda: 30000)
+    before = time.monotonic()
+    assert Deadline(context, margin=5).at - before == pytest.approx(25, abs=1)
+    assert Deadline(None).at is None
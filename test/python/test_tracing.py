@@ -0,0 +1,93 @@
+import io
+import json
+
+import pytest
+
+from tracing import EmfExporter, MemoryExporter, Tracer, build_tracer_from_env, percentile, stage_durations
+
+
+class FailingExporter:
+    def export(self, service, root):
+        raise ConnectionError('collector unreachable')
+
+
+def test_a_trace_is_exported_once_its_root_and_every_child_have_ended():
+    exporter = MemoryExporter()
+    tracer = Tracer('svc', exporter)
+    with tracer.span('request') as root:
+        with tracer.span('retrieve', hits=3) as retrieve:
+            assert tracer.current() is retrieve
+        # a span started off the current one, e.g. ended later from a worker thread
+        generate = tracer.start_span('generate')
+        assert tracer.current() is root
+    assert exporter.traces == []
+    generate.end(tokens=12)
+    assert exporter.traces == [root]
+    assert [span.name for span in root.walk()] == ['request', 'retrieve', 'generate']
+    assert {span.trace_id for span in root.walk()} == {root.trace_id}
+    assert tracer.current() is None
+
+
+def test_an_error_escaping_a_span_is_recorded_on_it():
+    exporter = MemoryExporter()
+    tracer = Tracer('svc', exporter)
+    with pytest.raises(KeyError):
+        with tracer.span('request'):
+            raise KeyError('missing')
+    assert exporter.traces[0].attributes == {'error': 'KeyError'}
+
+
+def test_the_emf_document_has_one_metric_per_stage_and_the_attributes_as_properties():
+    stream = io.StringIO()
+    tracer = Tracer('indexer', EmfExporter(stream=stream))
+    with tracer.span('handler', records=2):
+        for _ in range(2):
+            with tracer.span('embed', texts=4):
+                pass
+        with tracer.span('bulk'):
+            pass
+    document = json.loads(stream.getvalue())
+
+    metrics = document['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Namespace'] == 'RagApp' and metrics['Dimensions'] == [['Service', 'Operation']]
+    assert [metric['Name'] for metric in metrics['Metrics']] == ['handler_ms', 'embed_ms', 'bulk_ms']
+    assert (document['Service'], document['Operation']) == ('indexer', 'handler')
+    assert isinstance(document['handler_ms'], float) and len(document['embed_ms']) == 2
+    assert document['records'] == 2 and document['embed.texts'] == 4
+
+
+def test_the_memory_exporter_summarizes_every_stage():
+    exporter = MemoryExporter()
+    tracer = Tracer('svc', exporter)
+    for _ in range(3):
+        with tracer.span('request'):
+            with tracer.span('retrieve'):
+                pass
+    summary = exporter.summary()
+    assert set(summary) == {'request', 'retrieve'}
+    assert summary['retrieve']['count'] == 3
+    assert summary['retrieve']['p50_ms'] <= summary['retrieve']['p99_ms']
+    assert stage_durations(exporter.traces[0]).keys() == {'request', 'retrieve'}
+
+
+def test_percentile_picks_the_nearest_rank():
+    assert percentile([5, 1, 3, 2, 4], 0.5) == 3
+    assert percentile([5, 1, 3, 2, 4], 0.99) == 5
+    assert percentile([7], 0.95) == 7
+
+
+def test_a_failing_exporter_does_not_fail_the_request(capsys):
+    tracer = Tracer('svc', FailingExporter())
+    with tracer.span('request') as root:
+        pass
+    assert f"Failed to export trace {root.trace_id}" in capsys.readouterr().out
+
+
+def test_the_exporter_is_chosen_by_the_environment(monkeypatch):
+    monkeypatch.setenv('tracing_exporter', 'memory')
+    assert isinstance(build_tracer_from_env('svc').exporter, MemoryExporter)
+    monkeypatch.setenv('tracing_exporter', 'none')
+    assert build_tracer_from_env('svc').exporter is None
+    monkeypatch.setenv('tracing_exporter', 'xray')
+    with pytest.raises(ValueError, match='xray'):
+        build_tracer_from_env('svc')
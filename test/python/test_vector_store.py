@@ -0,0 +1,73 @@
+import os
+
+import index_profiles
+from opensearch_bulk import BulkItem, bulk_index
+from vector_store import DOCUMENTS_FILE, LocalVectorStore
+
+ALIAS = 'rag-vector-index'
+
+
+def knn(client, vector, k=2, **body):
+    response = client.search(body=dict({'size': k, 'query': {'knn': {'vector_field': {'vector': vector, 'k': k}}}},
+                                       **body), index=ALIAS)
+    return [hit['_id'] for hit in response['hits']['hits']]
+
+
+def fill(client):
+    body = index_profiles.build_index_body('balanced')
+    body['mappings']['properties']['vector_field']['dimension'] = 2
+    index_name = index_profiles.versioned_index_name(ALIAS, body)
+    index_profiles.ensure_index(client, index_name, body)
+    index_profiles.swap_alias(client, ALIAS, index_name)
+    bulk_index(client, ALIAS, [BulkItem(str(n), {'vector_field': [1.0, float(n)], 'text': f'chunk {n}',
+                                                 'source': 'a.pdf' if n % 2 else 'b.pdf'}, doc_id=str(n))
+                               for n in range(6)])
+    return index_name
+
+
+def test_knn_returns_the_nearest_documents_with_their_vectors():
+    client = LocalVectorStore()
+    fill(client)
+    assert knn(client, [1.0, 4.2]) == ['4', '5']
+    hit = client.search(body={'size': 1, 'query': {'knn': {'vector_field': {'vector': [1.0, 0.0], 'k': 1}}}},
+                        index=ALIAS)['hits']['hits'][0]
+    assert hit['_source'] == {'vector_field': [1.0, 0.0], 'text': 'chunk 0', 'source': 'b.pdf'}
+
+
+def test_filtered_knn_only_returns_matching_documents():
+    client = LocalVectorStore()
+    fill(client)
+    response = client.search(body={'size': 2, 'query': {'knn': {'vector_field': {
+        'vector': [1.0, 4.2], 'k': 2, 'filter': {'term': {'source': 'a.pdf'}}}}}}, index=ALIAS)
+    assert [hit['_id'] for hit in response['hits']['hits']] == ['5', '3']
+
+
+def test_a_store_directory_survives_a_restart(tmp_path):
+    client = LocalVectorStore(str(tmp_path))
+    index_name = fill(client)
+    bulk_index(client, ALIAS, [BulkItem('4', doc_id='4', op_type='delete'),
+                               BulkItem('1', {'vector_field': [1.0, 9.0], 'text': 'moved'}, doc_id='1')])
+
+    reopened = LocalVectorStore(str(tmp_path))
+    assert index_profiles.alias_targets(reopened, ALIAS) == [index_name]
+    assert reopened.count(index=ALIAS)['count'] == 5
+    assert knn(reopened, [1.0, 4.2]) == ['5', '3']
+    assert knn(reopened, [1.0, 9.0], k=1) == ['1']
+
+
+def test_a_torn_last_log_line_is_skipped(tmp_path):
+    client = LocalVectorStore(str(tmp_path))
+    index_name = fill(client)
+    with open(os.path.join(str(tmp_path), index_name, DOCUMENTS_FILE), 'a') as log:
+        log.write('{"_id": "6", "_sou')
+
+    reopened = LocalVectorStore(str(tmp_path))
+    assert reopened.count(index=ALIAS)['count'] == 6
+
+
+def test_approximate_search_goes_through_the_profile_graph():
+    client = LocalVectorStore(approximate=True)
+    index_name = fill(client)
+    (graph, _), = client.graphs[index_name].values()
+    assert len(graph) == 6 and graph.m == 16
+    assert knn(client, [1.0, 4.2]) == ['4', '5']